@@ -0,0 +1,487 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import importlib.util
+import numpy as np
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+import SimpleITK as sitk
+from dicom_index import build_index
+from dicom_patch import patch_file, patch_files
+from dicom_stream import iter_series_chunks
+from nrrd_io import NrrdWriter
+from parallel_gzip import open_gzip
+from us_dicom import write_us_dicom
+from nrrd_to_dicom_seg import ReferenceCache, get_seg_info, create_dicom_seg, load_templates
+
+# The conversion script has a dash in its name, it is loaded from its path
+_spec = importlib.util.spec_from_file_location(
+    'dicom_to_nifti', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dicom_to_nifti-nrrd_img.py'))
+dicom_to_nifti = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(dicom_to_nifti)
+
+DATE = '19990101'
+MR_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+
+# Sessions of a synthetic case, with the same file and folder names as the ReMIND NRRD release
+PREOP_MR = ['ceT1', 'T2', 'FLAIR']
+INTRAOP_US = ['pre_dura', 'post_dura', 'pre_imri']
+INTRAOP_MR = ['ceT1', 'T2']
+SEGS = [('preop', 'tumor', 'ceT1'), ('intraop', 'tumor_residual', 'ceT1')]
+
+STAGES = ['index', 'index_cached', 'read_sitk', 'read_streaming', 'compress', 'write_nrrd', 'write_nifti',
+          'convert_streaming', 'patch', 'us_write', 'seg_write']
+
+
+def parsing_data():
+    parser = argparse.ArgumentParser(
+        description='Benchmark of the conversion stages on a synthetic ReMIND-shaped dataset')
+    parser.add_argument('--path_work',
+                        type=str,
+                        default=None,
+                        help='Folder of the synthetic dataset and outputs (default: temporary folder, deleted at the end)')
+    parser.add_argument('--output',
+                        type=str,
+                        default='benchmark.json',
+                        help='Path to the JSON report')
+    parser.add_argument('--cases',
+                        type=int,
+                        default=2,
+                        help='Number of synthetic cases')
+    parser.add_argument('--mr_size',
+                        type=int,
+                        nargs=3,
+                        default=[256, 256, 176],
+                        help='Size of the MR volumes (columns rows slices)')
+    parser.add_argument('--us_size',
+                        type=int,
+                        nargs=3,
+                        default=[256, 256, 256],
+                        help='Size of the US volumes (columns rows frames)')
+    parser.add_argument('--stages',
+                        type=str,
+                        nargs='+',
+                        default=STAGES,
+                        choices=STAGES,
+                        help='Stages to time')
+    parser.add_argument('--compression_levels',
+                        type=int,
+                        nargs='+',
+                        default=[1, 6, 9],
+                        choices=range(-1, 10),
+                        help='gzip levels of the compress stage')
+    parser.add_argument('--compression_threads',
+                        type=int,
+                        nargs='+',
+                        default=[1, os.cpu_count() or 1],
+                        help='Numbers of threads of the compress stage')
+    parser.add_argument('--memory_budget',
+                        type=int,
+                        default=256,
+                        help='Memory budget in MB of the streaming stages')
+    parser.add_argument('--index_workers',
+                        type=int,
+                        default=8,
+                        help='Number of threads reading the DICOM headers')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0,
+                        help='Seed of the synthetic volumes')
+    opt = parser.parse_args()
+
+    return opt
+
+
+def _reset_peak_rss():
+    # Linux only: resets the peak RSS of the process so that it is measured per stage
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Peak since the start of the process, in bytes on macOS and kB elsewhere
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+class StageTimer:
+    """
+    Accumulate the wall and CPU time of the timed sections of a stage, and the data they processed
+    """
+
+    def __init__(self):
+        self.seconds = 0.
+        self.cpu_seconds = 0.
+        self.volumes = 0
+        self.bytes = 0
+        self.extra = {}
+
+    def __enter__(self):
+        self.start = (time.perf_counter(), time.process_time())
+        return self
+
+    def __exit__(self, *args):
+        self.seconds += time.perf_counter() - self.start[0]
+        self.cpu_seconds += time.process_time() - self.start[1]
+
+    def count(self, nbytes, volumes=1):
+        self.volumes += volumes
+        self.bytes += nbytes
+
+    def report(self):
+        return {'seconds': round(self.seconds, 4),
+                'cpu_seconds': round(self.cpu_seconds, 4),
+                'volumes': self.volumes,
+                'megabytes': round(self.bytes / 1024 ** 2, 2),
+                'volumes_per_sec': round(self.volumes / self.seconds, 3) if self.seconds else None,
+                'mb_per_sec': round(self.bytes / 1024 ** 2 / self.seconds, 2) if self.seconds else None,
+                **self.extra}
+
+
+class _CountingSink(io.RawIOBase):
+    # Discards the compressed stream, only its size is kept
+    def __init__(self):
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def _phantom(size, rng):
+    # Smooth head-like volume with noise, so that the compression ratio is realistic
+    columns, rows, slices = size
+    z, y, x = np.ogrid[-1:1:slices * 1j, -1:1:rows * 1j, -1:1:columns * 1j]
+    radius = np.sqrt((x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.85) ** 2)
+    volume = np.where(radius < 1, 600 + 300 * np.cos(6 * radius), 0).astype(np.float32)
+    volume += rng.normal(0, 20, volume.shape).astype(np.float32) * (radius < 1.05)
+    return volume, radius
+
+
+def _geometry(size, spacing, rng):
+    # Slightly oblique in-plane orientation
+    angle = rng.uniform(-0.1, 0.1)
+    directions = np.array([[np.cos(angle), np.sin(angle), 0], [-np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+    origin = -0.5 * np.array(size) * spacing @ directions
+    return origin, directions, np.array(spacing, dtype=float)
+
+
+def _write_nrrd(path_nrrd, volume, origin, directions, spacing):
+    with NrrdWriter(path_nrrd, volume.shape[::-1], volume.dtype, origin, directions, spacing) as writer:
+        writer.write(volume)
+
+
+def _write_mr_dicom(path_folder, volume, origin, directions, spacing, info, study_instance_uid):
+    # Single-frame MR series, as exported by 3D Slicer
+    os.makedirs(path_folder, exist_ok=True)
+    series_instance_uid = generate_uid()
+    frame_of_reference_uid = generate_uid()
+    for k, pixels in enumerate(volume):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MR_STORAGE
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+        ds = FileDataset(None, {}, file_meta=file_meta, preamble=b'\0' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = MR_STORAGE
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.PatientName = info['patient_name']
+        ds.PatientID = info['patient_id']
+        ds.StudyInstanceUID = study_instance_uid
+        ds.StudyID = info['study_id']
+        ds.StudyDate = DATE
+        ds.StudyDescription = info['study_id']
+        ds.SeriesInstanceUID = series_instance_uid
+        ds.SeriesNumber = info['series_number']
+        ds.SeriesDescription = info['series_description']
+        ds.Modality = 'MR'
+        ds.RescaleType = 'US'
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [float(f'{v:.10g}') for v in origin + k * spacing[2] * directions[2]]
+        ds.ImageOrientationPatient = [float(f'{v:.10g}') for v in np.concatenate([directions[0], directions[1]])]
+        ds.PixelSpacing = [float(spacing[1]), float(spacing[0])]
+        ds.SliceThickness = float(spacing[2])
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.RescaleSlope = 1
+        ds.RescaleIntercept = 0
+        ds.PixelData = np.ascontiguousarray(pixels, dtype='<i2').tobytes()
+        ds.save_as(os.path.join(path_folder, f'IMG{k + 1:04d}.dcm'), write_like_original=False)
+
+
+def generate_dataset(opt, path_nrrd, path_dicom):
+    """
+    Generate a synthetic ReMIND-shaped dataset: the NRRD release (Preop-MR, Intraop-US, Intraop-MR
+    and Annotations folders) and its DICOM conversion, with the same names as the conversion scripts
+    @param opt: parsed arguments
+    @param path_nrrd: root of the NRRD dataset
+    @param path_dicom: root of the DICOM dataset
+    @return: dictionary with the NRRD files of the US volumes and of the segmentations
+    """
+    rng = np.random.default_rng(opt.seed)
+    dataset = {'us': [], 'seg': []}
+    for number in range(1, opt.cases + 1):
+        case = f'case{number:03d}'
+        patient_id = case[4:]
+        sessions = {'preop': ('Preop', [('Preop-MR', 'MR', k) for k in PREOP_MR]),
+                    'intraop': ('Intraop', [('Intraop-US', 'US', k) for k in INTRAOP_US] +
+                                [('Intraop-MR', 'MR', k) for k in INTRAOP_MR])}
+        for session, (study_id, images) in sessions.items():
+            study_instance_uid = generate_uid()
+            geometry = _geometry(opt.mr_size, [0.9, 0.9, 1.0], rng)
+            series_numbers = {'Preop-MR': 1, 'Intraop-MR': 4}
+            for folder, modality, name in images:
+                path_folder = os.path.join(path_nrrd, case, folder)
+                os.makedirs(path_folder, exist_ok=True)
+                path_image = os.path.join(path_folder, f'{case}-{session}-{modality}-{name}.nrrd')
+                if modality == 'US':
+                    volume, radius = _phantom(opt.us_size, rng)
+                    volume = np.clip(volume / 4 * rng.rayleigh(1, volume.shape), 0, 255).astype(np.uint8)
+                    _write_nrrd(path_image, volume, *_geometry(opt.us_size, [0.3, 0.3, 0.3], rng))
+                    series_number = INTRAOP_US.index(name) + 1
+                    description = f'US_{name}'
+                    path_us = os.path.join(path_dicom, f'{patient_id}-CASE^{patient_id}', f'{DATE}-{study_id}',
+                                           f'{series_number}-{description}')
+                    os.makedirs(path_us, exist_ok=True)
+                    write_us_dicom(path_image, os.path.join(path_us, f'{description}.dcm'),
+                                   patient_name=f'CASE^{patient_id}', patient_id=patient_id, study_id=study_id,
+                                   series_number=series_number, instance_number=series_number,
+                                   study_instance_uid=study_instance_uid, study_description=study_id,
+                                   series_description=description, study_date=DATE)
+                    dataset['us'].append(path_image)
+                    continue
+                volume, radius = _phantom(opt.mr_size, rng)
+                volume = volume.astype(np.int16)
+                _write_nrrd(path_image, volume, *geometry)
+                info = {'patient_id': patient_id, 'patient_name': f'CASE^{patient_id}', 'study_id': study_id,
+                        'series_number': series_numbers[folder], 'series_description': name}
+                _write_mr_dicom(os.path.join(path_dicom, f'{patient_id}-CASE^{patient_id}', f'{DATE}-{study_id}',
+                                             f'{series_numbers[folder]}-{name}'),
+                                volume, *geometry, info, study_instance_uid)
+                series_numbers[folder] += 1
+            # Label maps on the grid of their reference MR
+            for seg_session, structure, ref_scan in SEGS:
+                if seg_session != session:
+                    continue
+                path_folder = os.path.join(path_nrrd, case, 'Annotations')
+                os.makedirs(path_folder, exist_ok=True)
+                path_seg = os.path.join(path_folder, f'{case}-{session}-SEG-{structure}-MR-{ref_scan}.nrrd')
+                labels = (radius < 0.3 + 0.1 * rng.random()).astype(np.uint8)
+                _write_nrrd(path_seg, labels, *geometry)
+                dataset['seg'].append(path_seg)
+    return dataset
+
+
+def list_units(path_dicom, path_output, opt):
+    # Same conversion units as dicom_to_nifti-nrrd_img.py
+    args = argparse.Namespace(path_dicom=path_dicom, path_output=path_output, index=None,
+                              index_workers=opt.index_workers, archive_root='')
+    _, units = dicom_to_nifti.list_series(args, 'nrrd')
+    return units
+
+
+def _read_image(unit):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(unit['inputs'])
+    return reader.Execute()
+
+
+def run_stage(stage, opt, paths, dataset, timer):
+    """
+    Run a stage of the benchmark, only the sections under the timer are measured
+    @param stage: name of the stage
+    @param opt: parsed arguments
+    @param paths: dictionary of the work folders
+    @param dataset: dictionary returned by generate_dataset
+    @param timer: StageTimer of the stage
+    """
+    memory_budget = opt.memory_budget * 1024 ** 2
+    if stage == 'index':
+        with timer:
+            index = build_index(paths['dicom'], None, workers=opt.index_workers)
+        for folder, folder_series in index.items():
+            for series in folder_series.values():
+                timer.count(sum(os.path.getsize(os.path.join(paths['dicom'], folder, k)) for k in series['files']))
+    elif stage == 'index_cached':
+        path_index = os.path.join(paths['work'], 'dicom_index.json')
+        build_index(paths['dicom'], path_index, workers=opt.index_workers)
+        with timer:
+            index = build_index(paths['dicom'], path_index, workers=opt.index_workers)
+        timer.count(0, volumes=sum(len(k) for k in index.values()))
+    elif stage == 'read_sitk':
+        for unit in paths['units']:
+            with timer:
+                image = _read_image(unit)
+            timer.count(sitk.GetArrayViewFromImage(image).nbytes)
+            del image
+    elif stage == 'read_streaming':
+        for unit in paths['units']:
+            nbytes = 0
+            with timer:
+                for chunk in iter_series_chunks(unit['inputs'], memory_budget):
+                    nbytes += chunk.nbytes
+            timer.count(nbytes)
+    elif stage == 'compress':
+        # One report per (level, threads), on the raw pixels of the series
+        results = {}
+        for level in sorted(set(opt.compression_levels)):
+            for threads in sorted(set(opt.compression_threads)):
+                sub_timer = StageTimer()
+                compressed = 0
+                for unit in paths['units']:
+                    sink = _CountingSink()
+                    f_gzip = open_gzip(sink, compresslevel=level, threads=threads)
+                    nbytes = 0
+                    for chunk in iter_series_chunks(unit['inputs'], memory_budget):
+                        data = np.ascontiguousarray(chunk).tobytes()
+                        with sub_timer:
+                            f_gzip.write(data)
+                        nbytes += len(data)
+                    with sub_timer:
+                        f_gzip.close()
+                    sub_timer.count(nbytes)
+                    compressed += sink.size
+                sub_timer.extra['ratio'] = round(compressed / sub_timer.bytes, 4) if sub_timer.bytes else None
+                results[f'gzip_l{level}_t{threads}'] = sub_timer.report()
+                timer.seconds += sub_timer.seconds
+                timer.cpu_seconds += sub_timer.cpu_seconds
+                timer.count(sub_timer.bytes, sub_timer.volumes)
+        timer.extra['codecs'] = results
+    elif stage in ['write_nrrd', 'write_nifti']:
+        ext = 'nrrd' if stage == 'write_nrrd' else 'nii.gz'
+        for unit in paths['units']:
+            image = _read_image(unit)
+            output_file = os.path.join(paths['work'], 'output', f'{stage}.{ext}')
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            with timer:
+                if ext == 'nrrd':
+                    dicom_to_nifti.write_nrrd(image, output_file)
+                else:
+                    dicom_to_nifti.write_image(image, output_file)
+            timer.count(sitk.GetArrayViewFromImage(image).nbytes)
+            del image
+    elif stage == 'convert_streaming':
+        for unit in paths['units']:
+            unit = dict(unit, output_file=os.path.join(paths['work'], 'output', 'convert_streaming.nii.gz'))
+            with timer:
+                dicom_to_nifti.convert_series(unit, memory_budget)
+            timer.count(_unit_bytes(unit, memory_budget))
+    elif stage == 'patch':
+        # Same edits as nrrd_to_dicom_img.py after the exports
+        values = {'StudyDate': DATE}
+        for unit in paths['units']:
+            with timer:
+                if len(unit['inputs']) > 1:
+                    failures = patch_files(unit['inputs'], values, delete=['RescaleType'], workers=opt.index_workers)
+                    assert not any(e is not None for _, e in failures), failures
+                else:
+                    patch_file(unit['inputs'][0], values)
+            timer.count(sum(os.path.getsize(k) for k in unit['inputs']))
+    elif stage == 'us_write':
+        for path_nrrd in dataset['us']:
+            path_output = os.path.join(paths['work'], 'output', 'us_write.dcm')
+            os.makedirs(os.path.dirname(path_output), exist_ok=True)
+            with timer:
+                write_us_dicom(path_nrrd, path_output, patient_name='CASE^000', patient_id='000', study_id='Intraop',
+                               series_number=1, instance_number=1, study_instance_uid=generate_uid(),
+                               study_description='Intraop', series_description='US_pre_dura', study_date=DATE)
+            timer.count(os.path.getsize(path_output))
+    elif stage == 'seg_write':
+        templates = load_templates()
+        references = ReferenceCache()
+        for path_nrrd in dataset['seg']:
+            with timer:
+                info = get_seg_info(path_nrrd, paths['dicom'], references)
+                info['reference'] = references.get_series(info['path_ref_folder'])
+                create_dicom_seg(path_nrrd, paths['dicom'], None, templates, info, engine='native')
+            timer.count(os.path.getsize(info['path_dicom_seg']))
+
+
+def _unit_bytes(unit, memory_budget):
+    # Size of the pixels of a series once decoded, from the index
+    series = unit['series']
+    frames = int(series.get('NumberOfFrames', 1)) if len(unit['inputs']) == 1 else len(unit['inputs'])
+    header = pydicom.dcmread(unit['inputs'][0], stop_before_pixels=True, specific_tags=['BitsAllocated'])
+    return frames * int(series['Rows']) * int(series['Columns']) * int(header.BitsAllocated) // 8
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    opt = parsing_data()
+    path_work = opt.path_work if opt.path_work is not None else tempfile.mkdtemp(prefix='remind_benchmark_')
+    paths = {'work': path_work,
+             'nrrd': os.path.join(path_work, 'nrrd'),
+             'dicom': os.path.join(path_work, 'dicom')}
+    try:
+        print(f'Generating {opt.cases} synthetic cases in {path_work}')
+        start = time.perf_counter()
+        dataset = generate_dataset(opt, paths['nrrd'], paths['dicom'])
+        paths['units'] = list_units(paths['dicom'], os.path.join(path_work, 'output'), opt)
+        generation = time.perf_counter() - start
+
+        stages = {}
+        for stage in opt.stages:
+            timer = StageTimer()
+            _reset_peak_rss()
+            run_stage(stage, opt, paths, dataset, timer)
+            stages[stage] = dict(timer.report(), peak_rss_mb=round(_peak_rss_mb(), 1))
+            print(f"{stage:>18}: {stages[stage]['seconds']:8.2f} s  {stages[stage]['volumes_per_sec'] or 0:8.2f} vol/s"
+                  f"  {stages[stage]['mb_per_sec'] or 0:8.1f} MB/s  {stages[stage]['peak_rss_mb']:8.1f} MB RSS")
+
+        report = {'commit': get_commit(),
+                  'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'cpu_count': os.cpu_count(),
+                  'config': {k: v for k, v in vars(opt).items() if k not in ['path_work', 'output']},
+                  'dataset': {'cases': opt.cases,
+                              'series': len(paths['units']),
+                              'generation_seconds': round(generation, 2)},
+                  'stages': stages}
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Report written to {opt.output}')
+    finally:
+        if opt.path_work is None:
+            shutil.rmtree(path_work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
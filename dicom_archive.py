@@ -0,0 +1,100 @@
+import os
+import tarfile
+import zipfile
+import threading
+
+# Archives opened by each thread of each process, as zip and tar handles cannot be shared,
+# and the member listings of the process, so that a tar archive is only scanned once
+_handles = threading.local()
+_listings = {}
+
+
+def is_archive(path):
+    """
+    Check if a path is a zip or tar archive (possibly compressed) rather than a folder
+    """
+    return os.path.isfile(path) and (zipfile.is_zipfile(path) or tarfile.is_tarfile(path))
+
+
+class DicomArchive:
+    """
+    Read-only access to the files of a zip or tar archive, without extracting it.
+    Members are opened as seekable file objects, decompressed while they are read.
+    Random access is cheap in zip and uncompressed tar archives, a compressed tar
+    is decompressed from its start to reach a member.
+    """
+
+    def __init__(self, path, root='', members=None):
+        """
+        @param path: path to the archive
+        @param root: folder inside the archive used as root, e.g. manifest-1695134609823/ReMIND
+        @param members: member listing of another DicomArchive of the same archive and root, listed if None
+        """
+        self.path = path
+        self.root = root.strip('/')
+        prefix = self.root + '/' if self.root else ''
+        if zipfile.is_zipfile(path):
+            self.zip, self.tar = zipfile.ZipFile(path), None
+        else:
+            self.zip, self.tar = None, tarfile.open(path)
+        self.members = members
+        if members is not None:
+            return
+        self.members = {}
+        if self.zip is not None:
+            for info in self.zip.infolist():
+                if not info.is_dir() and info.filename.startswith(prefix):
+                    self.members[info.filename[len(prefix):]] = (info, info.file_size, list(info.date_time))
+        else:
+            for info in self.tar:
+                if info.isfile() and info.name.startswith(prefix):
+                    self.members[info.name[len(prefix):]] = (info, info.size, info.mtime)
+
+    def folder_signatures(self):
+        """
+        Signature of each folder from the member listing, as dicom_index does for a folder on disk
+        @return: dictionary folder (relative to the root) -> sorted list of [name, size, mtime]
+        """
+        folders = {}
+        for name, (_, size, mtime) in self.members.items():
+            folder, _, filename = name.rpartition('/')
+            folders.setdefault(folder or '.', []).append([filename, size, mtime])
+        return {k: sorted(v) for k, v in folders.items()}
+
+    def open(self, name):
+        """
+        Open a member for reading
+        @param name: path of the member relative to the root
+        @return: seekable binary file object
+        """
+        name = name[2:] if name.startswith('./') else name
+        info = self.members[name][0]
+        if self.zip is not None:
+            return self.zip.open(info)
+        return self.tar.extractfile(info)
+
+    def getsize(self, name):
+        """
+        Uncompressed size of a member
+        """
+        return self.members[name[2:] if name.startswith('./') else name][1]
+
+    def close(self):
+        (self.zip or self.tar).close()
+
+
+def open_archive(path, root=''):
+    """
+    Open an archive once per thread and per process, so that series of the same archive
+    can be read in parallel (forked workers must not share the file offset of their parent)
+    @param path: path to the archive
+    @param root: folder inside the archive used as root
+    @return: DicomArchive
+    """
+    if getattr(_handles, 'pid', None) != os.getpid():
+        _handles.pid, _handles.archives = os.getpid(), {}
+    if (path, root) not in _handles.archives:
+        archive = DicomArchive(path, root, _listings.get((os.getpid(), path, root)))
+        _listings[(os.getpid(), path, root)] = archive.members
+        _handles.archives[(path, root)] = archive
+    return _handles.archives[(path, root)]
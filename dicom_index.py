@@ -0,0 +1,172 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pydicom
+from pydicom.errors import InvalidDicomError
+from dicom_archive import is_archive, open_archive
+
+INDEX_VERSION = 2
+
+# Only the tags needed to group, sort and name the series are read from the headers
+INDEX_TAGS = ['SOPClassUID',
+              'SOPInstanceUID',
+              'StudyInstanceUID',
+              'SeriesInstanceUID',
+              'FrameOfReferenceUID',
+              'SeriesNumber',
+              'SeriesDescription',
+              'SequenceName',
+              'ProtocolName',
+              'Modality',
+              'InstanceNumber',
+              'ImagePositionPatient',
+              'ImageOrientationPatient',
+              'PixelSpacing',
+              'SliceThickness',
+              'Rows',
+              'Columns',
+              'NumberOfFrames']
+
+
+def _to_json(value):
+    if isinstance(value, (list, pydicom.multival.MultiValue)):
+        return [_to_json(k) for k in value]
+    if isinstance(value, (int, float)):
+        return value
+    return str(value)
+
+
+def read_header(path_file):
+    """
+    Read the indexed tags of a DICOM file, without the pixel data
+    @param path_file: path to the DICOM file (or file-like object)
+    @return: dictionary of the tags present in the file, None if it is not a DICOM file
+    """
+    try:
+        dicom_input = pydicom.dcmread(path_file, stop_before_pixels=True, specific_tags=INDEX_TAGS)
+    except (InvalidDicomError, EOFError):
+        return None
+    if 'SeriesInstanceUID' not in dicom_input:
+        return None
+    return {k: _to_json(dicom_input.data_element(k).value) for k in INDEX_TAGS
+            if k in dicom_input and dicom_input.data_element(k).value is not None}
+
+
+def sort_instances(headers):
+    """
+    Sort the instances of a series along the slice normal, as GDCM does,
+    falling back on the InstanceNumber
+    @param headers: list of (filename, header) of the series
+    @return: sorted list of (filename, header)
+    """
+    headers = sorted(headers, key=lambda k: k[0])
+    if all('ImagePositionPatient' in h and 'ImageOrientationPatient' in h for _, h in headers):
+        orientation = np.array(headers[0][1]['ImageOrientationPatient'], dtype=float)
+        normal = np.cross(orientation[:3], orientation[3:])
+        distances = [float(np.dot(normal, h['ImagePositionPatient'])) for _, h in headers]
+        if len(set(distances)) == len(distances):
+            return [headers[k] for k in np.argsort(distances, kind='stable')]
+    return sorted(headers, key=lambda k: k[1].get('InstanceNumber', 0))
+
+
+def _folder_signature(path_folder):
+    # Cheap signature from the directory listing, no file is opened
+    signature = []
+    with os.scandir(path_folder) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                signature.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return sorted(signature)
+
+
+def _index_folder(path_folder, signature, archive=None):
+    series = {}
+    for name, _, _ in signature:
+        if archive is None:
+            header = read_header(os.path.join(path_folder, name))
+        else:
+            # Member of an archive, opened with the handle of the thread
+            with open_archive(*archive).open(f'{path_folder}/{name}') as f:
+                header = read_header(f)
+        if header is None:
+            continue
+        series.setdefault(header['SeriesInstanceUID'], []).append((name, header))
+
+    entries = {}
+    for uid, headers in series.items():
+        headers = sort_instances(headers)
+        # Series level tags are taken from the first instance
+        entry = {k: v for k, v in headers[0][1].items() if k not in ['ImagePositionPatient', 'InstanceNumber', 'SOPInstanceUID']}
+        entry['files'] = [name for name, _ in headers]
+        entry['instances'] = [h.get('SOPInstanceUID') for _, h in headers]
+        entry['positions'] = [h.get('ImagePositionPatient') for _, h in headers]
+        entries[uid] = entry
+    return entries
+
+
+def index_folder(path_folder):
+    """
+    Index the DICOM series of a single folder with header-only reads
+    @param path_folder: path to the folder
+    @return: dictionary SeriesInstanceUID -> series
+    """
+    return _index_folder(path_folder, _folder_signature(path_folder))
+
+
+def build_index(path_root, path_index=None, workers=8, archive_root=''):
+    """
+    Index all the DICOM series of a tree with header-only reads.
+    Folders whose listing did not change since the cached index are not read again.
+    @param path_root: root of the DICOM tree (e.g. TCIA manifest folder), or zip/tar archive of the tree
+    @param path_index: path to the on-disk cache of the index (json), not cached if None
+    @param workers: number of threads reading the headers
+    @param archive_root: folder inside the archive used as root, if path_root is an archive
+    @return: dictionary folder (relative to path_root) -> {SeriesInstanceUID -> series}
+    """
+    archive = (path_root, archive_root) if is_archive(path_root) else None
+    root = os.path.abspath(path_root) if archive is None else f'{os.path.abspath(path_root)}:{archive_root}'
+    cached = {}
+    if path_index is not None and os.path.isfile(path_index):
+        with open(path_index) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION and index.get('root') == root:
+            cached = index['folders']
+
+    folders = {}
+    if archive is None:
+        for path_folder, _, files in os.walk(path_root):
+            if files:
+                folders[os.path.relpath(path_folder, path_root)] = _folder_signature(path_folder)
+    else:
+        folders = open_archive(*archive).folder_signatures()
+
+    todo = [k for k, signature in folders.items()
+            if k not in cached or cached[k]['signature'] != signature]
+    indexed = {k: cached[k] for k in folders if k not in todo}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if archive is None:
+            results = executor.map(lambda k: _index_folder(os.path.join(path_root, k), folders[k]), todo)
+        else:
+            results = executor.map(lambda k: _index_folder(k, folders[k], archive), todo)
+        for folder, series in zip(todo, results):
+            indexed[folder] = {'signature': folders[folder], 'series': series}
+
+    if path_index is not None and (todo or len(indexed) != len(cached)):
+        os.makedirs(os.path.dirname(os.path.abspath(path_index)), exist_ok=True)
+        with open(path_index + '.tmp', 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'root': root, 'folders': indexed}, f)
+        os.replace(path_index + '.tmp', path_index)
+
+    return {k: v['series'] for k, v in indexed.items()}
+
+
+def series_in_folder(index, folder):
+    """
+    List the series of a folder of the index, sorted by SeriesNumber
+    @param index: index returned by build_index
+    @param folder: folder relative to the indexed root
+    """
+    series = list(index.get(os.path.normpath(folder), {}).values())
+    return sorted(series, key=lambda k: (k.get('SeriesNumber', 0), k['SeriesInstanceUID']))
@@ -0,0 +1,71 @@
+import os
+import io
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+import pydicom
+from pydicom.uid import DeflatedExplicitVRLittleEndian
+
+
+def patch_file(path_dicom, values=None, delete=()):
+    """
+    Change some attributes of a DICOM file without decoding or copying its pixel data in memory.
+    Only the header is parsed; the bytes from the pixel data element to the end of the file
+    are copied unchanged after the rewritten header.
+    @param path_dicom: path to the DICOM file, replaced atomically
+    @param values: dictionary keyword -> new value
+    @param delete: keywords of the attributes to remove if present
+    """
+    values = {} if values is None else values
+    with open(path_dicom, 'rb') as f:
+        # stop_before_pixels rewinds the file to the start of the pixel data element
+        dataset = pydicom.dcmread(f, stop_before_pixels=True, force=True)
+        offset_pixels = f.tell()
+        file_meta = getattr(dataset, 'file_meta', None)
+        transfer_syntax = file_meta.get('TransferSyntaxUID') if file_meta is not None else None
+        if transfer_syntax == DeflatedExplicitVRLittleEndian:
+            # The whole dataset is compressed, no raw byte range can be reused
+            f.seek(0)
+            dataset = pydicom.dcmread(f, force=True)
+            offset_pixels = None
+
+        for keyword, value in values.items():
+            setattr(dataset, keyword, value)
+        for keyword in delete:
+            if keyword in dataset:
+                delattr(dataset, keyword)
+
+        header = io.BytesIO()
+        pydicom.dcmwrite(header, dataset, write_like_original=True)
+
+        path_temp = f'{path_dicom}.tmp'
+        try:
+            with open(path_temp, 'wb') as output:
+                output.write(header.getvalue())
+                if offset_pixels is not None:
+                    f.seek(offset_pixels)
+                    shutil.copyfileobj(f, output, 1 << 22)
+        except BaseException:
+            if os.path.exists(path_temp):
+                os.remove(path_temp)
+            raise
+    os.replace(path_temp, path_dicom)
+
+
+def patch_files(paths_dicom, values=None, delete=(), workers=8):
+    """
+    Patch several DICOM files in parallel, see patch_file
+    @param paths_dicom: paths to the DICOM files
+    @param values: dictionary keyword -> new value
+    @param delete: keywords of the attributes to remove if present
+    @param workers: number of threads
+    @return: list of (path, error) for the files that could not be patched
+    """
+    def patch(path_dicom):
+        try:
+            patch_file(path_dicom, values, delete)
+        except Exception as e:
+            return path_dicom, e
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [k for k in executor.map(patch, paths_dicom) if k is not None]
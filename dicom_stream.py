@@ -0,0 +1,142 @@
+import struct
+import numpy as np
+import pydicom
+from pydicom.uid import UID
+
+# Transfer syntaxes whose frames can be read directly from the file
+NATIVE_TRANSFER_SYNTAXES = ['1.2.840.10008.1.2', '1.2.840.10008.1.2.1']
+
+
+def _rescale(dataset, pixels):
+    slope = float(dataset.get('RescaleSlope', 1) or 1)
+    intercept = float(dataset.get('RescaleIntercept', 0) or 0)
+    if slope == 1 and intercept == 0:
+        return pixels
+    # Same output type as the GDCM reader: integers stay integers if the rescale is integral
+    if slope.is_integer() and intercept.is_integer() and pixels.dtype.itemsize <= 2:
+        return pixels.astype(np.int32) * int(slope) + int(intercept)
+    return pixels.astype(np.float32) * slope + intercept
+
+
+def frame_geometry(dataset):
+    """
+    Geometry of the frames of a multi-frame file, from its functional groups: the Patient ones,
+    or the Volume ones of the Enhanced US Volume files (e.g. written by PixelMed)
+    @param dataset: header of the file
+    @return: orientation (row and column cosines), pixel spacing (rows, columns) and position of each frame
+    """
+    shared = dataset.SharedFunctionalGroupsSequence[0]
+    per_frames = dataset.PerFrameFunctionalGroupsSequence
+    if 'PlaneOrientationSequence' in shared:
+        orientation = shared.PlaneOrientationSequence[0].ImageOrientationPatient
+        positions = [k.PlanePositionSequence[0].ImagePositionPatient for k in per_frames]
+    else:
+        orientation = shared.PlaneOrientationVolumeSequence[0].ImageOrientationVolume
+        positions = [k.PlanePositionVolumeSequence[0].ImagePositionVolume for k in per_frames]
+    pixel_spacing = [float(k) for k in shared.PixelMeasuresSequence[0].PixelSpacing]
+    return np.array(orientation, dtype=float), pixel_spacing, np.array(positions, dtype=float)
+
+
+def series_geometry(series, first_dataset):
+    """
+    Geometry of a series in the DICOM patient (LPS) space
+    @param series: series entry of the DICOM index
+    @param first_dataset: header of the first file of the series
+    @return: origin, directions (one normalised row per axis), spacing and number of slices
+    """
+    if int(first_dataset.get('NumberOfFrames', 1)) > 1:
+        orientation, pixel_spacing, positions = frame_geometry(first_dataset)
+    else:
+        orientation = np.array(series['ImageOrientationPatient'], dtype=float)
+        pixel_spacing = series['PixelSpacing']
+        positions = np.array(series['positions'], dtype=float)
+    normal = np.cross(orientation[:3], orientation[3:])
+    directions = np.stack([orientation[:3], orientation[3:], normal])
+    if len(positions) > 1:
+        slice_spacing = float(np.mean(np.diff(positions @ normal)))
+    else:
+        slice_spacing = float(first_dataset.get('SliceThickness', 1) or 1)
+    spacing = np.array([float(pixel_spacing[1]), float(pixel_spacing[0]), abs(slice_spacing)])
+    if slice_spacing < 0:
+        directions[2] *= -1
+    return positions[0], directions, spacing, len(positions)
+
+
+def _frame_offset(fp, dataset):
+    # Position of the pixel data value, None if the frames cannot be read directly
+    if dataset.file_meta.get('TransferSyntaxUID') not in NATIVE_TRANSFER_SYNTAXES:
+        return None
+    explicit = dataset.file_meta.TransferSyntaxUID == UID('1.2.840.10008.1.2.1')
+    element = fp.read(12 if explicit else 8)
+    if len(element) < 8 or struct.unpack('<HH', element[:4]) != (0x7FE0, 0x0010):
+        return None
+    if explicit:
+        if element[4:6] in (b'OB', b'OW'):
+            length = struct.unpack('<I', element[8:12])[0]
+        else:
+            return None
+    else:
+        length = struct.unpack('<I', element[4:8])[0]
+    if length == 0xFFFFFFFF:
+        return None
+    return fp.tell()
+
+
+def iter_series_chunks(paths_dicom, max_bytes):
+    """
+    Read a series by chunks of slices (or frames for a multi-frame file), with the
+    rescale slope/intercept applied, so that at most about max_bytes of pixels are in memory.
+    @param paths_dicom: sorted files of the series (or file-like objects)
+    @param max_bytes: memory budget of a chunk
+    @return: generator of arrays (slices, rows, columns), only valid until the next chunk is read
+    """
+    if len(paths_dicom) == 1:
+        yield from _iter_frames_chunks(paths_dicom[0], max_bytes)
+        return
+    # Slices are decoded into a preallocated chunk, so that no second copy is made
+    chunk, number = None, 0
+    for path_dicom in paths_dicom:
+        dataset = pydicom.dcmread(path_dicom)
+        pixels = _rescale(dataset, dataset.pixel_array)
+        del dataset
+        if chunk is None:
+            step = max(1, int(max_bytes // pixels.nbytes))
+            chunk = np.empty((min(step, len(paths_dicom)),) + pixels.shape, dtype=pixels.dtype)
+        elif number == len(chunk):
+            yield chunk
+            number = 0
+        chunk[number] = pixels
+        number += 1
+    if chunk is not None:
+        yield chunk[:number]
+
+
+def _iter_frames_chunks(path_dicom, max_bytes):
+    fp = open(path_dicom, 'rb') if isinstance(path_dicom, str) else path_dicom
+    try:
+        dataset = pydicom.dcmread(fp, stop_before_pixels=True)
+        number_frames = int(dataset.get('NumberOfFrames', 1))
+        offset = _frame_offset(fp, dataset)
+        if offset is None or dataset.SamplesPerPixel != 1 or dataset.BitsAllocated not in (8, 16, 32):
+            # Encapsulated (compressed) pixel data: decoded at once by pydicom
+            fp.seek(0)
+            dataset = pydicom.dcmread(fp)
+            pixels = _rescale(dataset, dataset.pixel_array)
+            pixels = pixels.reshape((number_frames,) + pixels.shape[-2:])
+            step = max(1, int(max_bytes // max(1, pixels[0].nbytes)))
+            for k in range(0, number_frames, step):
+                yield pixels[k:k + step]
+            return
+        dtype = np.dtype(f'<{"i" if dataset.PixelRepresentation else "u"}{dataset.BitsAllocated // 8}')
+        frame_shape = (int(dataset.Rows), int(dataset.Columns))
+        frame_bytes = frame_shape[0] * frame_shape[1] * dtype.itemsize
+        step = max(1, int(max_bytes // frame_bytes))
+        fp.seek(offset)
+        for k in range(0, number_frames, step):
+            number = min(step, number_frames - k)
+            data = fp.read(number * frame_bytes)
+            pixels = np.frombuffer(data, dtype=dtype).reshape((number,) + frame_shape)
+            yield _rescale(dataset, pixels)
+    finally:
+        if isinstance(path_dicom, str):
+            fp.close()
@@ -1,11 +1,24 @@
 import os
+import shutil
+from contextlib import ExitStack
 import argparse
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm import tqdm
+import pydicom
 import SimpleITK as sitk
 from natsort import natsorted
-import pydicom
+from dicom_index import build_index, series_in_folder
+from dicom_archive import is_archive, open_archive
+from dicom_stream import iter_series_chunks, series_geometry
+from nifti_io import NiftiWriter
+from nrrd_io import NrrdWriter, gzip_nrrd
+from parallel_gzip import open_gzip
+from manifest import add_manifest_arguments, open_manifest
+from instrumentation import add_instrumentation_arguments, open_run_log, measure
 
 TIMES = ['Preop', 'Intraop']
+COMPRESSION = {'codec':'gzip', 'level':-1, 'threads':1}
 
 def parsing_data():
     parser = argparse.ArgumentParser(
@@ -13,7 +26,11 @@ def parsing_data():
     parser.add_argument('--path_dicom',
                         type=str,
                         default='../../data/ReMIND_TCIA/manifest-1695134609823/ReMIND/',
-                        help='Path to the DICOM iamges from TCIA')
+                        help='Path to the DICOM iamges from TCIA, or to a zip/tar archive of them')
+    parser.add_argument('--archive_root',
+                        type=str,
+                        default='',
+                        help='Folder inside the archive holding the cases (e.g. manifest-1695134609823/ReMIND)')
     parser.add_argument('--path_output',
                         type=str,
                         default='./nifti_imgs',
@@ -24,95 +41,368 @@ def parsing_data():
     parser.add_argument('--nifti',
                         action='store_true',
                         help='Convert to NIfTI format')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of processes converting series in parallel')
+    parser.add_argument('--index',
+                        type=str,
+                        default=None,
+                        help='Path to the cached index of the DICOM headers (default: dicom_index.json in the output folder)')
+    parser.add_argument('--index_workers',
+                        type=int,
+                        default=8,
+                        help='Number of threads reading the DICOM headers during indexing')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='Read and write the volumes by chunks of slices instead of loading them in memory (always used for archives)')
+    parser.add_argument('--memory_budget',
+                        type=int,
+                        default=256,
+                        help='Maximum size in MB of the pixels held in memory per series with --streaming')
+    parser.add_argument('--compression',
+                        type=str,
+                        default='gzip',
+                        choices=['none', 'gzip'],
+                        help='Compression of the outputs (none writes raw NRRD / .nii)')
+    parser.add_argument('--compression_level',
+                        type=int,
+                        default=-1,
+                        choices=range(-1, 10),
+                        help='gzip compression level, from 1 (fastest) to 9 (smallest), -1 for the default (6)')
+    parser.add_argument('--compression_threads',
+                        type=int,
+                        default=1,
+                        help='Number of threads compressing each output (pigz-style, still readable by any gzip reader)')
+    add_manifest_arguments(parser)
+    add_instrumentation_arguments(parser)
     opt = parser.parse_args()
 
     return opt
 
 
-def get_filename(dicom_input_path):
-    dicom_input = pydicom.read_file(dicom_input_path)
-    base_filename = ""
-    # noinspection PyBroadException
-    try:
-        # construct the filename 
-        base_filename = ""
-        if 'SeriesNumber' in dicom_input:
-            base_filename = f'{dicom_input.SeriesNumber}'
-            if 'SeriesDescription' in dicom_input:
-                base_filename = '%s_%s' % (base_filename, dicom_input.SeriesDescription)
-            elif 'SequenceName' in dicom_input[0]:
-                base_filename = '%s_%s' % (base_filename,dicom_input.SequenceName)
-            elif 'ProtocolName' in dicom_input[0]:
-                base_filename = '%s_%s' % (base_filename, dicom_input.ProtocolName)
-        else:
-            base_filename = dicom_input[0].SeriesInstanceUID
-    except:
-        print("Unable to convert: %s" % dicom_input)
+def get_filename(series):
+    """
+    Construct the output filename of a series from its indexed tags
+    @param series: series entry of the DICOM index
+    """
+    if 'SeriesNumber' in series:
+        base_filename = f'{series["SeriesNumber"]}'
+        if 'SeriesDescription' in series:
+            base_filename = '%s_%s' % (base_filename, series['SeriesDescription'])
+        elif 'SequenceName' in series:
+            base_filename = '%s_%s' % (base_filename, series['SequenceName'])
+        elif 'ProtocolName' in series:
+            base_filename = '%s_%s' % (base_filename, series['ProtocolName'])
+    else:
+        base_filename = series['SeriesInstanceUID']
     return base_filename
 
 
-def main():
-    opt = parsing_data()
-    if opt.nrrd:
-        ext = 'nrrd'
-    elif opt.nifti:
-        ext = 'nii.gz'
-    else:
-        raise Exception('Either --nrrd or --nifti are required'
-        )
-    cases = natsorted([k for k in os.listdir(opt.path_dicom) if os.path.isdir(os.path.join(opt.path_dicom,k))])
-    number_imgs = {t:0 for t in TIMES}
-    print(f"Found {len(cases)} cases.")
-    for case in tqdm(cases):
+def list_folders(opt, index, folder=''):
+    """
+    List the subfolders of a folder of the DICOM tree, on disk or in the archive
+    @param opt: parsed arguments
+    @param index: index returned by build_index
+    @param folder: folder relative to the root of the tree
+    """
+    if not is_archive(opt.path_dicom):
+        path_folder = os.path.join(opt.path_dicom, folder)
+        return [k for k in os.listdir(path_folder) if os.path.isdir(os.path.join(path_folder, k))]
+    # Folders of an archive are only known from the paths of its members. Files at the root of the
+    # archive are indexed under '.', which is not a subfolder (e.g. a README next to the cases).
+    prefix = folder + '/' if folder else ''
+    return list({k[len(prefix):].split('/')[0] for k in index if k.startswith(prefix) and k not in [folder, '.']})
+
+
+def list_series(opt, ext):
+    """
+    List all the series to convert, one unit per (case, session, series)
+    @param opt: parsed arguments
+    @param ext: extension of the output files
+    @return: list of cases and list of conversion units
+    """
+    # Headers are read once for the whole tree, the conversion only uses the index
+    path_index = opt.index if opt.index is not None else os.path.join(opt.path_output, 'dicom_index.json')
+    index = build_index(opt.path_dicom, path_index, workers=opt.index_workers, archive_root=opt.archive_root)
+    archive = is_archive(opt.path_dicom)
+    
+    cases = natsorted(list_folders(opt, index))
+    units = []
+    for case in cases:
         path_case = os.path.join(opt.path_dicom, case)
         path_output_case = os.path.join(opt.path_output, case)
         
         for acquisition_time in TIMES:
-            sessions = [k for k in os.listdir(path_case) if acquisition_time in k]
+            sessions = [k for k in list_folders(opt, index, case) if acquisition_time in k]
             assert len(sessions)>0, f'Error with {case} - cannot found {acquisition_time} folder'
             assert len(sessions)==1, f'Error with {case} - found more than 1 {acquisition_time} folder'
             session = sessions[0]
             
             path_case_session = os.path.join(path_case, session)
             path_output_case_session = os.path.join(path_output_case, session)
-            os.makedirs(path_output_case_session, exist_ok=True)
             
-            dicom_folders = [k for k in os.listdir(path_case_session) \
-                            if os.path.isdir(os.path.join(path_case_session, k)) 
-                            and not 'seg' in k]
+            dicom_folders = natsorted([k for k in list_folders(opt, index, f'{case}/{session}') if not 'seg' in k])
             
-            # Iterates over all images files in the session
+            # Output filenames are resolved here so that no two workers write the same file
+            output_files = set()
             for dicom_folder in dicom_folders:
-                # Load DICOM as SITK Image
-                reader = sitk.ImageSeriesReader()
-                dicom_names = reader.GetGDCMSeriesFileNames(os.path.join(path_case_session, dicom_folder))
-                reader.SetFileNames(dicom_names)      
-                image = reader.Execute()
-                
-                # Output filename 
-                filename = get_filename(dicom_names[0])
-
-                # Conversion
-                if opt.nifti:
-                    sitk.WriteImage(image, os.path.join(path_output_case_session,f'{filename}.nii.gz'), 
-                                                        useCompression=True
-                    )
-                elif opt.nrrd: # Errors where found if using NRRD IO in SITK
-                    temp_file = os.path.join(path_output_case_session, 'temp.nii.gz')
-                    output_file = os.path.join(path_output_case_session,f'{filename}.nrrd')
-                    sitk.WriteImage(image, temp_file, useCompression=True)
-                    image = sitk.ReadImage(temp_file)
-                    sitk.WriteImage(image, output_file, useCompression=True)
-                    os.remove(temp_file)
-                number_imgs[acquisition_time]+=1
-            
+                path_series = os.path.join(path_case_session, dicom_folder)
+                series = series_in_folder(index, os.path.join(case, session, dicom_folder))
+                if len(series)==0:
+                    print(f'Warning: no DICOM series found in {path_series}')
+                    continue
+                elif len(series)>1:
+                    print(f'Warning: {len(series)} series found in {path_series}, only the first one is converted')
+                series = series[0]
+                filename = get_filename(series)
+                output_file = os.path.join(path_output_case_session, f'{filename}.{ext}')
+                duplicate = 1
+                while output_file in output_files:
+                    duplicate += 1
+                    output_file = os.path.join(path_output_case_session, f'{filename}_{duplicate}.{ext}')
+                if duplicate>1:
+                    print(f'Warning: {path_series} renamed to {os.path.basename(output_file)} to avoid overwriting')
+                output_files.add(output_file)
+                unit = {'case':case,
+                        'acquisition_time':acquisition_time,
+                        'path_series':path_series,
+                        'inputs':[os.path.join(path_series, k) for k in series['files']],
+                        'series':series,
+                        'output_file':output_file}
+                if archive:
+                    # Members are read from the archive, whose signature stands for them in the manifest
+                    unit['archive'] = (opt.path_dicom, opt.archive_root)
+                    unit['members'] = [f'{case}/{session}/{dicom_folder}/{k}' for k in series['files']]
+                    unit['inputs'] = [opt.path_dicom]
+                units.append(unit)
+    return cases, units
+
+
+def get_bytes_read(unit):
+    """
+    Size of the DICOM files of a unit, uncompressed for the members of an archive
+    """
+    if 'archive' in unit:
+        archive = open_archive(*unit['archive'])
+        return sum(archive.getsize(k) for k in unit['members'])
+    return sum(os.path.getsize(k) for k in unit['inputs'])
+
+
+def convert_series(unit, memory_budget=None, compression=COMPRESSION):
+    """
+    Convert a single DICOM series into NIfTI/NRRD
+    @param unit: conversion unit as returned by list_series
+    @param memory_budget: if set, the series is streamed by chunks of at most this many bytes
+    @param compression: dictionary with the codec ('none' or 'gzip'), level and number of threads
+    @return: the conversion unit, with the time of its stages in unit['stages']
+    """
+    if memory_budget is not None:
+        return convert_series_streaming(unit, memory_budget, compression)
+    # Times are returned with the unit, the run log is written by the main process
+    unit['stages'] = {}
+    # Load DICOM as SITK Image, the files are already sorted by the index
+    with measure(unit['stages'], 'read'):
+        if int(unit['series'].get('NumberOfFrames', 1)) > 1:
+            # A multi-frame file is read on its own (ImageSeriesReader adds a fourth axis). GDCM does not
+            # read the functional groups of all the multi-frame SOP classes (e.g. Enhanced US Volume),
+            # the geometry is taken from them as in the streaming path.
+            image = sitk.ReadImage(unit['inputs'][0])
+            first_dataset = pydicom.dcmread(unit['inputs'][0], stop_before_pixels=True)
+            origin, directions, spacing, _ = series_geometry(unit['series'], first_dataset)
+            image.SetOrigin(origin.tolist())
+            image.SetDirection(directions.T.flatten().tolist())
+            image.SetSpacing(spacing.tolist())
+        else:
+            reader = sitk.ImageSeriesReader()
+            reader.SetFileNames(unit['inputs'])
+            image = reader.Execute()
+    unit['stages']['read']['bytes_read'] = get_bytes_read(unit)
+    
+    output_file = unit['output_file']
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    # Conversion
+    with measure(unit['stages'], 'write'):
+        if output_file.endswith('.nrrd'):
+            write_nrrd(image, output_file, compression)
+        else:
+            write_image(image, output_file, compression)
+    unit['stages']['write']['bytes_written'] = os.path.getsize(output_file)
+    return unit
+
+
+def convert_series_streaming(unit, memory_budget, compression=COMPRESSION):
+    """
+    Convert a single DICOM series into NIfTI/NRRD by chunks of slices (or frames), so that
+    the memory used does not grow with the size of the volume
+    @param unit: conversion unit as returned by list_series
+    @param memory_budget: maximum size in bytes of the pixels held in memory
+    @param compression: dictionary with the codec ('none' or 'gzip'), level and number of threads
+    @return: the conversion unit, with the time of its stages in unit['stages']
+    """
+    unit['stages'] = {}
+    with measure(unit['stages'], 'convert_streaming'):
+        _convert_series_streaming(unit, memory_budget, compression)
+    unit['stages']['convert_streaming']['bytes_read'] = get_bytes_read(unit)
+    unit['stages']['convert_streaming']['bytes_written'] = os.path.getsize(unit['output_file'])
+    return unit
+
+
+def _convert_series_streaming(unit, memory_budget, compression):
+    with ExitStack() as stack:
+        if 'archive' in unit:
+            # Members are decompressed while their pixels are read, with the archive handle of this process
+            archive = open_archive(*unit['archive'])
+            files = [stack.enter_context(archive.open(k)) for k in unit['members']]
+        else:
+            files = unit['inputs']
+        _write_series_streaming(unit, files, memory_budget, compression)
+
+
+def _write_series_streaming(unit, files, memory_budget, compression):
+    first_dataset = pydicom.dcmread(files[0], stop_before_pixels=True)
+    if not isinstance(files[0], str):
+        files[0].seek(0)
+    origin, directions, spacing, number_slices = series_geometry(unit['series'], first_dataset)
+    
+    output_file = unit['output_file']
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    
+    # The voxel type is only known once the rescale is applied, the writer is opened on the first chunk
+    writer = None
+    try:
+        for chunk in iter_series_chunks(files, memory_budget):
+            if writer is None:
+                shape = (chunk.shape[2], chunk.shape[1], number_slices)
+                if output_file.endswith('.nrrd'):
+                    encoding = 'raw' if compression['codec']=='none' else 'gzip'
+                    writer = NrrdWriter(output_file, shape, chunk.dtype, origin, directions, spacing, encoding=encoding,
+                                        compresslevel=compression['level'], threads=compression['threads'])
+                else:
+                    writer = NiftiWriter(output_file, shape, chunk.dtype, origin, directions, spacing,
+                                         compresslevel=compression['level'], threads=compression['threads'])
+            writer.write(chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_image(image, output_file, compression=COMPRESSION):
+    """
+    Write an image with the requested compression
+    @param image: SITK image
+    @param output_file: path to the output NIfTI/NRRD file
+    @param compression: dictionary with the codec ('none' or 'gzip'), level and number of threads
+    """
+    if compression['codec']=='none':
+        sitk.WriteImage(image, output_file, useCompression=False)
+    elif compression['threads']<=1 and compression['level']==-1:
+        sitk.WriteImage(image, output_file, useCompression=True)
+    else:
+        # ITK compresses with a single thread and does not apply the level to all the formats:
+        # the image is written uncompressed in a private folder, then gzip compressed here
+        with tempfile.TemporaryDirectory() as temp_dir:
+            if output_file.endswith('.nrrd'):
+                temp_file = os.path.join(temp_dir, 'temp.nrrd')
+                sitk.WriteImage(image, temp_file, useCompression=False)
+                gzip_nrrd(temp_file, output_file, compresslevel=compression['level'], threads=compression['threads'])
+            else:
+                temp_file = os.path.join(temp_dir, 'temp.nii')
+                sitk.WriteImage(image, temp_file, useCompression=False)
+                with open(temp_file, 'rb') as f_in, open(output_file, 'wb') as f_out:
+                    with open_gzip(f_out, compresslevel=compression['level'], threads=compression['threads']) as f_gzip:
+                        shutil.copyfileobj(f_in, f_gzip, 1024*1024)
+
+
+def write_nrrd(image, output_file, compression=COMPRESSION):
+    """
+    Write an image as NRRD with the geometry normalised by the NIfTI IO
+    @param image: SITK image read from the DICOM series
+    @param output_file: path to the output NRRD file
+    @param compression: dictionary with the codec ('none' or 'gzip'), level and number of threads
+    """
+    # Errors where found if using NRRD IO in SITK directly: the NIfTI IO stores the
+    # geometry in float32 and re-orthonormalises the direction cosines, which the
+    # NRRD writer expects. The round-trip is kept for that but done uncompressed in a
+    # private folder, so it costs no gzip pass and series can be written concurrently.
+    # The folder is next to the output, on the same disk rather than in a small system /tmp.
+    with tempfile.TemporaryDirectory(prefix='.write_nrrd-', dir=os.path.dirname(os.path.abspath(output_file))) as temp_dir:
+        temp_file = os.path.join(temp_dir, 'temp.nii')
+        sitk.WriteImage(image, temp_file, useCompression=False)
+        image = sitk.ReadImage(temp_file)
+    write_image(image, output_file, compression)
+
+
+def main():
+    opt = parsing_data()
+    if opt.nrrd:
+        ext = 'nrrd'
+    elif opt.nifti:
+        ext = 'nii' if opt.compression=='none' else 'nii.gz'
+    else:
+        raise Exception('Either --nrrd or --nifti are required'
+        )
+    log = open_run_log(opt, opt.path_output, 'dicom_to_nifti')
+    with log.stage('index'):
+        cases, units = list_series(opt, ext)
+    number_imgs = {t:0 for t in TIMES}
+    print(f"Found {len(cases)} cases.")
+    
+    # Skip the series already converted by a previous run
+    manifest = open_manifest(opt, opt.path_output)
+    params = {'ext':ext}
+    compression = {'codec':opt.compression, 'level':opt.compression_level, 'threads':opt.compression_threads}
+    if compression['codec']!=COMPRESSION['codec'] or compression['level']!=COMPRESSION['level']:
+        params['compression'] = compression['codec']
+        params['compression_level'] = compression['level']
+    memory_budget = None
+    # The files of an archive are read with pydicom, SimpleITK only reads files on disk
+    if opt.streaming or is_archive(opt.path_dicom):
+        params['streaming'] = True
+        memory_budget = opt.memory_budget*1024*1024
+    todo = []
+    for unit in units:
+        unit['key'] = f"{ext}/{os.path.relpath(unit['path_series'], opt.path_dicom)}"
+        if opt.resume and manifest.is_up_to_date(unit['key'], unit['inputs'], params):
+            number_imgs[unit['acquisition_time']]+=1
+        else:
+            todo.append(unit)
+    if len(todo)<len(units):
+        print(f"Skipping {len(units)-len(todo)} series already converted.")
+    
+    def record(unit, error=None):
+        if error is None:
+            manifest.record(unit['key'], unit['inputs'], params, [unit['output_file']])
+            number_imgs[unit['acquisition_time']]+=1
+            for stage, measures in unit['stages'].items():
+                log.record_stage(stage, case=unit['case'], path=unit['path_series'], **measures)
+        else:
+            manifest.record(unit['key'], unit['inputs'], params, [unit['output_file']], status='failed', error=repr(error))
+            log.failure(unit['path_series'], error, case=unit['case'])
+    
+    if opt.workers>1:
+        with ProcessPoolExecutor(max_workers=opt.workers) as executor:
+            futures = {executor.submit(convert_series, unit, memory_budget, compression):unit for unit in todo}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                try:
+                    unit = future.result()
+                except Exception as e:
+                    record(futures[future], e)
+                else:
+                    record(unit)
+    else:
+        for unit in tqdm(todo):
+            try:
+                convert_series(unit, memory_budget, compression)
+            except Exception as e:
+                record(unit, e)
+            else:
+                record(unit)
     
     for t in TIMES:
         print(f"Number of {t} scans: {number_imgs[t]}")
+    log.close()
 
 if __name__ == '__main__':
     main()
-
-            
-            
-        
\ No newline at end of file
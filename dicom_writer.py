@@ -0,0 +1,41 @@
+import pydicom
+from pydicom.dataset import Dataset
+
+# Enhanced General Equipment (Type 1) of the files written in Python: the device is the writer
+# module, identified the way dcmqi identifies itself in the SEG files it writes
+MANUFACTURER = 'ReMIND'
+URL = 'https://github.com/ReubenDo/ReMIND'
+DEVICE_SERIAL_NUMBER = '0'
+
+
+def format_ds(value):
+    """
+    Round a float so that it fits in a DS value (16 characters)
+    """
+    return float(f'{value:.10g}')
+
+
+def code(value, scheme, meaning):
+    """
+    Item of a code sequence
+    @param value: CodeValue
+    @param scheme: CodingSchemeDesignator
+    @param meaning: CodeMeaning
+    """
+    item = Dataset()
+    item.CodeValue = value
+    item.CodingSchemeDesignator = scheme
+    item.CodeMeaning = meaning
+    return item
+
+
+def set_equipment(ds, writer):
+    """
+    Set the attributes of the Enhanced General Equipment module
+    @param ds: dataset being written
+    @param writer: name of the writer module, e.g. us_dicom.py
+    """
+    ds.Manufacturer = MANUFACTURER
+    ds.ManufacturerModelName = f'{writer} {URL}'
+    ds.DeviceSerialNumber = DEVICE_SERIAL_NUMBER
+    ds.SoftwareVersions = f'pydicom {pydicom.__version__}'
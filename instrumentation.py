@@ -0,0 +1,234 @@
+import os
+import sys
+import json
+import time
+import uuid
+import cProfile
+import threading
+import subprocess
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+
+
+@contextmanager
+def measure(stages, name):
+    """
+    Measure the wall and CPU time of a block, e.g. in a worker process without a RunLog
+    @param stages: dictionary filled with name -> {'wall', 'cpu'}
+    @param name: name of the stage
+    """
+    start, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        stages[name] = {'wall': time.perf_counter() - start, 'cpu': time.thread_time() - start_cpu}
+
+
+def log_stage(log, name, **fields):
+    """
+    Measure a stage with an optional RunLog
+    @param log: RunLog, or None to only run the block
+    @return: context manager yielding the fields of the stage
+    """
+    if log is None:
+        return nullcontext(fields)
+    return log.stage(name, **fields)
+
+
+def log_run(log, cmd, name, **fields):
+    """
+    Run an external tool with an optional RunLog
+    @param log: RunLog, or None to only run the tool
+    @return: return code
+    """
+    if log is None:
+        return subprocess.call(cmd)
+    return log.run(cmd, name, **fields)
+
+
+def wait_rusage(process):
+    """
+    Wait for a subprocess and get its resource usage
+    @param process: subprocess.Popen
+    @return: return code, dictionary with the CPU time and peak RSS (None where wait4 is not available)
+    """
+    if not hasattr(os, 'wait4'):
+        return process.wait(), None
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in bytes on macOS and kB elsewhere
+    max_rss = rusage.ru_maxrss / 1024 ** 2 if sys.platform == 'darwin' else rusage.ru_maxrss / 1024
+    return process.returncode, {'cpu': rusage.ru_utime + rusage.ru_stime, 'max_rss_mb': round(max_rss, 1)}
+
+
+class RunLog:
+    """
+    Structured log of a conversion run, stored as JSON lines.
+    Each stage (per case, per series, per external tool call) is one event with its wall and
+    CPU time and the bytes it read and wrote. A summary per stage and per case is written at the end.
+    Thread-safe, and several processes can append to the same file.
+    """
+
+    def __init__(self, path, script, profile=False):
+        """
+        @param path: path to the log file (appended if it exists)
+        @param script: name of the entry point, stored in every event
+        @param profile: capture a cProfile of the main thread and the tracemalloc allocations
+        """
+        self.path = path
+        self.script = script
+        self.run_id = uuid.uuid4().hex[:12]
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.cases = {}
+        self.failures = []
+        self.start = time.perf_counter()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.profiler = None
+        if profile:
+            tracemalloc.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.event('start', argv=sys.argv, pid=os.getpid())
+
+    def event(self, event, **fields):
+        """
+        Append an event to the log
+        @param event: type of the event
+        """
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'run': self.run_id, 'script': self.script,
+                  'event': event, **fields}
+        line = json.dumps(record, default=str) + '\n'
+        with self.lock:
+            # Opened in append mode for each event so that concurrent processes do not clobber each other
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    def record_stage(self, name, wall, cpu=None, status='ok', **fields):
+        """
+        Record a stage measured elsewhere (e.g. in a worker process)
+        @param name: name of the stage
+        @param wall: wall time in seconds
+        @param cpu: CPU time in seconds
+        @param status: 'ok' or 'failed'
+        @param fields: case, path, bytes_read, bytes_written, ...
+        """
+        with self.lock:
+            stage = self.stages.setdefault(name, {'count': 0, 'failed': 0, 'wall': 0., 'cpu': 0.,
+                                                  'bytes_read': 0, 'bytes_written': 0})
+            stage['count'] += 1
+            stage['failed'] += status != 'ok'
+            stage['wall'] += wall
+            stage['cpu'] += cpu or 0.
+            stage['bytes_read'] += fields.get('bytes_read') or 0
+            stage['bytes_written'] += fields.get('bytes_written') or 0
+            if 'case' in fields:
+                self.cases[fields['case']] = self.cases.get(fields['case'], 0.) + wall
+        self.event('stage', stage=name, status=status, wall=round(wall, 4),
+                   cpu=None if cpu is None else round(cpu, 4), **fields)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Measure the wall time and the CPU time of the calling thread of a stage. The yielded dictionary
+        can be filled with more fields (e.g. bytes_read, bytes_written). A failed stage is recorded
+        and the error raised.
+        @param name: name of the stage
+        @param fields: case, path, ...
+        """
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        status, error = 'ok', None
+        try:
+            yield fields
+        except Exception as e:
+            status, error = 'failed', repr(e)
+            raise
+        finally:
+            if error is not None:
+                fields['error'] = error
+            self.record_stage(name, time.perf_counter() - start, time.thread_time() - start_cpu, status, **fields)
+
+    def run(self, cmd, name, **fields):
+        """
+        Run an external tool, recording its wall time, CPU time and peak RSS
+        @param cmd: command line
+        @param name: name of the stage
+        @return: return code
+        """
+        start = time.perf_counter()
+        process = subprocess.Popen(cmd)
+        returncode, usage = wait_rusage(process)
+        fields.update(usage or {})
+        cpu = fields.pop('cpu', None)
+        self.record_stage(name, time.perf_counter() - start, cpu, 'ok' if returncode == 0 else 'failed',
+                          returncode=returncode, **fields)
+        return returncode
+
+    def failure(self, path, error, **fields):
+        """
+        Record a unit that failed to convert
+        @param path: input of the unit
+        @param error: exception or message
+        """
+        with self.lock:
+            self.failures.append((path, error))
+        self.event('failure', path=path, error=error if isinstance(error, str) else repr(error), **fields)
+
+    def close(self):
+        """
+        Write the summary of the run (and the profile if captured) and print it
+        """
+        summary = {'wall': round(time.perf_counter() - self.start, 2),
+                   'stages': {k: dict(v, wall=round(v['wall'], 2), cpu=round(v['cpu'], 2))
+                              for k, v in self.stages.items()},
+                   'slowest_cases': {k: round(v, 2) for k, v in sorted(self.cases.items(), key=lambda k: -k[1])[:10]},
+                   'failures': len(self.failures)}
+        if self.profiler is not None:
+            self.profiler.disable()
+            path_profile = os.path.splitext(self.path)[0] + f'-{self.run_id}.prof'
+            self.profiler.dump_stats(path_profile)
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            summary['profile'] = path_profile
+            summary['tracemalloc_peak_mb'] = round(peak / 1024 ** 2, 1)
+            summary['tracemalloc_top'] = [str(k) for k in snapshot.statistics('lineno')[:20]]
+        self.event('summary', **summary)
+
+        print(f"----------- Run {self.run_id}: {summary['wall']:.1f} s -------------")
+        print(f"{'stage':<20}{'count':>8}{'failed':>8}{'wall (s)':>12}{'cpu (s)':>12}{'read (MB)':>12}{'written (MB)':>14}")
+        for name, stage in self.stages.items():
+            print(f"{name:<20}{stage['count']:>8}{stage['failed']:>8}{stage['wall']:>12.1f}{stage['cpu']:>12.1f}"
+                  f"{stage['bytes_read'] / 1024 ** 2:>12.1f}{stage['bytes_written'] / 1024 ** 2:>14.1f}")
+        if self.cases:
+            print('Slowest cases: ' + ', '.join(f'{k} ({v:.1f} s)' for k, v in list(summary['slowest_cases'].items())[:5]))
+        if 'profile' in summary:
+            print(f"Profile written to {summary['profile']}, peak traced memory {summary['tracemalloc_peak_mb']} MB")
+        print(f'----------- {len(self.failures)} errors -------------')
+        for path, error in self.failures:
+            print(f'{path}: {error if isinstance(error, str) else repr(error)}')
+        print(f'Run log: {self.path}')
+
+
+def add_instrumentation_arguments(parser):
+    """
+    Add the run log options shared by the conversion scripts
+    """
+    parser.add_argument('--log',
+                        type=str,
+                        default=None,
+                        help='Path to the JSON lines log of the run (default: run_log.jsonl in the output folder)')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Capture a cProfile of the main process and its tracemalloc allocations')
+
+
+def open_run_log(opt, path_output, script):
+    """
+    Open the run log selected by the command line options
+    @param opt: parsed arguments including the run log options
+    @param path_output: output folder holding the default log
+    @param script: name of the entry point
+    """
+    path = opt.log if opt.log is not None else os.path.join(path_output, 'run_log.jsonl')
+    return RunLog(path, script, profile=opt.profile)
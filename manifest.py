@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+
+class Manifest:
+    """
+    Persistent record of the converted units, stored as JSON lines.
+    Each line describes one conversion attempt; the last line of a unit wins.
+    Used to skip units that are up to date when an interrupted run is resumed.
+    """
+
+    def __init__(self, path, hash_contents=False):
+        """
+        @param path: path to the manifest file (created if missing)
+        @param hash_contents: hash the content of the input files instead of only size and mtime
+        """
+        self.path = path
+        self.hash_contents = hash_contents
+        self.records = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of a crashed run can be truncated
+                        continue
+                    self.records[record['key']] = record
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def _signature(self, path):
+        stat = os.stat(path)
+        signature = [path, stat.st_size, stat.st_mtime_ns]
+        if self.hash_contents:
+            sha = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(block)
+            signature.append(sha.hexdigest())
+        return signature
+
+    def fingerprint(self, inputs, params):
+        """
+        Fingerprint of a unit from its input files and conversion parameters
+        @param inputs: list of input file paths
+        @param params: json-serialisable conversion parameters
+        """
+        content = {'inputs': [self._signature(k) for k in sorted(inputs)],
+                   'params': params}
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    def is_up_to_date(self, key, inputs, params):
+        """
+        Check if a unit was successfully converted with the same inputs and parameters
+        and if all its outputs still exist
+        """
+        record = self.records.get(key)
+        if record is None or record['status'] != 'ok':
+            return False
+        if not all(os.path.exists(k) for k in record['outputs']):
+            return False
+        return record['fingerprint'] == self.fingerprint(inputs, params)
+
+    def record(self, key, inputs, params, outputs, status='ok', error=None):
+        """
+        Append the result of a conversion to the manifest
+        @param key: unique identifier of the unit
+        @param inputs: list of input file paths
+        @param params: json-serialisable conversion parameters
+        @param outputs: list of output paths
+        @param status: 'ok' or 'failed'
+        @param error: error message if the conversion failed
+        """
+        record = {'key': key,
+                  'status': status,
+                  'fingerprint': self.fingerprint(inputs, params) if status == 'ok' else None,
+                  'params': params,
+                  'outputs': outputs,
+                  'error': error,
+                  'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self._append(record)
+
+    def get_state(self, key, default=None):
+        """
+        Get a value persisted across runs (e.g. a study instance UID)
+        """
+        record = self.records.get(f'state/{key}')
+        return default if record is None else record['value']
+
+    def set_state(self, key, value):
+        """
+        Persist a value across runs
+        """
+        self._append({'key': f'state/{key}', 'value': value})
+
+    def _append(self, record):
+        self.records[record['key']] = record
+        # Opened in append mode for each record so that concurrent processes do not clobber each other
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def replace_folder(path_source, path_target):
+    """
+    Move the output folder of a unit that was converted again in place of the folder of an earlier run.
+    The old folder is only deleted once the new one is in place.
+    @param path_source: folder just written
+    @param path_target: final folder, which may exist and hold the files of an earlier run
+    """
+    path_old = None
+    if os.path.exists(path_target):
+        path_old = tempfile.mkdtemp(prefix='.replaced-', dir=os.path.dirname(os.path.abspath(path_target)))
+        os.rename(path_target, os.path.join(path_old, os.path.basename(path_target)))
+    try:
+        os.rename(path_source, path_target)
+    except OSError:
+        if path_old is not None:
+            os.rename(os.path.join(path_old, os.path.basename(path_target)), path_target)
+            os.rmdir(path_old)
+        raise
+    if path_old is not None:
+        shutil.rmtree(path_old)
+
+
+def add_manifest_arguments(parser):
+    """
+    Add the manifest options shared by the conversion scripts
+    """
+    parser.add_argument('--manifest',
+                        type=str,
+                        default=None,
+                        help='Path to the manifest recording the converted units (default: manifest.jsonl in the output folder)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--resume',
+                       action='store_true',
+                       help='Skip units that are up to date in the manifest')
+    group.add_argument('--force',
+                       action='store_true',
+                       help='Convert every unit even if it is up to date in the manifest (default)')
+    parser.add_argument('--hash_contents',
+                        action='store_true',
+                        help='Compare the content of the input files instead of their size and mtime')
+
+
+def open_manifest(opt, path_output):
+    """
+    Open the manifest selected by the command line options
+    @param opt: parsed arguments including the manifest options
+    @param path_output: output folder holding the default manifest
+    """
+    path = opt.manifest if opt.manifest is not None else os.path.join(path_output, 'manifest.jsonl')
+    return Manifest(path, hash_contents=opt.hash_contents)
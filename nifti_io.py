@@ -0,0 +1,178 @@
+import gzip
+import struct
+import numpy as np
+from parallel_gzip import open_gzip
+
+NIFTI_HEADER = '<i10s18sihcB8h3f4h8f3fhBB2f2f2i80s24s2h3f3f12f16s4s'
+NIFTI_DATATYPES = {'u1': 2, 'i2': 4, 'i4': 8, 'f4': 16, 'f8': 64, 'i1': 256, 'u2': 512, 'u4': 768, 'i8': 1024, 'u8': 1280}
+VOX_OFFSET = 352
+
+
+def _quaternion(rotation):
+    # Same convention as nifti_mat44_to_quatern
+    qfac = 1.
+    rotation = rotation.copy()
+    if np.linalg.det(rotation) < 0:
+        qfac = -1.
+        rotation[:, 2] *= -1
+    a = rotation[0, 0] + rotation[1, 1] + rotation[2, 2] + 1
+    if a > 0.5:
+        a = 0.5 * np.sqrt(a)
+        b = 0.25 * (rotation[2, 1] - rotation[1, 2]) / a
+        c = 0.25 * (rotation[0, 2] - rotation[2, 0]) / a
+        d = 0.25 * (rotation[1, 0] - rotation[0, 1]) / a
+    else:
+        xd = 1 + rotation[0, 0] - (rotation[1, 1] + rotation[2, 2])
+        yd = 1 + rotation[1, 1] - (rotation[0, 0] + rotation[2, 2])
+        zd = 1 + rotation[2, 2] - (rotation[0, 0] + rotation[1, 1])
+        if xd > 1:
+            b = 0.5 * np.sqrt(xd)
+            c = 0.25 * (rotation[0, 1] + rotation[1, 0]) / b
+            d = 0.25 * (rotation[0, 2] + rotation[2, 0]) / b
+            a = 0.25 * (rotation[2, 1] - rotation[1, 2]) / b
+        elif yd > 1:
+            c = 0.5 * np.sqrt(yd)
+            b = 0.25 * (rotation[0, 1] + rotation[1, 0]) / c
+            d = 0.25 * (rotation[1, 2] + rotation[2, 1]) / c
+            a = 0.25 * (rotation[0, 2] - rotation[2, 0]) / c
+        else:
+            d = 0.5 * np.sqrt(zd)
+            b = 0.25 * (rotation[0, 2] + rotation[2, 0]) / d
+            c = 0.25 * (rotation[1, 2] + rotation[2, 1]) / d
+            a = 0.25 * (rotation[1, 0] - rotation[0, 1]) / d
+        if a < 0:
+            b, c, d = -b, -c, -d
+    return (b, c, d), qfac
+
+
+def nifti_header(shape, dtype, origin, directions, spacing):
+    """
+    Build a NIfTI-1 single file header
+    @param shape: size of the volume (columns, rows, slices)
+    @param dtype: numpy dtype of the voxels
+    @param origin: position of the first voxel in the DICOM patient (LPS) space
+    @param directions: one normalised row per axis, in the LPS space
+    @param spacing: spacing along each axis
+    @return: header bytes, including the empty extension flag
+    """
+    dtype = np.dtype(dtype)
+    # NIfTI is in the RAS space
+    flip = np.array([-1., -1., 1.])
+    rotation = (np.asarray(directions, dtype=float) * flip[None]).T
+    origin = np.asarray(origin, dtype=float) * flip
+    affine = rotation * np.asarray(spacing, dtype=float)[None]
+    (b, c, d), qfac = _quaternion(rotation)
+    dim = [3] + list(shape) + [1] * (7 - len(shape))
+    pixdim = [qfac] + list(spacing) + [0.] * (7 - len(spacing))
+    srows = [list(affine[k]) + [origin[k]] for k in range(3)]
+    header = struct.pack(NIFTI_HEADER,
+                         348, b'', b'', 0, 0, b'r', 0,
+                         *dim,
+                         0., 0., 0.,
+                         0, NIFTI_DATATYPES[dtype.str[1:]], 8 * dtype.itemsize, 0,
+                         *pixdim,
+                         float(VOX_OFFSET), 1., 0.,
+                         0, 0, 2,
+                         0., 0., 0., 0.,
+                         0, 0,
+                         b'', b'',
+                         1, 1,
+                         b, c, d,
+                         *origin,
+                         *srows[0], *srows[1], *srows[2],
+                         b'', b'n+1\0')
+    return header + b'\0' * 4
+
+
+def _rotation(b, c, d, qfac):
+    # Same convention as nifti_quatern_to_mat44
+    a = np.sqrt(max(0., 1. - (b * b + c * c + d * d)))
+    rotation = np.array([[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                         [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+                         [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b]])
+    rotation[:, 2] *= -1 if qfac < 0 else 1
+    return rotation
+
+
+def read_nifti_header(path_nifti):
+    """
+    Read the header of a NIfTI-1 single file (.nii or .nii.gz)
+    @param path_nifti: path to the NIfTI file
+    @return: dictionary with the shape (columns, rows, slices), dtype, byte offset of the voxels,
+             rescale slope/intercept and the geometry in the DICOM patient (LPS) space
+    """
+    opener = gzip.open if path_nifti.endswith('.gz') else open
+    with opener(path_nifti, 'rb') as f:
+        data = f.read(struct.calcsize(NIFTI_HEADER))
+    fields = struct.unpack(NIFTI_HEADER, data)
+    if fields[0] != 348 or fields[65][:3] != b'n+1':
+        raise ValueError(f'{path_nifti} is not a little endian NIfTI-1 single file')
+    dim, pixdim = fields[7:15], fields[22:30]
+    dtypes = {v: k for k, v in NIFTI_DATATYPES.items()}
+    if fields[19] not in dtypes:
+        raise ValueError(f'NIfTI datatype {fields[19]} is not supported: {path_nifti}')
+    shape = tuple(int(k) for k in dim[1:1 + dim[0]])
+    # Trailing singleton dimensions, e.g. of a single time point
+    while len(shape) > 3 and shape[-1] == 1:
+        shape = shape[:-1]
+    if fields[45] > 0:
+        # sform
+        affine = np.array(fields[52:64], dtype=float).reshape(3, 4)
+        spacing = np.linalg.norm(affine[:, :3], axis=0)
+        rotation, origin = affine[:, :3] / spacing[None], affine[:, 3]
+    else:
+        # qform
+        spacing = np.abs(np.array(pixdim[1:4], dtype=float))
+        rotation, origin = _rotation(*fields[46:49], pixdim[0]), np.array(fields[49:52], dtype=float)
+    # NIfTI is in the RAS space
+    flip = np.array([-1., -1., 1.])
+    return {'shape': shape,
+            'dtype': np.dtype('<' + dtypes[fields[19]]),
+            'offset': int(fields[30]),
+            'slope': fields[31],
+            'intercept': fields[32],
+            'origin': origin * flip,
+            'directions': (rotation * flip[:, None]).T,
+            'spacing': spacing}
+
+
+class NiftiWriter:
+    """
+    Write a NIfTI-1 volume slice by slice (.nii or .nii.gz), without holding the volume in memory
+    """
+
+    def __init__(self, path_nifti, shape, dtype, origin, directions, spacing, compresslevel=6, threads=1):
+        """
+        @param path_nifti: path to the output file, compressed if it ends with .gz
+        @param shape: size of the volume (columns, rows, slices)
+        @param dtype: numpy dtype of the voxels
+        @param origin: position of the first voxel in the DICOM patient (LPS) space
+        @param directions: one normalised row per axis, in the LPS space
+        @param spacing: spacing along each axis
+        @param compresslevel: gzip compression level
+        @param threads: number of threads compressing the output
+        """
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.raw = open(path_nifti, 'wb')
+        self.file = self.raw
+        if path_nifti.endswith('.gz'):
+            self.file = open_gzip(self.raw, compresslevel=compresslevel, threads=threads)
+        self.file.write(nifti_header(shape, self.dtype, origin, directions, spacing))
+
+    def write(self, slices):
+        """
+        Append slices to the volume
+        @param slices: array (slices, rows, columns)
+        """
+        self.file.write(np.ascontiguousarray(slices, dtype=self.dtype).tobytes())
+
+    def close(self):
+        if self.file is not self.raw:
+            self.file.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,200 @@
+import re
+import gzip
+import shutil
+import numpy as np
+from parallel_gzip import open_gzip
+
+NRRD_TYPES = {'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+              'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+              'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+              'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+              'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+              'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+              'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+              'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+              'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+              'float': 'f4', 'double': 'f8'}
+
+SPACES_RAS = ['right-anterior-superior', 'RAS']
+
+
+def _parse_vector(value):
+    if value.strip() == 'none':
+        return None
+    return [float(k) for k in value.strip().strip('()').split(',')]
+
+
+def read_header(path_nrrd):
+    """
+    Read the header of an attached NRRD file
+    @param path_nrrd: path to the NRRD file
+    @return: dictionary of the fields and byte offset of the data
+    """
+    header = {}
+    with open(path_nrrd, 'rb') as f:
+        magic = f.readline().decode('ascii').strip()
+        if not magic.startswith('NRRD'):
+            raise ValueError(f'{path_nrrd} is not a NRRD file')
+        for line in f:
+            line = line.decode('latin-1').rstrip('\r\n')
+            if line == '':
+                break
+            if line.startswith('#') or ':=' in line:
+                # Comments and key/value pairs are not needed
+                continue
+            field, value = line.split(':', 1)
+            header[field.strip()] = value.strip()
+        offset = f.tell()
+
+    if 'data file' in header or 'datafile' in header:
+        raise ValueError(f'Detached NRRD files are not supported: {path_nrrd}')
+    header['type'] = np.dtype(NRRD_TYPES[header['type']])
+    if header['type'].itemsize > 1:
+        header['type'] = header['type'].newbyteorder('<' if header.get('endian', 'little') == 'little' else '>')
+    header['sizes'] = [int(k) for k in header['sizes'].split()]
+    header['encoding'] = 'gzip' if header['encoding'] == 'gz' else header['encoding']
+    if 'space directions' in header:
+        header['space directions'] = [_parse_vector(k) for k in re.findall(r'none|\([^)]*\)', header['space directions'])]
+    if 'space origin' in header:
+        header['space origin'] = _parse_vector(header['space origin'])
+    return header, offset
+
+
+def get_geometry(header):
+    """
+    Geometry of a 3D NRRD in the DICOM patient (LPS) space
+    @param header: header returned by read_header
+    @return: origin, directions (one normalised row per axis) and spacing
+    """
+    directions = np.array([k for k in header['space directions'] if k is not None], dtype=float)
+    origin = np.array(header.get('space origin', [0., 0., 0.]), dtype=float)
+    if header.get('space') in SPACES_RAS:
+        directions[:, :2] *= -1
+        origin[:2] *= -1
+    spacing = np.linalg.norm(directions, axis=1)
+    return origin, directions / spacing[:, None], spacing
+
+
+def iter_frames(path_nrrd, header=None, offset=None):
+    """
+    Iterate over the frames (slices along the slowest axis) of a NRRD file without
+    loading the volume: raw payloads are memory-mapped, gzip payloads are decompressed
+    one frame at a time.
+    @param path_nrrd: path to the NRRD file
+    @return: generator of 2D arrays (rows, columns)
+    """
+    if header is None:
+        header, offset = read_header(path_nrrd)
+    dtype = header['type']
+    shape = header['sizes'][::-1]
+    frame_shape = shape[1:]
+    frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+    if header['encoding'] == 'raw':
+        volume = np.memmap(path_nrrd, dtype=dtype, mode='r', offset=offset, shape=tuple(shape))
+        for frame in volume:
+            yield frame
+    elif header['encoding'] == 'gzip':
+        with open(path_nrrd, 'rb') as f:
+            f.seek(offset)
+            with gzip.GzipFile(fileobj=f, mode='rb') as payload:
+                for _ in range(shape[0]):
+                    data = payload.read(frame_bytes)
+                    if len(data) != frame_bytes:
+                        raise ValueError(f'Truncated NRRD payload in {path_nrrd}')
+                    yield np.frombuffer(data, dtype=dtype).reshape(frame_shape)
+    else:
+        raise ValueError(f'NRRD encoding {header["encoding"]} is not supported: {path_nrrd}')
+
+
+def read_volume(path_nrrd, header=None, offset=None):
+    """
+    Read the whole volume of a NRRD file, memory-mapped if the payload is raw
+    @param path_nrrd: path to the NRRD file
+    @return: array with the axes in reverse order of the NRRD sizes (frames, rows, columns)
+    """
+    if header is None:
+        header, offset = read_header(path_nrrd)
+    shape = tuple(header['sizes'][::-1])
+    if header['encoding'] == 'raw':
+        return np.memmap(path_nrrd, dtype=header['type'], mode='r', offset=offset, shape=shape)
+    elif header['encoding'] == 'gzip':
+        with open(path_nrrd, 'rb') as f:
+            f.seek(offset)
+            with gzip.GzipFile(fileobj=f, mode='rb') as payload:
+                return np.frombuffer(payload.read(), dtype=header['type']).reshape(shape)
+    raise ValueError(f'NRRD encoding {header["encoding"]} is not supported: {path_nrrd}')
+
+
+def gzip_nrrd(path_raw, path_nrrd, compresslevel=6, threads=1):
+    """
+    Copy a raw encoded NRRD file into a gzip encoded one, without loading the volume
+    @param path_raw: path to the input NRRD file with a raw payload
+    @param path_nrrd: path to the output NRRD file
+    @param compresslevel: gzip compression level
+    @param threads: number of threads compressing the payload
+    """
+    header, offset = read_header(path_raw)
+    assert header['encoding'] == 'raw', f'{path_raw} is not a raw NRRD file'
+    with open(path_raw, 'rb') as f_in, open(path_nrrd, 'wb') as f_out:
+        lines = f_in.read(offset).split(b'\n')
+        f_out.write(b'\n'.join(b'encoding: gzip' if k.startswith(b'encoding:') else k for k in lines))
+        with open_gzip(f_out, compresslevel=compresslevel, threads=threads) as payload:
+            shutil.copyfileobj(f_in, payload, 1024 * 1024)
+
+
+class NrrdWriter:
+    """
+    Write a 3D NRRD volume slice by slice (raw or gzip encoding), without holding the volume in memory
+    """
+
+    def __init__(self, path_nrrd, shape, dtype, origin, directions, spacing, encoding='gzip', compresslevel=6, threads=1):
+        """
+        @param path_nrrd: path to the output file
+        @param shape: size of the volume (columns, rows, slices)
+        @param dtype: numpy dtype of the voxels
+        @param origin: position of the first voxel in the DICOM patient (LPS) space
+        @param directions: one normalised row per axis, in the LPS space
+        @param spacing: spacing along each axis
+        @param encoding: 'gzip' or 'raw'
+        @param compresslevel: gzip compression level
+        @param threads: number of threads compressing the payload
+        """
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        type_names = {v: k for k, v in NRRD_TYPES.items() if ' ' not in k and not k.endswith('_t')}
+        directions = np.asarray(directions, dtype=float) * np.asarray(spacing, dtype=float)[:, None]
+        vector = lambda v: '(' + ','.join(f'{k:.17g}' for k in v) + ')'
+        header = ['NRRD0004',
+                  f'type: {type_names[self.dtype.str[1:]]}',
+                  'dimension: 3',
+                  'space: left-posterior-superior',
+                  f'sizes: {" ".join(str(k) for k in shape)}',
+                  f'space directions: {" ".join(vector(k) for k in directions)}',
+                  'kinds: domain domain domain',
+                  'endian: little',
+                  f'encoding: {encoding}',
+                  f'space origin: {vector(origin)}']
+        self.file = open(path_nrrd, 'wb')
+        self.file.write(('\n'.join(header) + '\n\n').encode('ascii'))
+        self.payload = self.file
+        if encoding == 'gzip':
+            self.payload = open_gzip(self.file, compresslevel=compresslevel, threads=threads)
+        elif encoding != 'raw':
+            raise ValueError(f'NRRD encoding {encoding} is not supported')
+
+    def write(self, slices):
+        """
+        Append slices to the volume
+        @param slices: array (slices, rows, columns)
+        """
+        self.payload.write(np.ascontiguousarray(slices, dtype=self.dtype).tobytes())
+
+    def close(self):
+        if self.payload is not self.file:
+            self.payload.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
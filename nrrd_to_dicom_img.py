@@ -1,5 +1,7 @@
 import os
-import subprocess
+import sys
+import shutil
+import uuid
 import slicer
 import argparse
 import DICOMScalarVolumePlugin
@@ -16,21 +18,21 @@ except:
     slicer.util.pip_install('tqdm')
     from tqdm import tqdm
 
-import numpy as np
-
 try:
     from natsort import natsorted
 except:
     slicer.util.pip_install('natsort')
     from natsort import natsorted
 
-try:
-    import pydicom
-except:
-    slicer.util.pip_install('pydicom')
-    import pydicom
-
-errors  = []
+# Slicer does not add the folder of the script to the path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from manifest import add_manifest_arguments, open_manifest, replace_folder
+from instrumentation import add_instrumentation_arguments, open_run_log, log_stage
+from dicom_patch import patch_file, patch_files
+from pixelmed_pool import PixelMedPool, download_pixelmed, nrrd_to_dicom_command
+from orchestrator import Scheduler, add_scheduler_arguments
+from us_dicom import write_us_dicom
+from concurrent.futures import ThreadPoolExecutor
 
 def parsing_data():
     parser = argparse.ArgumentParser(
@@ -43,6 +45,38 @@ def parsing_data():
                         type=str,
                         default='./dicom_folder',
                         help='Path to the output DICOM dataset')
+    parser.add_argument('--corr',
+                        type=str,
+                        default='corr.csv',
+                        help='Path to the output csv with the StudyInstanceUIDs of each case')
+    parser.add_argument('--shard',
+                        type=int,
+                        default=0,
+                        help='Index of the subset of cases converted by this process')
+    parser.add_argument('--num_shards',
+                        type=int,
+                        default=1,
+                        help='Number of subsets the cases are split into (see run_slicer_shards.py)')
+    parser.add_argument('--cases',
+                        type=str,
+                        default=None,
+                        help='Comma-separated cases to convert (default: all the cases, see pipeline.py)')
+    parser.add_argument('--us_engine',
+                        type=str,
+                        default='pixelmed',
+                        choices=['pixelmed', 'native'],
+                        help='Writer of the multi-frame US DICOM: PixelMed (Java) or native Python')
+    parser.add_argument('--us_workers',
+                        type=int,
+                        default=0,
+                        help='Number of US volumes converted in parallel, with long-lived JVMs for PixelMed (0: one JVM per volume)')
+    parser.add_argument('--java_jobs',
+                        type=int,
+                        default=1,
+                        help='Number of PixelMed JVMs running at the same time when a JVM is started per volume')
+    add_scheduler_arguments(parser)
+    add_manifest_arguments(parser)
+    add_instrumentation_arguments(parser)
     opt = parser.parse_args()
 
     return opt
@@ -50,43 +84,38 @@ def parsing_data():
 
 DATE = '19990101'
 
-def download_pixelmed():
-    from urllib.request import urlopen
-    url = "http://www.dclunie.com/pixelmed/software/20221004_current/pixelmed.jar"
-    data = urlopen(url).read()
-    with open("pixelmed.jar", 'wb') as f:
-        f.write(data)
+def get_case(path_nrrd):
+    """
+    Case folder of a NRRD file (case/session/file.nrrd), used to group the times of the run log
+    """
+    return path_nrrd.split("/")[-3]
 
 # based on https://discourse.slicer.org/t/exporting-volumetric-ultrasound-to-dicom/22265/25?u=koeglfryderyk
 def convert_nrrd_to_dicom_pure(path_nrrd, 
                                path_dicom,
+                               pool,
                                patient_name='Patient Name',
                                patient_id='Patient ID',
                                study_id='Study ID', 
                                series_number='1', 
-                               instance_number='1'):
+                               instance_number='1',
+                               log=None):
     """
     Execute the conversion of a nrrd file to a dicom file with David's tool
     @param path_nrrd: path to the input nrrd file
     @param path_dicom: path to the output dicom file
+    @param pool: PixelMedPool of running JVMs
     @param patient_name: Name of the patient
     @param patient_id: id of the patient
     @param study_id: id of the study
     @param series_number: number of the series (e.g. 1 for predura US)
     @param instance_number: instance number, often same as series number
+    @param log: RunLog recording the conversion time
     """
-
-    # create the command
-    path_jar = 'pixelmed.jar'
-    if not os.path.isfile(path_jar):
-        download_pixelmed()
-    
-    cmd = ['java', '-cp', path_jar, '-Djava.awt.headless=true', 'com.pixelmed.convert.NRRDToDicom',
-           path_nrrd, path_dicom,
-           patient_name, patient_id, study_id, series_number, instance_number]
-
-    # execute it
-    subprocess.call(cmd)
+    args = [path_nrrd, path_dicom,
+            patient_name, patient_id, study_id, series_number, instance_number]
+    with log_stage(log, 'pixelmed_pool', case=get_case(path_nrrd), path=path_nrrd):
+        pool.convert(args)
 
 
 def add_info_to_dicom(path_dicom, study_instance_uid=None, study_description=None, series_description=None ,modality=None):
@@ -97,48 +126,39 @@ def add_info_to_dicom(path_dicom, study_instance_uid=None, study_description=Non
     @param study_description: new study description of the dicom file so that it appears in 3D Slicer
     @param series_description: new series description of the dicom file so that it appears in 3D Slicer
     @param modality: new modality of the dicom file
-    @return:
     """
-
-    file = pydicom.dcmread(path_dicom)
+    values = {'StudyDate':DATE}
 
     if study_instance_uid is not None:
-        file.StudyInstanceUID = study_instance_uid
+        values['StudyInstanceUID'] = study_instance_uid
 
     if study_description is not None:
-        file.StudyDescription = study_description
+        values['StudyDescription'] = study_description
 
     if series_description is not None:
-        file.SeriesDescription = series_description
+        values['SeriesDescription'] = series_description
 
     if modality is not None:
-        file.Modality = modality
-        
-    file.StudyDate = DATE
-        
-    pydicom.dcmwrite(path_dicom, file)
+        values['Modality'] = modality
+    
+    # The multi-frame pixel data is copied through without being decoded
+    patch_file(path_dicom, values)
 
-def convert_dicom(path_nrrd, path_output, series_number, study_instanceid):
+def get_series_info(path_nrrd, series_number):
     """
-    Convert a nrrd file to a dicom file with 3D Slicer
+    Get the DICOM naming information of a NRRD file from its path
     @param path_nrrd: path to the NRRD file
-    @param path_output: path to the root DICOM folder
-    @param series_number: number of the series during DICOM conversion (e.g. 1 for iUS pre-dura)
-    @param study_instanceid: id of the study
+    @param series_number: number of the series during DICOM conversion (replaced for US)
+    @return: dictionary with patient_id, patient_name, study_id, series_description, series_number and modality
     """
-    
     patient_id = path_nrrd.split("/")[-3][4:]
     patient_name = 'CASE^'+patient_id
     study_id = path_nrrd.split("/")[-2].split("-")[0]
-    
 
     series_description = path_nrrd.replace('-r.n','.n').split('-')[-1].replace('.nrrd','')
 
-    study_instance_uid = '1' if "Preop" in path_nrrd else '2'
-    study_instance_uid += '.' + patient_id
     modality = "MR" if "MR" in path_nrrd else "US"
-    # modality = "MR"
-
+    
     if "US" in path_nrrd:
         if 'pre_dura' in path_nrrd:
             series_number = '1'
@@ -149,164 +169,369 @@ def convert_dicom(path_nrrd, path_output, series_number, study_instanceid):
         else:
             raise Exception(f'US without being in (pre_dura, post_dura, pre_imri) {path_nrrd}')
         series_description= f'US_{series_description}'
+    return {'patient_id':patient_id,
+            'patient_name':patient_name,
+            'study_id':study_id,
+            'series_description':series_description,
+            'series_number':series_number,
+            'modality':modality}
 
-    volumeNode = slicer.util.loadVolume(path_nrrd)
-    # Create patient and study and put the volume under the study
+
+def fix_mr_tags(path_final):
+    """
+    Fix the MR attributes of the files exported by 3D Slicer
+    @param path_final: path to the exported DICOM series folder
+    @return: list of (path, error) for the files that could not be fixed
+    """
+    dcms = [os.path.join(path_final, k) for k in os.listdir(path_final) if 'dcm' in k]
+    values = {'ScanningSequence':'RM',
+              'SequenceVariant':'NONE',
+              'MRAcquisitionType':'',
+              'ScanOptions':'',
+              'RepetitionTime':'',
+              'EchoTime':'',
+              'EchoTrainLength':'',
+              'Laterality':'',
+              'DeidentificationMethod':'PyDeface-NiftyReg'}
+    return patch_files(dcms, values, delete=['RescaleType'])
+
+
+def convert_dicom(paths_nrrd, path_output, series_numbers, study_instanceid, log=None):
+    """
+    Convert the nrrd files of a study to dicom files with 3D Slicer.
+    All the volumes are put under one study of the hierarchy and exported in one call.
+    @param paths_nrrd: paths to the NRRD files of the study
+    @param path_output: path to the root DICOM folder
+    @param series_numbers: numbers of the series during DICOM conversion
+    @param study_instanceid: id of the study
+    @param log: RunLog recording the time of the load, export and patch stages
+    @return: dictionary path_nrrd -> (list of the output DICOM series folders, list of (path, error))
+    """
     shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-    # set IDs. Note: these IDs are not specifying DICOM tags, but only the names that appear in the hierarchy tree
-    patientItemID = shNode.CreateSubjectItem(shNode.GetSceneItemID(), patient_id)
-    studyItemID = shNode.CreateStudyItem(patientItemID, study_id)
-    volumeShItemID = shNode.GetItemByDataNode(volumeNode)
-    shNode.SetItemParent(volumeShItemID, studyItemID)
     exporter = DICOMScalarVolumePlugin.DICOMScalarVolumePluginClass()
-    exportables = exporter.examineForExport(volumeShItemID)
+    studyItemIDs = {}
+    exportables = []
     renames = []
-    for exp in exportables:
-        # set output folder
-        exp.directory = os.path.join(path_output,f'{patient_id}-{patient_name}', f'{DATE}-{study_id}')
-        # here we set DICOM PatientID and StudyID tags
-        exp.setTag('PatientID', patient_id)
-        exp.setTag('StudyID', study_id)
-        exp.setTag('Modality', modality)
-        exp.setTag('StudyDescription', study_id)
-        exp.setTag('SeriesDescription', series_description)
-        exp.setTag('SeriesNumber', series_number)
-        exp.setTag('PatientName', patient_name)
-        exp.setTag('StudyDate', DATE)
-        exp.setTag('StudyInstanceUID', study_instanceid)
-        renames.append((f'ScalarVolume_{exp.subjectHierarchyItemID}', f'{series_number}-{series_description}'))
-
-    exporter.export(exportables)
-    slicer.mrmlScene.RemoveNode(volumeNode)
+    for path_nrrd, series_number in zip(paths_nrrd, series_numbers):
+        info = get_series_info(path_nrrd, series_number)
+        patient_id, patient_name, study_id = info['patient_id'], info['patient_name'], info['study_id']
+        path_study = os.path.join(path_output,f'{patient_id}-{patient_name}', f'{DATE}-{study_id}')
+
+        with log_stage(log, 'slicer_load', case=get_case(path_nrrd), path=path_nrrd, bytes_read=os.path.getsize(path_nrrd)):
+            volumeNode = slicer.util.loadVolume(path_nrrd)
+        # Create patient and study once and put the volumes under the study
+        # set IDs. Note: these IDs are not specifying DICOM tags, but only the names that appear in the hierarchy tree
+        if (patient_id, study_id) not in studyItemIDs:
+            patientItemID = shNode.CreateSubjectItem(shNode.GetSceneItemID(), patient_id)
+            studyItemIDs[(patient_id, study_id)] = shNode.CreateStudyItem(patientItemID, study_id)
+        volumeShItemID = shNode.GetItemByDataNode(volumeNode)
+        shNode.SetItemParent(volumeShItemID, studyItemIDs[(patient_id, study_id)])
+        for exp in exporter.examineForExport(volumeShItemID):
+            # set output folder
+            exp.directory = path_study
+            # here we set DICOM PatientID and StudyID tags
+            exp.setTag('PatientID', patient_id)
+            exp.setTag('StudyID', study_id)
+            exp.setTag('Modality', info['modality'])
+            exp.setTag('StudyDescription', study_id)
+            exp.setTag('SeriesDescription', info['series_description'])
+            exp.setTag('SeriesNumber', info['series_number'])
+            exp.setTag('PatientName', patient_name)
+            exp.setTag('StudyDate', DATE)
+            exp.setTag('StudyInstanceUID', study_instanceid)
+            exportables.append(exp)
+            renames.append((path_nrrd, path_study,
+                            f'ScalarVolume_{exp.subjectHierarchyItemID}', 
+                            f'{info["series_number"]}-{info["series_description"]}'))
+
+    # Slicer exports into ScalarVolume_<item> folders, a folder of an interrupted run must not be mixed in
+    for _, path_study, old, _ in renames:
+        shutil.rmtree(os.path.join(path_study, old), ignore_errors=True)
+    with log_stage(log, 'slicer_export', case=get_case(paths_nrrd[0]), volumes=len(exportables)):
+        exporter.export(exportables)
     slicer.mrmlScene.Clear(0)
     
-    for old,new in renames: 
-        path_final = os.path.join(path_output,f'{patient_id}-{patient_name}', f'{DATE}-{study_id}', new)
-        os.rename(
-            os.path.join(path_output,f'{patient_id}-{patient_name}', f'{DATE}-{study_id}', old),
-            path_final)
-    
-        dcms = [os.path.join(path_final, k) for k in os.listdir(path_final) if 'dcm' in k]
-        try:
-          for dcm in dcms:
-              file = pydicom.dcmread(dcm, force=True)
-              file.ScanningSequence = 'RM'
-              file.SequenceVariant = 'NONE'
-              file.MRAcquisitionType = ''
-              file.ScanOptions = ''
-              file.RepetitionTime = ''
-              file.EchoTime = ''
-              file.EchoTrainLength = ''
-              file.Laterality = ''
-              file.DeidentificationMethod = 'PyDeface-NiftyReg'
-              obs = file.RescaleType
-              del obs
-              pydicom.dcmwrite(dcm, file)
-        except Exception as e:
-          errors.append((e,path_final))
+    results = {k:([], []) for k in paths_nrrd}
+    for path_nrrd, path_study, old, new in renames: 
+        path_final = os.path.join(path_study, new)
+        # The series folder of an earlier run is replaced when a stale or failed unit is converted again
+        replace_folder(os.path.join(path_study, old), path_final)
+        outputs, failures = results[path_nrrd]
+        outputs.append(path_final)
+        with log_stage(log, 'patch', case=get_case(path_nrrd), path=path_final):
+            failures += fix_mr_tags(path_final)
+    return results
       
 
-def convert_dicom_clunie(path_nrrd, path_output, series_number, study_instanceid):
+def get_us_output(path_nrrd, path_output, series_number):
+    """
+    Series information and output file of a US volume, whose folder is created
+    @param path_nrrd: path to the NRRD file
+    @param path_output: path to the root DICOM folder
+    @param series_number: number of the series during DICOM conversion (e.g. 1 for iUS pre-dura)
+    @return: series information from get_series_info, path to the output DICOM file
+    """
+    info = get_series_info(path_nrrd, series_number)
+    path_dicom = os.path.join(path_output, f"{info['patient_id']}-{info['patient_name']}", f"{DATE}-{info['study_id']}",
+                              f"{info['series_number']}-{info['series_description']}")
+    os.makedirs(path_dicom, exist_ok=True)
+    return info, os.path.join(path_dicom, f"{info['series_description']}.dcm")
+
+
+def convert_dicom_clunie(path_nrrd, path_output, series_number, study_instanceid, pool=None, engine='pixelmed', log=None):
     """
     Convert a nrrd file to a dicom file with David's tool
     @param path_nrrd: path to the NRRD file
     @param path_output: path to the root DICOM folder
     @param series_number: number of the series during DICOM conversion (e.g. 1 for iUS pre-dura)
     @param study_instanceid: id of the study
+    @param pool: PixelMedPool of running JVMs, for the pixelmed engine
+    @param engine: 'pixelmed' to convert with David's tool, 'native' to write the file directly in Python
+    @param log: RunLog recording the time of the conversion and patch stages
+    @return: list with the output DICOM file
     """
     # Get information
-    patient_id = path_nrrd.split("/")[-3][4:]
-    patient_name = 'CASE^'+patient_id
-    study_id = path_nrrd.split("/")[-2].split("-")[0]
+    info, path_dicom = get_us_output(path_nrrd, path_output, series_number)
+    patient_id, patient_name, study_id = info['patient_id'], info['patient_name'], info['study_id']
+    series_number, series_description = info['series_number'], info['series_description']
+
+    if engine=='native':
+        # all the info is written in one pass
+        with log_stage(log, 'us_native_write', case=get_case(path_nrrd), path=path_nrrd,
+                       bytes_read=os.path.getsize(path_nrrd)) as stage:
+            write_us_dicom(path_nrrd, path_dicom,
+                           patient_name=patient_name, patient_id=patient_id,
+                           study_id=study_id, series_number=series_number, instance_number=series_number,
+                           study_instance_uid=study_instanceid, study_description=study_id,
+                           series_description=series_description, modality=info['modality'], study_date=DATE)
+            stage['bytes_written'] = os.path.getsize(path_dicom)
+        return [path_dicom]
 
-    series_description = path_nrrd.replace('-r.n','.n').split('-')[-1].replace('.nrrd','')
+    # first do the standard conversion
+    convert_nrrd_to_dicom_pure(path_nrrd, path_dicom, pool,
+                               patient_name=patient_name, patient_id=patient_id,
+                               study_id=study_id, series_number=series_number, instance_number=series_number,
+                               log=log)
 
-    study_instance_uid = '1' if "Preop" in path_nrrd else '2'
-    study_instance_uid += '.' + patient_id
-    modality = "MR" if "MR" in path_nrrd else "US"
-    
-    if "US" in path_nrrd:
-        if 'pre_dura' in path_nrrd:
-            series_number = '1'
-        elif 'post_dura' in path_nrrd:
-            series_number = '2'
-        elif 'pre_imri' in path_nrrd:
-            series_number = '3'
+    # then add the missing info
+    with log_stage(log, 'patch', case=get_case(path_nrrd), path=path_dicom):
+        add_info_to_dicom(path_dicom, study_instance_uid=study_instanceid, study_description=study_id,
+                          series_description=series_description, modality=info['modality'])
+    return [path_dicom]
+
+
+def record_results(manifest, units, results, log=None):
+    """
+    Record the conversion results of units in the manifest (and the failures in the run log)
+    @param manifest: manifest of the converted units
+    @param units: list of (path_nrrd, key, params)
+    @param results: dictionary path_nrrd -> (outputs, list of (path, error))
+    @param log: RunLog of the run
+    @return: list of (path, error) for the files that failed
+    """
+    all_failures = []
+    for path_nrrd, key, params in units:
+        outputs, failures = results[path_nrrd]
+        if len(failures)==0:
+            manifest.record(key, [path_nrrd], params, outputs)
         else:
-            raise Exception(f'US without being in (pre_dura, post_dura, pre_imri) {path_nrrd}')
-        series_description= f'US_{series_description}'
+            all_failures += failures
+            if log is not None:
+                for path, e in failures:
+                    log.failure(path, e, case=get_case(path_nrrd))
+            manifest.record(key, [path_nrrd], params, outputs, status='failed', 
+                            error='; '.join(f'{path}: {e!r}' for path, e in failures))
+    return all_failures
+
+
+def convert_us(manifest, opt, unit, study_instanceid, pool=None, log=None):
+    """
+    Convert a US NRRD file and record the result
+    @return: list of (path, error) for the files that failed
+    """
+    path_nrrd, _, params = unit
+    try:
+        results = {path_nrrd:(convert_dicom_clunie(
+            path_nrrd=path_nrrd,
+            path_output=opt.path_dicom,
+            series_number=params['series_number'],
+            study_instanceid=study_instanceid,
+            pool=pool,
+            engine=opt.us_engine,
+            log=log), [])}
+    except Exception as e:
+        results = {path_nrrd:([], [(path_nrrd, e)])}
+    return record_results(manifest, [unit], results, log)
+
+
+def submit_us(scheduler, manifest, opt, unit, study_instanceid, log=None):
+    """
+    Add the PixelMed conversion of a US NRRD file to the scheduler, patched and recorded once the JVM exited
+    @param scheduler: Scheduler running the JVMs
+    @return: future of the job
+    """
+    path_nrrd, key, params = unit
+    info, path_dicom = get_us_output(path_nrrd, opt.path_dicom, params['series_number'])
+    series_number = info['series_number']
+    args = [path_nrrd, path_dicom, info['patient_name'], info['patient_id'], info['study_id'], series_number, series_number]
     
-    path_dicom = os.path.join(path_output,f'{patient_id}-{patient_name}', f'{DATE}-{study_id}', f'{series_number}-{series_description}')
-    os.makedirs(path_dicom, exist_ok=True)
-    path_dicom = os.path.join(path_dicom, f'{series_description}.dcm')
+    def finish(result):
+        try:
+            if result['status']!='ok':
+                raise RuntimeError(f"NRRDToDicom {result['status']}: {result['error']}")
+            # NRRDToDicom can exit normally after an error, check the output is there
+            if not os.path.isfile(path_dicom):
+                raise RuntimeError(f'NRRDToDicom did not write {path_dicom}')
+            with log_stage(log, 'patch', case=get_case(path_nrrd), path=path_dicom):
+                add_info_to_dicom(path_dicom, study_instance_uid=study_instanceid, study_description=info['study_id'],
+                                  series_description=info['series_description'], modality=info['modality'])
+            results = {path_nrrd:([path_dicom], [])}
+        except Exception as e:
+            results = {path_nrrd:([], [(path_nrrd, e)])}
+        record_results(manifest, [unit], results, log)
+    
+    return scheduler.add(key, 'pixelmed_jvm', cmd=nrrd_to_dicom_command('pixelmed.jar', args), callback=finish,
+                         case=get_case(path_nrrd), path=path_nrrd)
 
-    # first do the standard conversion
-    convert_nrrd_to_dicom_pure(path_nrrd, path_dicom,
-                               patient_name=patient_name, patient_id=patient_id,
-                               study_id=study_id, series_number=series_number, instance_number=series_number)
 
-    # then add the missing info
-    add_info_to_dicom(path_dicom, study_instance_uid=study_instanceid, study_description=study_id,
-                      series_description=series_description, modality=modality)
+def convert_session(manifest, opt, path_folder_case_session, imgs, first_series_number, study_instanceid,
+                    us_executor=None, pool=None, pending=None, scheduler=None, log=None):
+    """
+    Convert the NRRD files of a session that are not up to date in the manifest, and record the results.
+    MR volumes of the session are exported together by 3D Slicer, US volumes one by one.
+    @param manifest: manifest of the converted units
+    @param opt: parsed arguments
+    @param path_folder_case_session: path to the session folder
+    @param imgs: sorted NRRD files of the session
+    @param first_series_number: series number of the first image
+    @param study_instanceid: id of the study
+    @param us_executor: if given, US volumes are converted in the background and their futures added to pending
+    @param pool: PixelMedPool used for the US volumes
+    @param pending: list of the futures of the background US conversions
+    @param scheduler: if given, US volumes are converted by PixelMed JVMs started by the scheduler
+    @param log: RunLog of the run
+    @return: list of (path, error) for the files that failed
+    """
+    units = []
+    for i,img in enumerate(imgs):
+        path_nrrd = os.path.join(path_folder_case_session,img)
+        key = f'dicom/{os.path.relpath(path_nrrd, opt.path_nrrd)}'
+        params = {'series_number':str(i+first_series_number), 'study_instanceid':study_instanceid}
+        if not (opt.resume and manifest.is_up_to_date(key, [path_nrrd], params)):
+            units.append((path_nrrd, key, params))
+    if len(units)==0:
+        return []
+    
+    if 'US' in os.path.basename(path_folder_case_session):
+        failures = []
+        for unit in units:
+            if scheduler is not None:
+                submit_us(scheduler, manifest, opt, unit, study_instanceid, log)
+            elif us_executor is None:
+                failures += convert_us(manifest, opt, unit, study_instanceid, pool, log)
+            else:
+                pending.append(us_executor.submit(convert_us, manifest, opt, unit, study_instanceid, pool, log))
+        return failures
+    
+    try:
+        results = convert_dicom(
+            paths_nrrd=[k[0] for k in units],
+            path_output=opt.path_dicom,
+            series_numbers=[k[2]['series_number'] for k in units],
+            study_instanceid=study_instanceid,
+            log=log)
+    except Exception as e:
+        slicer.mrmlScene.Clear(0)
+        results = {k[0]:([], [(k[0], e)]) for k in units}
+    return record_results(manifest, units, results, log)
+
+
+# Namespace of the name-based UUIDs of the studies
+UID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'https://github.com/ReubenDo/ReMIND')
+
+def get_study_uid(case, session):
+    """
+    Deterministic StudyInstanceUID of a session: UUID derived UID (2.25) of a name-based UUID,
+    so that every run (and every process) gives the same UID to a session
+    """
+    return f'2.25.{uuid.uuid5(UID_NAMESPACE, f"{case}/{session}").int}'
+
+def get_study_instanceid(manifest, opt, case, session):
+    """
+    Get the StudyInstanceUID of a session and record it in the manifest, or reuse the one
+    of the previous run when resuming
+    """
+    study_instanceid = manifest.get_state(f'study_uid/{case}/{session}') if opt.resume else None
+    if study_instanceid is None:
+        study_instanceid = get_study_uid(case, session)
+        manifest.set_state(f'study_uid/{case}/{session}', study_instanceid)
+    return study_instanceid
 
 
 def main():
     opt = parsing_data()
+    manifest = open_manifest(opt, opt.path_dicom)
+    log = open_run_log(opt, opt.path_dicom, 'nrrd_to_dicom_img')
     cases = natsorted([k for k in os.listdir(opt.path_nrrd) if os.path.isdir(os.path.join(opt.path_nrrd,k))])
-    problems = []
+    # Each Slicer process converts its own subset of the cases
+    cases = cases[opt.shard::opt.num_shards]
+    if opt.cases is not None:
+        cases = [k for k in cases if k in opt.cases.split(',')]
     df = {'case':[],'preop':[],'intraop':[]}
+    
+    # US volumes are converted in the background (by long-lived JVMs for PixelMed) while Slicer exports the MR
+    pool, us_executor, scheduler = None, None, None
+    if opt.us_engine=='pixelmed' and opt.us_workers==0:
+        # One JVM per volume, killed and retried if it hangs
+        download_pixelmed('pixelmed.jar')
+        scheduler = Scheduler({'pixelmed_jvm':opt.java_jobs}, timeout=opt.timeout, retries=opt.retries, log=log)
+    elif opt.us_workers>0:
+        us_executor = ThreadPoolExecutor(max_workers=opt.us_workers)
+        if opt.us_engine=='pixelmed':
+            download_pixelmed('pixelmed.jar')
+            pool = PixelMedPool('pixelmed.jar', opt.us_workers, log=log)
+    pending = []
     for case in tqdm(cases):
         # Start with pre-operative MRI
         folder = 'Preop-MR'
         path_folder_case_session = os.path.join(opt.path_nrrd,case,folder)
         imgs =  natsorted([k for k in os.listdir(path_folder_case_session) if '.nrrd' in k])
-        study_instanceid_preop = f'1.3.6.1.4.1.5962.99.1.3781888186.{np.random.randint(10**9)}.{np.random.randint(10**6)}.4.0'
-        for i,img in enumerate(imgs):
-            convert_dicom(
-                path_nrrd=os.path.join(path_folder_case_session,img),
-                path_output=opt.path_dicom,
-                series_number=str(i+1),
-                study_instanceid=study_instanceid_preop
-                )
+        study_instanceid_preop = get_study_instanceid(manifest, opt, case, 'preop')
+        convert_session(manifest, opt, path_folder_case_session, imgs, 1, study_instanceid_preop, log=log)
         
         # Then, intra-operative US
-        study_instanceid_intraop = f'1.3.6.1.4.1.5962.99.1.3781888186.{np.random.randint(10**9)}.{np.random.randint(10**6)}.4.0'
+        study_instanceid_intraop = get_study_instanceid(manifest, opt, case, 'intraop')
         folder = 'Intraop-US'
         path_folder_case_session = os.path.join(opt.path_nrrd,case,folder)
         imgs = natsorted([k for k in os.listdir(path_folder_case_session) if 'nrrd' in k])
-        for i,img in enumerate(imgs):
-            convert_dicom_clunie(
-                path_nrrd=os.path.join(path_folder_case_session,img),
-                path_output=opt.path_dicom,
-                series_number=str(i+1),
-                study_instanceid=study_instanceid_intraop,
-                )
+        convert_session(manifest, opt, path_folder_case_session, imgs, 1, study_instanceid_intraop,
+                        us_executor=us_executor, pool=pool, pending=pending, scheduler=scheduler, log=log)
 
         # Finally, intra-operative MR
         folder = 'Intraop-MR'
         path_folder_case_session = os.path.join(opt.path_nrrd,case,folder)
         imgs =  natsorted([k for k in os.listdir(path_folder_case_session) if '.nrrd' in k])
-        for i,img in enumerate(imgs):
-            convert_dicom(
-                path_nrrd=os.path.join(path_folder_case_session,img),
-                path_output=opt.path_dicom,
-                series_number=str(i+4), 
-                study_instanceid=study_instanceid_intraop)
+        convert_session(manifest, opt, path_folder_case_session, imgs, 4, study_instanceid_intraop, log=log)
             
         df['case'].append(case)
         df['preop'].append(study_instanceid_preop)
         df['intraop'].append(study_instanceid_intraop)
+    
+    for future in pending:
+        future.result()
+    if us_executor is not None:
+        us_executor.shutdown()
+    if pool is not None:
+        pool.close()
+    if scheduler is not None:
+        scheduler.close()
  
     df = pd.DataFrame(df)
-    df.to_csv('corr.csv')
-    print('----------- errors -------------')
-    print(errors)
+    df.to_csv(opt.corr)
+    log.close()
     
-    exit()
+    # Non-zero exit code if a volume failed, so that pipeline.py skips the SEG of the case
+    slicer.util.exit(1 if log.failures else 0)
 
 if __name__ == '__main__':
     main()
-
-            
-            
-        
\ No newline at end of file
@@ -1,9 +1,17 @@
 import os
+import sys
 from tqdm import tqdm
 from natsort import natsorted
-import subprocess
 import json
 import argparse
+import tempfile
+from collections import Counter
+from functools import partial
+from manifest import add_manifest_arguments, open_manifest
+from instrumentation import add_instrumentation_arguments, open_run_log, log_stage, log_run
+from orchestrator import Scheduler, add_scheduler_arguments
+from dicom_index import index_folder
+from seg_dicom import write_seg
 
 
 def parsing_data():
@@ -21,6 +29,22 @@ def parsing_data():
                         type=str,
                         default='../dcmqi-1.2.4-mac/bin/itkimage2segimage',
                         help='Path to the DCMQI Pixelmed')
+    parser.add_argument('--engine',
+                        type=str,
+                        default='dcmqi',
+                        choices=['dcmqi', 'native'],
+                        help='Writer of the DICOM SEG: dcmqi itkimage2segimage or native Python')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of dcmqi conversions running in parallel')
+    parser.add_argument('--cases',
+                        type=str,
+                        default=None,
+                        help='Comma-separated cases to convert (default: all the cases, see pipeline.py)')
+    add_scheduler_arguments(parser)
+    add_manifest_arguments(parser)
+    add_instrumentation_arguments(parser)
     opt = parser.parse_args()
 
     return opt
@@ -28,10 +52,70 @@ def parsing_data():
 
 studycorr = {'preop':'Preop','intraop':'Intraop'}
 
-def create_dicom_seg(path_nrrd, path_output, dcmqi_path):
+PATH_JSON = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json')
+
+
+def load_templates():
     """
-    Convert a SEG nrrd file to a dicom file with DCMqi
+    Load the metadata templates of all the structures once
+    @return: dictionary structure -> template
     """
+    templates = {}
+    for k in os.listdir(PATH_JSON):
+        if k.endswith('.json'):
+            with open(os.path.join(PATH_JSON, k)) as f:
+                templates[k.replace('.json','')] = json.load(f)
+    return templates
+
+
+class ReferenceCache:
+    """
+    Reference series of the studies, each study folder and each reference folder is listed once.
+    For the native engine, each reference series is also indexed once (sorted instances and geometry)
+    and shared by its SEG. dcmqi cannot take a parsed reference: each of its calls reads the series.
+    """
+
+    def __init__(self):
+        self.studies = {}
+        self.files = {}
+        self.series = {}
+
+    def get_folders(self, path_ref_study):
+        """
+        List the series folders of a study
+        """
+        if path_ref_study not in self.studies:
+            self.studies[path_ref_study] = os.listdir(path_ref_study)
+        return self.studies[path_ref_study]
+
+    def get_files(self, path_ref_folder):
+        """
+        List the files of a reference folder, without reading them
+        """
+        if path_ref_folder not in self.files:
+            self.files[path_ref_folder] = natsorted(os.listdir(path_ref_folder))
+        return self.files[path_ref_folder]
+
+    def get_series(self, path_ref_folder):
+        """
+        Index of the reference series of a folder, with its instances sorted along the slice normal
+        """
+        if path_ref_folder not in self.series:
+            series = list(index_folder(path_ref_folder).values())
+            assert len(series)==1, f'Error {len(series)} series in {path_ref_folder}'
+            self.series[path_ref_folder] = series[0]
+        return self.series[path_ref_folder]
+
+
+def get_seg_info(path_nrrd, path_output, references=None):
+    """
+    Get the structure, reference series and output path of a SEG nrrd file
+    @param path_nrrd: path to the SEG nrrd file
+    @param path_output: path to the root DICOM folder
+    @param references: ReferenceCache shared by the SEG files, the study folder is listed again if None
+    """
+    if references is None:
+        references = ReferenceCache()
     
     # Get SEG information
     structure = os.path.basename(path_nrrd).split('-')[3] # Type of structure
@@ -44,45 +128,172 @@ def create_dicom_seg(path_nrrd, path_output, dcmqi_path):
     
     # Get reference image path
     path_ref_study = os.path.join(path_output,f'{patient_id}-{patient_name}', f'{date}-{study_id}')
-    ref_folder = [k for k in os.listdir(path_ref_study) if '-' in k and ref_scan==k.split('-')[1]]
-    assert len(ref_folder)==1, f'Error {len(ref_folder)}, {ref_scan}, {os.path.basename(path_nrrd),  os.listdir(path_ref_study)}'
+    ref_folders = references.get_folders(path_ref_study)
+    ref_folder = [k for k in ref_folders if '-' in k and ref_scan==k.split('-')[1]]
+    assert len(ref_folder)==1, f'Error {len(ref_folder)}, {ref_scan}, {os.path.basename(path_nrrd),  ref_folders}'
     path_ref_folder = os.path.join(path_ref_study, ref_folder[0])
     
-    # Load json file
-    f = open(f'json/{structure}.json')
-    data = json.load(f)
+    path_dicom_seg = os.path.join(path_output,f'{patient_id}-{patient_name}', 'Annotations', os.path.basename(path_nrrd).replace('.nrrd','.dcm'))
+    return {'structure':structure,
+            'ref_scan':ref_scan,
+            'path_ref_folder':path_ref_folder,
+            'path_json':os.path.join(PATH_JSON, f'{structure}.json'),
+            'path_dicom_seg':path_dicom_seg}
+
+
+def get_seg_metadata(info, templates):
+    """
+    Metadata of a SEG for dcmqi, from the template of its structure
+    @param info: SEG information from get_seg_info
+    @param templates: metadata templates from load_templates
+    """
+    structure, ref_scan = info['structure'], info['ref_scan']
+    data = dict(templates[structure])
     data['SeriesDescription'] = f'{structure} seg - MR ref: {ref_scan}'
-    with open('temp.json', 'w') as f:
+    return data
+
+
+def write_seg_metadata(data):
+    """
+    Write the metadata of a SEG in its own temporary file, so that jobs can run concurrently
+    @return: path to the metadata file, to be removed by the caller
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
         json.dump(data, f)
+        return f.name
+
+
+def get_dcmqi_command(path_nrrd, info, dcmqi_path, path_metadata):
+    """
+    Command line of dcmqi itkimage2segimage for a SEG nrrd file
+    @param info: SEG information from get_seg_info
+    @param path_metadata: path to the metadata file of the SEG
+    """
+    return [dcmqi_path,
+            '--inputImageList', path_nrrd,
+            '--inputDICOMDirectory', info['path_ref_folder'],
+            '--outputDICOM', info['path_dicom_seg'],
+            '--inputMetadata', path_metadata,
+        ]
+
+
+def create_dicom_seg(path_nrrd, path_output, dcmqi_path, templates=None, info=None, engine='dcmqi', log=None):
+    """
+    Convert a SEG nrrd file to a dicom file with DCMqi
+    @param templates: metadata templates from load_templates, loaded if None
+    @param info: SEG information from get_seg_info, computed if None
+    @param engine: 'dcmqi' or 'native' to write the SEG in Python
+    @param log: RunLog recording the time of the conversion
+    @return: exit code of dcmqi (0 for the native engine)
+    """
+    if info is None:
+        info = get_seg_info(path_nrrd, path_output)
+    if templates is None:
+        templates = load_templates()
+    data = get_seg_metadata(info, templates)
     
     # Create output folder  
-    os.makedirs(os.path.join(path_output,f'{patient_id}-{patient_name}', 'Annotations'), exist_ok=True)
+    os.makedirs(os.path.dirname(info['path_dicom_seg']), exist_ok=True)
     
-    # create the command
-    cmd = [dcmqi_path, 
-           '--inputImageList', path_nrrd,
-           '--inputDICOMDirectory', path_ref_folder,
-           '--outputDICOM', os.path.join(path_output,f'{patient_id}-{patient_name}', 'Annotations', os.path.basename(path_nrrd).replace('.nrrd','.dcm')),
-           '--inputMetadata', 'temp.json',
-        ]
-    # execute it
-    subprocess.call(cmd)
+    if engine=='native':
+        reference = info.get('reference')
+        if reference is None:
+            reference = ReferenceCache().get_series(info['path_ref_folder'])
+        with log_stage(log, 'seg_native_write', case=path_nrrd.split("/")[-3], path=path_nrrd) as stage:
+            write_seg(path_nrrd, info['path_dicom_seg'], info['path_ref_folder'], reference, data)
+            stage['bytes_written'] = os.path.getsize(info['path_dicom_seg'])
+        return 0
     
-    os.remove('temp.json')
+    path_metadata = write_seg_metadata(data)
+    cmd = get_dcmqi_command(path_nrrd, info, dcmqi_path, path_metadata)
+    # execute it
+    try:
+        returncode = log_run(log, cmd, 'dcmqi', case=path_nrrd.split("/")[-3], path=path_nrrd)
+    finally:
+        os.remove(path_metadata)
+    return returncode
 
 
 def main():
     opt = parsing_data()
+    manifest = open_manifest(opt, opt.path_dicom)
+    log = open_run_log(opt, opt.path_dicom, 'nrrd_to_dicom_seg')
+    templates = load_templates()
+    references = ReferenceCache()
     cases = natsorted([k for k in os.listdir(opt.path_nrrd) if os.path.isdir(os.path.join(opt.path_nrrd, k))])
-    for case in tqdm(cases):
-        for folder in ['Annotations']:
-            path_folder_case_session = os.path.join(opt.path_nrrd, case, folder)
-            imgs =  [k for k in os.listdir(path_folder_case_session) if '.nrrd' in k]
-            for img in imgs:
-                create_dicom_seg(
-                    os.path.join(path_folder_case_session, img),
-                    opt.path_dicom,
-                    opt.img2seg)
+    if opt.cases is not None:
+        cases = [k for k in cases if k in opt.cases.split(',')]
+    
+    # List the SEG that are not up to date, by reference series
+    groups = {}
+    returncodes = Counter()
+    with log.stage('index'):
+        for case in cases:
+            for folder in ['Annotations']:
+                path_folder_case_session = os.path.join(opt.path_nrrd, case, folder)
+                imgs =  [k for k in os.listdir(path_folder_case_session) if '.nrrd' in k]
+                for img in imgs:
+                    path_nrrd = os.path.join(path_folder_case_session, img)
+                    key = f'seg/{os.path.relpath(path_nrrd, opt.path_nrrd)}'
+                    params = {'engine':opt.engine} if opt.engine=='native' else {'img2seg':opt.img2seg}
+                    try:
+                        info = get_seg_info(path_nrrd, opt.path_dicom, references)
+                        # Only the native engine uses the index of the reference, dcmqi reads the folder
+                        ref_files = references.get_files(info['path_ref_folder'])
+                        if opt.engine=='native':
+                            info['reference'] = references.get_series(info['path_ref_folder'])
+                    except Exception as e:
+                        # Missing or ambiguous reference series (e.g. its export failed): only this SEG fails
+                        returncodes['failed'] += 1
+                        manifest.record(key, [path_nrrd], params, [], status='failed', error=repr(e))
+                        log.failure(path_nrrd, e, case=case)
+                        continue
+                    # The SEG is stale if the reference series was exported again
+                    inputs = [path_nrrd, info['path_json']] + [os.path.join(info['path_ref_folder'], k) for k in ref_files]
+                    if opt.resume and manifest.is_up_to_date(key, inputs, params):
+                        continue
+                    groups.setdefault(info['path_ref_folder'], []).append((path_nrrd, info, key, inputs, params))
+    
+    # Jobs are queued by reference series. This is only their order: each dcmqi call parses its
+    # reference again, and the native jobs share the index of the reference built above.
+    number_jobs = sum(len(k) for k in groups.values())
+    scheduler = Scheduler({'dcmqi':opt.workers, 'seg_native':opt.workers}, 
+                          timeout=opt.timeout, retries=opt.retries, log=log)
+    with tqdm(total=number_jobs) as pbar:
+        def record(path_nrrd, info, key, inputs, params, path_metadata, result):
+            if path_metadata is not None:
+                os.remove(path_metadata)
+            returncodes[result['status'] if result['returncode'] is None else result['returncode']] += 1
+            if result['status']=='ok':
+                manifest.record(key, inputs, params, [info['path_dicom_seg']])
+            else:
+                manifest.record(key, inputs, params, [info['path_dicom_seg']], status='failed', error=result['error'])
+                log.failure(path_nrrd, result['error'], case=path_nrrd.split("/")[-3])
+            pbar.update(1)
+        
+        for jobs in groups.values():
+            for path_nrrd, info, key, inputs, params in jobs:
+                os.makedirs(os.path.dirname(info['path_dicom_seg']), exist_ok=True)
+                data = get_seg_metadata(info, templates)
+                fields = {'case':path_nrrd.split("/")[-3], 'path':path_nrrd}
+                if opt.engine=='native':
+                    func = partial(write_seg, path_nrrd, info['path_dicom_seg'], info['path_ref_folder'], info['reference'], data)
+                    callback = partial(record, path_nrrd, info, key, inputs, params, None)
+                    scheduler.add(key, 'seg_native', func=func, callback=callback, **fields)
+                else:
+                    path_metadata = write_seg_metadata(data)
+                    cmd = get_dcmqi_command(path_nrrd, info, opt.img2seg, path_metadata)
+                    callback = partial(record, path_nrrd, info, key, inputs, params, path_metadata)
+                    scheduler.add(key, 'dcmqi', cmd=cmd, callback=callback, **fields)
+        scheduler.close()
+    
+    print(f'----------- {sum(returncodes.values())} conversions -------------')
+    for returncode, count in returncodes.most_common():
+        # Jobs without an exit code (tool not started, timed out) are counted by status
+        print(f'exit code {returncode}: {count}' if isinstance(returncode, int) else f'{returncode}: {count}')
+    log.close()
+    if log.failures:
+        sys.exit(1)
 
         
 if __name__ == '__main__':
@@ -0,0 +1,151 @@
+import time
+import asyncio
+import threading
+
+
+class Scheduler:
+    """
+    Run external tools (and Python steps) as a graph of jobs on an asyncio loop in a background thread.
+    Each tool has its own concurrency limit, hung processes are killed after a timeout and failed
+    jobs are retried. A job starts when all its dependencies succeeded, and is skipped if one failed,
+    or once the jobs it runs after are done, whatever their status.
+    Jobs can be added from any thread while others are running.
+    """
+
+    def __init__(self, limits=None, timeout=None, retries=0, log=None):
+        """
+        @param limits: dictionary tool -> maximum number of concurrent jobs (1 for the tools not listed)
+        @param timeout: default time limit in seconds of an external command, None for no limit
+        @param retries: default number of retries of a failed or timed out job
+        @param log: RunLog recording each job
+        """
+        self.limits = dict(limits or {})
+        self.timeout = timeout
+        self.retries = retries
+        self.log = log
+        self.jobs = {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def add(self, name, tool, cmd=None, func=None, deps=(), after=(), timeout=None, retries=None, callback=None,
+            **fields):
+        """
+        Add a job, started as soon as its dependencies succeeded and its tool has a free slot
+        @param name: unique name of the job
+        @param tool: name of the tool, jobs of a tool share its concurrency limit
+        @param cmd: command line of an external tool
+        @param func: Python function without arguments run in a thread instead of a command (no timeout)
+        @param deps: names of the jobs (already added) that must succeed first
+        @param after: names of the jobs (already added) that must be done first, whatever their status
+        @param timeout: time limit in seconds, the default of the scheduler if None
+        @param retries: number of retries, the default of the scheduler if None
+        @param callback: function called in a thread with the result of the job, once done;
+                         an error in the callback fails the job
+        @param fields: case, path, ... stored with the result and in the run log
+        @return: concurrent.futures.Future of the result dictionary
+        """
+        assert (cmd is None) != (func is None), 'A job needs either a command or a function'
+        job = {'name': name, 'tool': tool, 'cmd': cmd, 'func': func, 'callback': callback, 'fields': fields,
+               'timeout': self.timeout if timeout is None else timeout,
+               'retries': self.retries if retries is None else retries}
+        with self.lock:
+            assert name not in self.jobs, f'Job {name} already added'
+            # Dependencies are added first, so that the graph has no cycle
+            deps = [self.jobs[k] for k in deps]
+            after = [self.jobs[k] for k in after]
+            self.jobs[name] = asyncio.run_coroutine_threadsafe(self._run_job(job, deps, after), self.loop)
+            return self.jobs[name]
+
+    def wait(self):
+        """
+        Wait for all the jobs added so far
+        @return: dictionary name -> result with the status ('ok', 'failed', 'timeout' or 'skipped'),
+                 return code, number of attempts, error and wall time
+        """
+        with self.lock:
+            jobs = dict(self.jobs)
+        return {name: future.result() for name, future in jobs.items()}
+
+    def close(self):
+        """
+        Wait for all the jobs and stop the loop
+        """
+        self.wait()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    async def _run_job(self, job, deps, after=()):
+        results = [await asyncio.wrap_future(k) for k in deps]
+        for k in after:
+            await asyncio.wrap_future(k)
+        queued = time.perf_counter()
+        result = {'status': 'skipped', 'returncode': None, 'attempts': 0, 'error': None, 'wall': 0.}
+        if all(k['status'] == 'ok' for k in results):
+            if job['tool'] not in self.semaphores:
+                self.semaphores[job['tool']] = asyncio.Semaphore(self.limits.get(job['tool'], 1))
+            async with self.semaphores[job['tool']]:
+                start = time.perf_counter()
+                while result['status'] != 'ok' and result['attempts'] <= job['retries']:
+                    result['attempts'] += 1
+                    result.update(await self._attempt(job))
+                result['wall'] = time.perf_counter() - start
+                result['queued'] = start - queued
+        else:
+            result['error'] = 'a dependency failed'
+        result.update(job['fields'])
+        if job['callback'] is not None:
+            try:
+                await self.loop.run_in_executor(None, job['callback'], result)
+            except Exception as e:
+                result.update(status='failed', error=repr(e))
+        if self.log is not None:
+            fields = {k: v for k, v in result.items() if k not in ['status', 'wall']}
+            self.log.record_stage(job['tool'], result['wall'], status=result['status'], job=job['name'], **fields)
+        return result
+
+    async def _attempt(self, job):
+        if job['func'] is not None:
+            try:
+                await self.loop.run_in_executor(None, job['func'])
+            except Exception as e:
+                return {'status': 'failed', 'error': repr(e)}
+            return {'status': 'ok', 'returncode': 0, 'error': None}
+
+        try:
+            process = await asyncio.create_subprocess_exec(*job['cmd'])
+        except OSError as e:
+            # Missing or not executable tool: the job fails like any other, and its callback still runs
+            return {'status': 'failed', 'returncode': None, 'error': f'cannot run {job["cmd"][0]}: {e}'}
+        try:
+            returncode = await asyncio.wait_for(process.wait(), job['timeout'])
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            return {'status': 'timeout', 'returncode': None, 'error': f'timed out after {job["timeout"]} s'}
+        if returncode != 0:
+            return {'status': 'failed', 'returncode': returncode, 'error': f'exit code {returncode}'}
+        return {'status': 'ok', 'returncode': 0, 'error': None}
+
+
+def add_scheduler_arguments(parser):
+    """
+    Add the options of the external tool scheduler shared by the conversion scripts
+    """
+    parser.add_argument('--timeout',
+                        type=float,
+                        default=None,
+                        help='Time limit in seconds of an external converter (Java, dcmqi), killed and retried after')
+    parser.add_argument('--retries',
+                        type=int,
+                        default=1,
+                        help='Number of retries of a failed or timed out conversion')
@@ -0,0 +1,86 @@
+import gzip
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCK_SIZE = 128 * 1024
+WINDOW_SIZE = 32 * 1024
+
+
+def _compress_block(data, dictionary, level, last):
+    # Raw deflate of a block, primed with the end of the previous block as pigz does,
+    # and ended on a byte boundary so that the blocks can be concatenated
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile:
+    """
+    Write-only gzip file whose blocks are compressed by a pool of threads (pigz-style).
+    The output is a single standard gzip member, readable by any gzip reader.
+    """
+
+    def __init__(self, fileobj, compresslevel=6, threads=4, block_size=BLOCK_SIZE):
+        """
+        @param fileobj: binary file object open for writing
+        @param compresslevel: gzip compression level
+        @param threads: number of threads compressing the blocks
+        @param block_size: size of the uncompressed blocks
+        """
+        self.fileobj = fileobj
+        self.level = compresslevel
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = 2 * threads
+        self.pending = []
+        self.buffer = bytearray()
+        self.dictionary = b''
+        self.crc = 0
+        self.size = 0
+        self.fileobj.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\xff')
+
+    def _submit(self, data, last=False):
+        self.pending.append(self.executor.submit(_compress_block, data, self.dictionary, self.level, last))
+        self.dictionary = data[-WINDOW_SIZE:]
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        # Blocks are written in order, and at most max_pending are in memory
+        while len(self.pending) > (0 if last else self.max_pending):
+            self.fileobj.write(self.pending.pop(0).result())
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) > self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.executor is None:
+            return
+        self._submit(bytes(self.buffer), last=True)
+        self.fileobj.write(struct.pack('<II', self.crc, self.size & 0xFFFFFFFF))
+        self.executor.shutdown()
+        self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_gzip(fileobj, compresslevel=6, threads=1):
+    """
+    Open a gzip stream for writing, compressed by several threads if threads > 1
+    @param fileobj: binary file object open for writing, not closed with the stream
+    @param compresslevel: gzip compression level
+    @param threads: number of threads compressing the stream
+    @return: file object
+    """
+    if threads > 1:
+        return ParallelGzipFile(fileobj, compresslevel=compresslevel, threads=threads)
+    return gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=compresslevel)
@@ -0,0 +1,129 @@
+import os
+import sys
+import argparse
+from natsort import natsorted
+from instrumentation import add_instrumentation_arguments, open_run_log
+from manifest import add_manifest_arguments
+from orchestrator import Scheduler, add_scheduler_arguments
+from pixelmed_pool import download_pixelmed, uses_pixelmed
+from run_slicer_shards import merge_corr
+
+PATH_SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def parsing_data():
+    parser = argparse.ArgumentParser(
+        description='Conversion of the NRRD dataset (images then SEG) into DICOM with a graph of jobs per case. '
+                    'Other arguments are passed to nrrd_to_dicom_img.py')
+    parser.add_argument('--path_nrrd',
+                        type=str,
+                        default='./nrrd',
+                        help='Path to the input NRRD dataset')
+    parser.add_argument('--path_dicom',
+                        type=str,
+                        default='./dicom_folder',
+                        help='Path to the output DICOM dataset')
+    parser.add_argument('--slicer',
+                        type=str,
+                        default='/Applications/Slicer.app/Contents/MacOS/Slicer',
+                        help='Path to the 3D Slicer executable')
+    parser.add_argument('--img2seg',
+                        type=str,
+                        default='../dcmqi-1.2.4-mac/bin/itkimage2segimage',
+                        help='Path to the DCMQI Pixelmed')
+    parser.add_argument('--engine',
+                        type=str,
+                        default='dcmqi',
+                        choices=['dcmqi', 'native'],
+                        help='Writer of the DICOM SEG: dcmqi itkimage2segimage or native Python')
+    parser.add_argument('--slicer_jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of Slicer processes (one per case) running in parallel')
+    parser.add_argument('--seg_jobs',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of cases whose SEG are converted in parallel')
+    parser.add_argument('--seg_workers',
+                        type=int,
+                        default=1,
+                        help='Number of dcmqi conversions running in parallel within a case')
+    parser.add_argument('--cases',
+                        type=str,
+                        default=None,
+                        help='Comma-separated cases to convert (default: all the cases)')
+    parser.add_argument('--corr',
+                        type=str,
+                        default='corr.csv',
+                        help='Path to the output csv with the StudyInstanceUIDs of each case')
+    add_scheduler_arguments(parser)
+    add_manifest_arguments(parser)
+    add_instrumentation_arguments(parser)
+    opt, args = parser.parse_known_args()
+
+    return opt, args
+
+
+def get_common_arguments(opt, path_log):
+    """
+    Arguments shared by the image and SEG scripts: paths, external tool limits, manifest and run log
+    """
+    args = ['--path_nrrd', opt.path_nrrd, '--path_dicom', opt.path_dicom, '--retries', str(opt.retries),
+            '--log', path_log]
+    if opt.timeout is not None:
+        args += ['--timeout', str(opt.timeout)]
+    if opt.manifest is not None:
+        args += ['--manifest', opt.manifest]
+    for option in ['resume', 'force', 'hash_contents']:
+        if getattr(opt, option):
+            args.append(f'--{option}')
+    return args
+
+
+def main():
+    opt, args = parsing_data()
+    log = open_run_log(opt, opt.path_dicom, 'pipeline')
+    common = get_common_arguments(opt, log.path)
+    cases = natsorted([k for k in os.listdir(opt.path_nrrd) if os.path.isdir(os.path.join(opt.path_nrrd, k))])
+    if opt.cases is not None:
+        cases = [k for k in cases if k in opt.cases.split(',')]
+    # Downloaded once here rather than by the Slicer process of each case
+    if uses_pixelmed(args):
+        download_pixelmed('pixelmed.jar')
+
+    # The images of a case are exported by their own Slicer process, and its SEG are converted
+    # as soon as the reference series exist, while the next cases are exported.
+    # Retries and timeouts apply to the external tools inside the scripts, not to whole cases.
+    paths_corr = []
+    with Scheduler({'slicer':opt.slicer_jobs, 'seg':opt.seg_jobs}, retries=0, log=log) as scheduler:
+        for case in cases:
+            path_corr = f'{opt.corr}.{case}'
+            paths_corr.append(path_corr)
+            cmd = [opt.slicer, '--no-splash', '--no-main-window', '--python-script',
+                   os.path.join(PATH_SCRIPTS, 'nrrd_to_dicom_img.py'),
+                   '--cases', case, '--corr', path_corr] + common + args
+            scheduler.add(f'img/{case}', 'slicer', cmd=cmd, case=case)
+
+            path_annotations = os.path.join(opt.path_nrrd, case, 'Annotations')
+            if not os.path.isdir(path_annotations) or not any('.nrrd' in k for k in os.listdir(path_annotations)):
+                continue
+            cmd = [sys.executable, os.path.join(PATH_SCRIPTS, 'nrrd_to_dicom_seg.py'),
+                   '--cases', case, '--img2seg', opt.img2seg, '--engine', opt.engine,
+                   '--workers', str(opt.seg_workers)] + common
+            # The SEG of a case are converted once its images are exported, even partially: each SEG
+            # whose reference series is missing fails on its own in nrrd_to_dicom_seg.py
+            scheduler.add(f'seg/{case}', 'seg', cmd=cmd, after=[f'img/{case}'], case=case)
+        results = scheduler.wait()
+
+    # Deterministic StudyInstanceUIDs of the cases, also recorded in the manifest
+    merge_corr(paths_corr, opt.corr)
+    for name, result in results.items():
+        if result['status']!='ok':
+            log.failure(name, result['error'], case=result['case'])
+    log.close()
+    if any(k['status']!='ok' for k in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
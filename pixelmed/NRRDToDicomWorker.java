@@ -0,0 +1,34 @@
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.PrintStream;
+import java.nio.charset.StandardCharsets;
+
+/**
+ * Long-lived PixelMed NRRDToDicom converter.
+ * Reads one job per line on stdin (the NRRDToDicom arguments separated by tabs)
+ * and answers "OK" or "ERROR message" on stdout for each job.
+ * Run with: java -cp pixelmed.jar -Djava.awt.headless=true NRRDToDicomWorker.java
+ */
+public class NRRDToDicomWorker {
+	public static void main(String[] args) throws Exception {
+		PrintStream replies = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+		// Messages of the converter must not be mixed with the replies
+		System.setOut(System.err);
+		BufferedReader jobs = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+		String line;
+		while ((line = jobs.readLine()) != null) {
+			if (line.isEmpty()) {
+				continue;
+			}
+			try {
+				com.pixelmed.convert.NRRDToDicom.main(line.split("\t", -1));
+				replies.println("OK");
+			}
+			catch (Throwable t) {
+				replies.println("ERROR " + t.toString().replace('\n', ' '));
+			}
+		}
+	}
+}
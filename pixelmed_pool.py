@@ -0,0 +1,125 @@
+import os
+import time
+import queue
+import tempfile
+import subprocess
+from instrumentation import wait_rusage
+
+PATH_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pixelmed', 'NRRDToDicomWorker.java')
+URL_PIXELMED = 'http://www.dclunie.com/pixelmed/software/20221004_current/pixelmed.jar'
+
+
+def download_pixelmed(path_jar='pixelmed.jar'):
+    """
+    Download pixelmed.jar if missing. The jar is written to a temporary file renamed once complete,
+    so that processes starting at the same time never read a partial jar.
+    @param path_jar: path to pixelmed.jar
+    """
+    from urllib.request import urlopen
+    if os.path.isfile(path_jar):
+        return
+    data = urlopen(URL_PIXELMED).read()
+    fd, path_tmp = tempfile.mkstemp(suffix='.jar', dir=os.path.dirname(os.path.abspath(path_jar)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(path_tmp, path_jar)
+    except BaseException:
+        os.remove(path_tmp)
+        raise
+
+
+def uses_pixelmed(args):
+    """
+    Whether the arguments passed to nrrd_to_dicom_img.py select the PixelMed engine (the default)
+    @param args: command line arguments of nrrd_to_dicom_img.py
+    """
+    args = list(args)
+    for i, arg in enumerate(args):
+        if arg.startswith('--us_engine='):
+            return arg.split('=', 1)[1]=='pixelmed'
+        if arg=='--us_engine' and i+1<len(args):
+            return args[i+1]=='pixelmed'
+    return True
+
+
+def nrrd_to_dicom_command(path_jar, args):
+    """
+    Command line running PixelMed NRRDToDicom in a new JVM
+    @param path_jar: path to pixelmed.jar
+    @param args: arguments of NRRDToDicom (input nrrd, output dicom, patient name, ...)
+    """
+    return ['java', '-cp', path_jar, '-Djava.awt.headless=true', 'com.pixelmed.convert.NRRDToDicom'] + list(args)
+
+
+class PixelMedPool:
+    """
+    Pool of long-lived JVMs running PixelMed NRRDToDicom, to avoid paying the JVM startup
+    and class loading for each volume. Jobs are sent on stdin, see pixelmed/NRRDToDicomWorker.java.
+    Thread-safe: each call to convert borrows one JVM, so up to `size` conversions run concurrently.
+    """
+
+    def __init__(self, path_jar, size=1, log=None):
+        """
+        @param path_jar: path to pixelmed.jar
+        @param size: number of JVMs
+        @param log: RunLog recording the wall and CPU time of each JVM when the pool is closed
+        """
+        self.path_jar = path_jar
+        self.log = log
+        self.idle = queue.Queue()
+        self.workers = []
+        # JVMs are started when first needed
+        for _ in range(size):
+            self.idle.put(None)
+
+    def _start(self):
+        cmd = ['java', '-cp', self.path_jar, '-Djava.awt.headless=true', PATH_WORKER]
+        worker = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                  text=True, encoding='utf-8', bufsize=1)
+        self.workers.append((worker, time.perf_counter()))
+        return worker
+
+    def convert(self, args):
+        """
+        Run NRRDToDicom in one of the JVMs of the pool
+        @param args: arguments of NRRDToDicom (input nrrd, output dicom, patient name, ...)
+        """
+        assert not any('\t' in k or '\n' in k for k in args), f'Invalid NRRDToDicom arguments {args}'
+        worker = self.idle.get()
+        try:
+            if worker is None or worker.poll() is not None:
+                worker = self._start()
+            worker.stdin.write('\t'.join(args) + '\n')
+            worker.stdin.flush()
+            reply = worker.stdout.readline().strip()
+            if not reply:
+                # The converter called System.exit, the JVM is restarted for the next job
+                returncode = worker.wait()
+                worker = None
+                raise RuntimeError(f'NRRDToDicom worker exited with code {returncode}')
+            if reply != 'OK':
+                raise RuntimeError(f'NRRDToDicom failed: {reply}')
+        finally:
+            self.idle.put(worker)
+        if not os.path.isfile(args[1]):
+            raise RuntimeError(f'NRRDToDicom did not write {args[1]}')
+
+    def close(self):
+        """
+        Stop all the JVMs of the pool
+        """
+        for worker, start in self.workers:
+            if worker.poll() is None:
+                worker.stdin.close()
+                _, usage = wait_rusage(worker)
+                if self.log is not None:
+                    usage = usage or {}
+                    self.log.record_stage('pixelmed_jvm_pool', time.perf_counter() - start, usage.pop('cpu', None), **usage)
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,203 @@
+import os
+import gzip
+import threading
+from collections import OrderedDict
+import numpy as np
+from natsort import natsorted
+from nrrd_io import read_header, get_geometry, read_volume
+from nifti_io import read_nifti_header
+
+EXTENSIONS = ['.nii.gz', '.nii', '.nrrd']
+
+
+def parse_filename(filename):
+    """
+    Series number and description of an output file named by get_filename in dicom_to_nifti-nrrd_img.py
+    ({SeriesNumber}_{SeriesDescription}, with _{n} appended to duplicates, or the SeriesInstanceUID)
+    @param filename: name of the file without extension
+    @return: series number (None if the file is named by its SeriesInstanceUID) and description
+    """
+    number, _, description = filename.partition('_')
+    if not number.isdigit():
+        return None, filename
+    return int(number), description
+
+
+def read_entry(path):
+    """
+    Index entry of a converted volume, from its header only
+    @param path: path to a NIfTI or NRRD file
+    @return: dictionary with the path, format, shape (columns, rows, slices), dtype, spacing, origin,
+             directions (LPS) and whether the voxels can be memory-mapped
+    """
+    if path.endswith('.nrrd'):
+        header, offset = read_header(path)
+        origin, directions, spacing = get_geometry(header)
+        return {'path': path, 'format': 'nrrd', 'shape': tuple(header['sizes']), 'dtype': header['type'],
+                'spacing': spacing, 'origin': origin, 'directions': directions,
+                'offset': offset, 'mapped': header['encoding'] == 'raw'}
+    header = read_nifti_header(path)
+    # Rescaled voxels cannot be mapped as they are stored
+    rescaled = header['slope'] not in (0., 1.) or header['intercept'] != 0.
+    return {'path': path, 'format': 'nifti', 'shape': header['shape'], 'dtype': header['dtype'],
+            'spacing': header['spacing'], 'origin': header['origin'], 'directions': header['directions'],
+            'offset': header['offset'], 'slope': header['slope'], 'intercept': header['intercept'],
+            'mapped': not path.endswith('.gz') and not rescaled}
+
+
+def _open_payload(entry):
+    # Decompressed stream positioned on the first voxel
+    f = open(entry['path'], 'rb')
+    if entry['format']=='nrrd':
+        f.seek(entry['offset'])
+        return gzip.GzipFile(fileobj=f, mode='rb'), f
+    payload = gzip.GzipFile(fileobj=f, mode='rb') if entry['path'].endswith('.gz') else f
+    payload.seek(entry['offset'])
+    return payload, f
+
+
+def _rescale(entry, voxels):
+    if entry.get('slope', 0.) in (0., 1.) and entry.get('intercept', 0.) == 0.:
+        return voxels
+    return voxels.astype(np.float32) * (entry['slope'] or 1.) + entry['intercept']
+
+
+def iter_slabs(entry, frames=16):
+    """
+    Iterate over a volume by slabs of slices without loading it: memory-mapped if the file is
+    uncompressed, else decompressed one slab at a time
+    @param entry: index entry from read_entry
+    @param frames: number of slices of a slab
+    @return: generator of arrays (slices, rows, columns)
+    """
+    shape = entry['shape'][::-1]
+    if entry['mapped']:
+        volume = np.memmap(entry['path'], dtype=entry['dtype'], mode='r', offset=entry['offset'], shape=shape)
+        for k in range(0, shape[0], frames):
+            yield volume[k:k + frames]
+        return
+    frame_bytes = int(np.prod(shape[1:])) * entry['dtype'].itemsize
+    payload, f = _open_payload(entry)
+    try:
+        for k in range(0, shape[0], frames):
+            number = min(frames, shape[0] - k)
+            data = payload.read(number * frame_bytes)
+            if len(data) != number * frame_bytes:
+                raise ValueError(f'Truncated voxel data in {entry["path"]}')
+            yield _rescale(entry, np.frombuffer(data, dtype=entry['dtype']).reshape((number,) + tuple(shape[1:])))
+    finally:
+        payload.close()
+        f.close()
+
+
+class ReMINDDataset:
+    """
+    Lazy access to the converted ReMIND dataset (output of dicom_to_nifti-nrrd_img.py),
+    organised as case -> session -> series.
+    Only the headers are read to build the index. Uncompressed volumes (raw NRRD, .nii) are
+    memory-mapped, compressed ones are decoded once and kept in a LRU cache.
+    Thread-safe, e.g. for the workers of a data loader.
+    """
+
+    def __init__(self, path, cases=None, cache_mb=1024):
+        """
+        @param path: root folder of the converted dataset (path_output of dicom_to_nifti-nrrd_img.py)
+        @param cases: cases to index (default: all the cases)
+        @param cache_mb: memory budget of the decoded volumes kept in the cache
+        """
+        self.path = path
+        self.cache_bytes = cache_mb * 1024 ** 2
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.lock = threading.Lock()
+        self.index = {}
+        if cases is None:
+            cases = natsorted([k for k in os.listdir(path) if os.path.isdir(os.path.join(path, k))])
+        for case in cases:
+            path_case = os.path.join(path, case)
+            sessions = natsorted([k for k in os.listdir(path_case) if os.path.isdir(os.path.join(path_case, k))])
+            for session in sessions:
+                path_session = os.path.join(path_case, session)
+                for filename in natsorted(os.listdir(path_session)):
+                    extension = [k for k in EXTENSIONS if filename.endswith(k)]
+                    if len(extension)==0:
+                        continue
+                    series = filename[:-len(extension[0])]
+                    entry = read_entry(os.path.join(path_session, filename))
+                    entry['case'], entry['session'], entry['series'] = case, session, series
+                    entry['series_number'], entry['description'] = parse_filename(series)
+                    self.index.setdefault(case, {}).setdefault(session, {})[series] = entry
+        self.keys = [(case, session, series) for case, sessions in self.index.items()
+                     for session, series_entries in sessions.items() for series in series_entries]
+
+    @property
+    def cases(self):
+        return list(self.index)
+
+    def sessions(self, case):
+        return list(self.index[case])
+
+    def series(self, case, session):
+        return list(self.index[case][session])
+
+    def entry(self, case, session, series):
+        """
+        Index entry of a series: path, shape, spacing, origin, directions, ...
+        """
+        return self.index[case][session][series]
+
+    def find(self, case=None, session=None, description=None):
+        """
+        Entries matching a case, a session (or a part of its name, e.g. 'Preop') and a part of the series description
+        """
+        return [self.entry(*k) for k in self.keys
+                if (case is None or k[0]==case) and (session is None or session in k[1])
+                and (description is None or description in self.entry(*k)['description'])]
+
+    def load(self, case, session, series):
+        """
+        Voxels of a series, as an array (slices, rows, columns)
+        @return: read-only memory-mapped array if the file is uncompressed, else a cached decoded array
+        """
+        entry = self.entry(case, session, series)
+        shape = entry['shape'][::-1]
+        if entry['mapped']:
+            return np.memmap(entry['path'], dtype=entry['dtype'], mode='r', offset=entry['offset'], shape=shape)
+
+        key = entry['path']
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        # Decoded outside of the lock, so that several volumes are decoded at once
+        if entry['format']=='nrrd':
+            volume = read_volume(entry['path'])
+        else:
+            payload, f = _open_payload(entry)
+            with payload, f:
+                volume = np.frombuffer(payload.read(int(np.prod(shape)) * entry['dtype'].itemsize), dtype=entry['dtype'])
+            volume = _rescale(entry, volume.reshape(shape))
+        volume.flags.writeable = False
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = volume
+                self.cached_bytes += volume.nbytes
+                while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+                    _, evicted = self.cache.popitem(last=False)
+                    self.cached_bytes -= evicted.nbytes
+            return self.cache[key]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, i):
+        """
+        @param i: position of the series or (case, session, series)
+        @return: index entry of the series and its voxels
+        """
+        key = self.keys[i] if isinstance(i, int) else tuple(i)
+        return self.entry(*key), self.load(*key)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,78 @@
+import os
+import csv
+import sys
+import argparse
+import subprocess
+from natsort import natsorted
+from pixelmed_pool import download_pixelmed, uses_pixelmed
+
+
+def parsing_data():
+    parser = argparse.ArgumentParser(
+        description='Conversion NRRD images into DICOM with several headless 3D Slicer processes. '
+                    'Other arguments are passed to nrrd_to_dicom_img.py')
+    parser.add_argument('--slicer',
+                        type=str,
+                        default='/Applications/Slicer.app/Contents/MacOS/Slicer',
+                        help='Path to the 3D Slicer executable')
+    parser.add_argument('--num_shards',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='Number of Slicer processes running in parallel')
+    parser.add_argument('--corr',
+                        type=str,
+                        default='corr.csv',
+                        help='Path to the output csv with the StudyInstanceUIDs of each case')
+    opt, args = parser.parse_known_args()
+
+    return opt, args
+
+
+def merge_corr(paths_corr, path_corr):
+    """
+    Merge the StudyInstanceUIDs written by several processes into one csv, sorted by case
+    @param paths_corr: csv files of the processes, removed once merged
+    @param path_corr: path to the output csv
+    """
+    rows = []
+    for path in paths_corr:
+        if os.path.isfile(path):
+            with open(path) as f:
+                rows += [[k['case'], k['preop'], k['intraop']] for k in csv.DictReader(f)]
+            os.remove(path)
+    with open(path_corr, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['', 'case', 'preop', 'intraop'])
+        for i, row in enumerate(natsorted(rows, key=lambda k: k[0])):
+            writer.writerow([i] + row)
+
+
+def main():
+    opt, args = parsing_data()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nrrd_to_dicom_img.py')
+    # Downloaded once here rather than by each shard
+    if uses_pixelmed(args):
+        download_pixelmed('pixelmed.jar')
+
+    processes = []
+    for shard in range(opt.num_shards):
+        path_corr = f'{opt.corr}.shard{shard}'
+        cmd = [opt.slicer, '--no-splash', '--no-main-window', '--python-script', script,
+               '--shard', str(shard), '--num_shards', str(opt.num_shards), '--corr', path_corr] + args
+        processes.append((shard, path_corr, subprocess.Popen(cmd)))
+
+    # Merge the StudyInstanceUIDs of all the shards
+    failed = []
+    for shard, path_corr, process in processes:
+        if process.wait()!=0:
+            failed.append((shard, process.returncode))
+    merge_corr([k[1] for k in processes], opt.corr)
+
+    for shard, returncode in failed:
+        print(f'Shard {shard} failed with exit code {returncode}')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
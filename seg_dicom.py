@@ -0,0 +1,262 @@
+import os
+import numpy as np
+import pydicom
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+from dicom_stream import frame_geometry
+from dicom_writer import format_ds, code, set_equipment
+from nrrd_io import read_header, get_geometry, read_volume
+
+SEGMENTATION_STORAGE = '1.2.840.10008.5.1.4.1.1.66.4'
+
+# Attributes of the reference copied into the SEG
+PATIENT_STUDY_ATTRIBUTES = ['PatientName', 'PatientID', 'PatientBirthDate', 'PatientSex',
+                            'StudyInstanceUID', 'StudyID', 'StudyDate', 'StudyTime', 'StudyDescription',
+                            'AccessionNumber', 'ReferringPhysicianName', 'FrameOfReferenceUID']
+
+# Attributes of the metadata templates (json/*.json) written as is
+TEMPLATE_ATTRIBUTES = ['ContentCreatorName', 'ClinicalTrialSeriesID', 'ClinicalTrialTimePointID',
+                       'ClinicalTrialCoordinatingCenterName', 'SeriesDescription', 'SeriesNumber',
+                       'InstanceNumber', 'ContentLabel', 'ContentDescription', 'BodyPartExamined']
+
+
+def _template_code(code_json):
+    # Code of a metadata template, stored as a dictionary
+    return code(code_json['CodeValue'], code_json['CodingSchemeDesignator'], code_json['CodeMeaning'])
+
+
+def rgb_to_dicom_lab(rgb):
+    """
+    Convert a sRGB colour (0-255) into the scaled CIELab values of RecommendedDisplayCIELabValue
+    """
+    rgb = np.asarray(rgb, dtype=float) / 255
+    rgb = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = np.array([[0.4124, 0.3576, 0.1805],
+                    [0.2126, 0.7152, 0.0722],
+                    [0.0193, 0.1192, 0.9505]]) @ rgb
+    xyz = xyz / np.array([0.95047, 1., 1.08883])
+    xyz = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    lab = [116 * xyz[1] - 16, 500 * (xyz[0] - xyz[1]), 200 * (xyz[1] - xyz[2])]
+    return [int(round(lab[0] * 65535 / 100)),
+            int(round((lab[1] + 128) * 65535 / 255)),
+            int(round((lab[2] + 128) * 65535 / 255))]
+
+
+def read_reference(path_ref_folder, reference):
+    """
+    Read the geometry and the instances of a reference series with header-only reads
+    @param path_ref_folder: path to the reference series folder
+    @param reference: series entry of the DICOM index (see dicom_index.index_folder)
+    @return: dictionary with the first header, the orientation, spacing and the list of
+             frames (SOPClassUID, SOPInstanceUID, frame number or None, position)
+    """
+    header = pydicom.dcmread(os.path.join(path_ref_folder, reference['files'][0]), stop_before_pixels=True)
+    if int(header.get('NumberOfFrames', 1)) > 1:
+        # Multi-frame reference (e.g. US): geometry from the functional groups
+        orientation, pixel_spacing, positions = frame_geometry(header)
+        frames = [(header.SOPClassUID, header.SOPInstanceUID, k + 1, position) for k, position in enumerate(positions)]
+    else:
+        orientation = reference['ImageOrientationPatient']
+        pixel_spacing = reference['PixelSpacing']
+        frames = [(reference['SOPClassUID'], uid, None, np.array(position, dtype=float))
+                  for uid, position in zip(reference['instances'], reference['positions'])]
+    orientation = np.array(orientation, dtype=float)
+    return {'header': header,
+            'row': orientation[:3],
+            'column': orientation[3:],
+            'pixel_spacing': [float(k) for k in pixel_spacing],
+            'rows': int(header.Rows),
+            'columns': int(header.Columns),
+            'frames': frames}
+
+
+def match_frames(path_nrrd, reference):
+    """
+    Load a label map and match each of its slices with a frame of the reference
+    @param path_nrrd: path to the label map
+    @param reference: reference returned by read_reference
+    @return: label map (slices, rows, columns) in the reference in-plane orientation,
+             index of the matching reference frame for each slice (-1 if none)
+    """
+    header, offset = read_header(path_nrrd)
+    labels = read_volume(path_nrrd, header, offset)
+    origin, directions, spacing = get_geometry(header)
+    assert labels.shape[1:] == (reference['rows'], reference['columns']), \
+        f'Label map {path_nrrd} has not the size of the reference'
+
+    # Flip the in-plane axes that are opposed to the reference
+    for axis, ref_direction in [(0, reference['row']), (1, reference['column'])]:
+        alignment = np.dot(directions[axis], ref_direction)
+        assert abs(alignment) > 0.99, f'Label map {path_nrrd} is not aligned with the reference'
+        if alignment < 0:
+            labels = np.flip(labels, axis=2 - axis)
+            origin = origin + (header['sizes'][axis] - 1) * spacing[axis] * directions[axis]
+
+    positions = origin[None] + np.arange(labels.shape[0])[:, None] * spacing[2] * directions[2][None]
+    ref_positions = np.array([k[3] for k in reference['frames']])
+    distances = np.linalg.norm(positions[:, None] - ref_positions[None], axis=2)
+    matches = np.argmin(distances, axis=1)
+    tolerance = 0.5 * min(spacing)
+    matches[distances[np.arange(len(matches)), matches] > tolerance] = -1
+    return labels, matches
+
+
+def write_seg(path_nrrd, path_dicom, path_ref_folder, reference, metadata):
+    """
+    Write a DICOM SEG from a label map, without dcmqi.
+    Each segment of the metadata template is stored as binary frames, only the non-empty ones are kept.
+    @param path_nrrd: path to the label map
+    @param path_dicom: path to the output DICOM SEG
+    @param path_ref_folder: path to the reference series folder
+    @param reference: series entry of the DICOM index of the reference
+    @param metadata: metadata template (json/*.json) with the segmentAttributes
+    """
+    reference = read_reference(path_ref_folder, reference)
+    labels, matches = match_frames(path_nrrd, reference)
+    ref_header = reference['header']
+
+    # Binary frames of all the segments, packed at once
+    segments = metadata['segmentAttributes'][0]
+    masks, frame_segments, frame_refs = [], [], []
+    for number, segment in enumerate(segments, start=1):
+        mask = labels == segment['labelID']
+        non_empty = mask.reshape(len(mask), -1).any(axis=1)
+        assert not np.any(non_empty & (matches < 0)), \
+            f'Label map {path_nrrd} has labels outside of the reference'
+        masks.append(mask[non_empty])
+        frame_segments += [number] * int(non_empty.sum())
+        frame_refs += list(matches[non_empty])
+    frames = np.concatenate(masks) if masks else np.zeros((0,) + labels.shape[1:], dtype=bool)
+    pixel_data = np.packbits(frames.ravel(), bitorder='little').tobytes()
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = SEGMENTATION_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+    ds = FileDataset(path_dicom, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = SEGMENTATION_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    for keyword in PATIENT_STUDY_ATTRIBUTES:
+        setattr(ds, keyword, ref_header.get(keyword, ''))
+    ds.Modality = 'SEG'
+    ds.SeriesInstanceUID = generate_uid()
+    for keyword in TEMPLATE_ATTRIBUTES:
+        if keyword in metadata:
+            setattr(ds, keyword, metadata[keyword])
+    ds.ContentDate = ref_header.get('StudyDate', '')
+    ds.ContentTime = ref_header.get('StudyTime', '')
+    set_equipment(ds, 'seg_dicom.py')
+    ds.ImageType = ['DERIVED', 'PRIMARY']
+    ds.SegmentationType = 'BINARY'
+    ds.PositionReferenceIndicator = ''
+
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = reference['rows']
+    ds.Columns = reference['columns']
+    ds.NumberOfFrames = len(frames)
+    ds.BitsAllocated = 1
+    ds.BitsStored = 1
+    ds.HighBit = 0
+    ds.PixelRepresentation = 0
+    ds.LossyImageCompression = '00'
+
+    # Segments
+    segment_items = []
+    for number, segment in enumerate(segments, start=1):
+        item = Dataset()
+        item.SegmentNumber = number
+        item.SegmentLabel = segment.get('SegmentLabel', segment['SegmentDescription'])
+        item.SegmentDescription = segment['SegmentDescription']
+        item.SegmentAlgorithmType = segment['SegmentAlgorithmType']
+        if 'SegmentAlgorithmName' in segment:
+            item.SegmentAlgorithmName = segment['SegmentAlgorithmName']
+        item.SegmentedPropertyCategoryCodeSequence = Sequence([_template_code(segment['SegmentedPropertyCategoryCodeSequence'])])
+        item.SegmentedPropertyTypeCodeSequence = Sequence([_template_code(segment['SegmentedPropertyTypeCodeSequence'])])
+        if 'AnatomicRegionSequence' in segment:
+            item.AnatomicRegionSequence = Sequence([_template_code(segment['AnatomicRegionSequence'])])
+        if 'recommendedDisplayRGBValue' in segment:
+            item.RecommendedDisplayCIELabValue = rgb_to_dicom_lab(segment['recommendedDisplayRGBValue'])
+        segment_items.append(item)
+    ds.SegmentSequence = Sequence(segment_items)
+
+    # Referenced instances
+    referenced_series = Dataset()
+    referenced_series.SeriesInstanceUID = ref_header.SeriesInstanceUID
+    referenced_instances = []
+    for sop_class, sop_instance in dict.fromkeys((k[0], k[1]) for k in reference['frames']):
+        item = Dataset()
+        item.ReferencedSOPClassUID = sop_class
+        item.ReferencedSOPInstanceUID = sop_instance
+        referenced_instances.append(item)
+    referenced_series.ReferencedInstanceSequence = Sequence(referenced_instances)
+    ds.ReferencedSeriesSequence = Sequence([referenced_series])
+
+    # Dimensions: segment number and position of the frame
+    dimension_organization_uid = generate_uid()
+    dimension_organization = Dataset()
+    dimension_organization.DimensionOrganizationUID = dimension_organization_uid
+    ds.DimensionOrganizationSequence = Sequence([dimension_organization])
+    dimensions = []
+    for pointer, group in [('ReferencedSegmentNumber', 'SegmentIdentificationSequence'),
+                           ('ImagePositionPatient', 'PlanePositionSequence')]:
+        dimension = Dataset()
+        dimension.DimensionOrganizationUID = dimension_organization_uid
+        dimension.DimensionIndexPointer = tag_for_keyword(pointer)
+        dimension.FunctionalGroupPointer = tag_for_keyword(group)
+        dimensions.append(dimension)
+    ds.DimensionIndexSequence = Sequence(dimensions)
+
+    # Geometry shared by all the frames
+    shared = Dataset()
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = [format_ds(k) for k in np.concatenate([reference['row'], reference['column']])]
+    shared.PlaneOrientationSequence = Sequence([plane_orientation])
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = reference['pixel_spacing']
+    normal = np.cross(reference['row'], reference['column'])
+    ref_distances = np.array([np.dot(normal, k[3]) for k in reference['frames']])
+    slice_spacing = float(np.median(np.diff(np.sort(ref_distances)))) if len(ref_distances) > 1 else 1.
+    pixel_measures.SliceThickness = format_ds(slice_spacing)
+    pixel_measures.SpacingBetweenSlices = format_ds(slice_spacing)
+    shared.PixelMeasuresSequence = Sequence([pixel_measures])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    # Per-frame references to the source frames
+    position_indexes = np.empty(len(ref_distances), dtype=int)
+    position_indexes[np.argsort(ref_distances, kind='stable')] = np.arange(1, len(ref_distances) + 1)
+    per_frames = []
+    for number, ref in zip(frame_segments, frame_refs):
+        sop_class, sop_instance, frame_number, position = reference['frames'][ref]
+        per_frame = Dataset()
+        source = Dataset()
+        source.ReferencedSOPClassUID = sop_class
+        source.ReferencedSOPInstanceUID = sop_instance
+        if frame_number is not None:
+            source.ReferencedFrameNumber = frame_number
+        source.PurposeOfReferenceCodeSequence = Sequence([code('121322', 'DCM', 'Source image for image processing operation')])
+        derivation = Dataset()
+        derivation.SourceImageSequence = Sequence([source])
+        derivation.DerivationCodeSequence = Sequence([code('113076', 'DCM', 'Segmentation')])
+        per_frame.DerivationImageSequence = Sequence([derivation])
+        frame_content = Dataset()
+        frame_content.DimensionIndexValues = [number, int(position_indexes[ref])]
+        per_frame.FrameContentSequence = Sequence([frame_content])
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = [format_ds(k) for k in position]
+        per_frame.PlanePositionSequence = Sequence([plane_position])
+        segment_identification = Dataset()
+        segment_identification.ReferencedSegmentNumber = number
+        per_frame.SegmentIdentificationSequence = Sequence([segment_identification])
+        per_frames.append(per_frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(per_frames)
+
+    ds.PixelData = pixel_data + (b'\0' if len(pixel_data) % 2 else b'')
+    ds['PixelData'].VR = 'OB'
+    pydicom.dcmwrite(path_dicom, ds, write_like_original=False)
@@ -0,0 +1,25 @@
+import os
+import sys
+import pytest
+
+PATH_REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PATH_REPO)
+
+from synthetic import make_volume, write_mr_series
+
+
+@pytest.fixture
+def mr_series(tmp_path):
+    """
+    Folder of a synthetic single-frame MR series
+    """
+    path_folder = str(tmp_path / 'mr')
+    write_mr_series(path_folder)
+    return path_folder
+
+
+@pytest.fixture
+def us_nrrd(tmp_path):
+    path = str(tmp_path / 'us.nrrd')
+    make_volume(path)
+    return path
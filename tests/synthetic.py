@@ -0,0 +1,107 @@
+import os
+import numpy as np
+import SimpleITK as sitk
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+from us_dicom import write_us_dicom
+
+MR_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+# Rotation of 36.87 degrees around the z axis, rows of the LPS directions
+DIRECTIONS = np.array([[0.8, -0.6, 0.], [0.6, 0.8, 0.], [0., 0., 1.]])
+
+
+def make_volume(path, shape=(7, 6, 5), dtype=np.uint8, spacing=(0.3, 0.4, 0.5), origin=(10., -20., 30.), seed=0):
+    """
+    Write a synthetic volume with an oblique geometry
+    @param path: path to the output NRRD/NIfTI file
+    @param shape: columns, rows, slices
+    @return: SITK image written
+    """
+    rng = np.random.default_rng(seed)
+    voxels = rng.integers(0, min(np.iinfo(dtype).max, 4000), size=shape[::-1]).astype(dtype)
+    image = sitk.GetImageFromArray(voxels)
+    image.SetSpacing(spacing)
+    image.SetOrigin(origin)
+    image.SetDirection(DIRECTIONS.T.flatten().tolist())
+    sitk.WriteImage(image, path, useCompression=True)
+    return image
+
+
+def write_mr_series(path_folder, shape=(32, 28, 12), spacing=(0.9, 0.8, 1.1), origin=(-14., -11., -6.), seed=0,
+                    patient_id='001', study_id='Preop', series_number=1, series_description='ceT1',
+                    study_instance_uid=None):
+    """
+    Write a synthetic single-frame MR series with an oblique geometry, as exported by 3D Slicer
+    @param path_folder: output folder of the series
+    @param shape: columns, rows, slices
+    @return: voxels (slices, rows, columns)
+    """
+    rng = np.random.default_rng(seed)
+    z, y, x = np.ogrid[-1:1:shape[2] * 1j, -1:1:shape[1] * 1j, -1:1:shape[0] * 1j]
+    radius = np.sqrt((x / 0.8) ** 2 + (y / 0.9) ** 2 + (z / 0.85) ** 2)
+    volume = (np.where(radius < 1, 600 + 300 * np.cos(6 * radius), 0) + rng.normal(0, 20, radius.shape)).astype(np.int16)
+    os.makedirs(path_folder, exist_ok=True)
+    series_instance_uid, frame_of_reference_uid = generate_uid(), generate_uid()
+    study_instance_uid = study_instance_uid or generate_uid()
+    for k, pixels in enumerate(volume):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MR_STORAGE
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+        ds = FileDataset(None, {}, file_meta=file_meta, preamble=b'\0' * 128)
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.SOPClassUID = MR_STORAGE
+        ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        ds.PatientName = f'CASE^{patient_id}'
+        ds.PatientID = patient_id
+        ds.StudyInstanceUID = study_instance_uid
+        ds.StudyID = study_id
+        ds.StudyDate = '19990101'
+        ds.SeriesInstanceUID = series_instance_uid
+        ds.SeriesNumber = series_number
+        ds.SeriesDescription = series_description
+        ds.Modality = 'MR'
+        ds.FrameOfReferenceUID = frame_of_reference_uid
+        ds.InstanceNumber = k + 1
+        ds.ImagePositionPatient = [float(f'{v:.10g}') for v in np.array(origin) + k * spacing[2] * DIRECTIONS[2]]
+        ds.ImageOrientationPatient = [float(v) for v in np.concatenate([DIRECTIONS[0], DIRECTIONS[1]])]
+        ds.PixelSpacing = [float(spacing[1]), float(spacing[0])]
+        ds.SliceThickness = float(spacing[2])
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.PixelData = np.ascontiguousarray(pixels, dtype='<i2').tobytes()
+        ds.save_as(os.path.join(path_folder, f'IMG{k + 1:04d}.dcm'), write_like_original=False)
+    return volume
+
+
+def write_us(path_nrrd, path_dicom):
+    """
+    Write a US volume with the native Enhanced US Volume writer
+    """
+    write_us_dicom(path_nrrd, path_dicom, patient_name='CASE^001', patient_id='001', study_id='Intraop',
+                   series_number=1, instance_number=1, study_instance_uid=generate_uid(),
+                   study_description='Intraop', series_description='US_predura')
+
+
+def strip_geometry(path_dicom, keep):
+    """
+    Keep only some of the geometry functional groups of a multi-frame US file: the Patient ones
+    (like the files of the first native writer) or the Volume ones (like the files of PixelMed)
+    @param keep: 'patient' or 'volume'
+    """
+    ds = pydicom.dcmread(path_dicom)
+    shared = ds.SharedFunctionalGroupsSequence[0]
+    removed = ['PlaneOrientationVolumeSequence', 'PlanePositionVolumeSequence'] if keep == 'patient' else \
+        ['PlaneOrientationSequence', 'PlanePositionSequence']
+    delattr(shared, removed[0])
+    for frame in ds.PerFrameFunctionalGroupsSequence:
+        delattr(frame, removed[1])
+    ds.save_as(path_dicom)
@@ -0,0 +1,44 @@
+import os
+import argparse
+import zipfile
+import importlib
+import pytest
+from synthetic import write_mr_series
+
+conversion = importlib.import_module('dicom_to_nifti-nrrd_img')
+
+
+def write_tree(path_root):
+    """
+    DICOM tree of one case with a Preop and an Intraop series, and a README next to the case
+    """
+    for session, series in [('19990101-Preop', '1-ceT1'), ('19990101-Intraop', '4-ceT1')]:
+        write_mr_series(os.path.join(path_root, '001-CASE^001', session, series), shape=(8, 6, 3))
+    with open(os.path.join(path_root, 'README.txt'), 'w') as f:
+        f.write('ReMIND')
+
+
+def list_units(path_dicom, path_output, archive_root=''):
+    opt = argparse.Namespace(path_dicom=path_dicom, path_output=path_output, index=None, index_workers=1,
+                             archive_root=archive_root)
+    return conversion.list_series(opt, 'nrrd')
+
+
+@pytest.mark.parametrize('archive_root', ['', 'manifest-1/ReMIND'])
+def test_zip_with_files_at_the_root(tmp_path, archive_root):
+    path_tree = str(tmp_path / 'tree')
+    write_tree(os.path.join(path_tree, archive_root))
+    with open(os.path.join(path_tree, 'LICENSE.txt'), 'w') as f:
+        f.write('license')
+    path_zip = str(tmp_path / 'ReMIND.zip')
+    with zipfile.ZipFile(path_zip, 'w') as archive:
+        for folder, _, files in os.walk(path_tree):
+            for name in files:
+                archive.write(os.path.join(folder, name), os.path.relpath(os.path.join(folder, name), path_tree))
+
+    cases, units = list_units(path_zip, str(tmp_path / 'out_zip'), archive_root)
+    cases_disk, units_disk = list_units(os.path.join(path_tree, archive_root), str(tmp_path / 'out_disk'))
+    assert cases == cases_disk == ['001-CASE^001']
+    assert len(units) == len(units_disk) == 2
+    assert [k['members'] for k in units] == [[os.path.relpath(f, os.path.join(path_tree, archive_root)) for f in k['inputs']]
+                                             for k in units_disk]
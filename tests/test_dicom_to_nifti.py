@@ -0,0 +1,55 @@
+import os
+import importlib
+import SimpleITK as sitk
+import pytest
+from dicom_index import index_folder
+from remind_dataset import read_entry
+from verify_conversion import compare_geometry, compare_voxels
+from synthetic import write_us, strip_geometry
+
+conversion = importlib.import_module('dicom_to_nifti-nrrd_img')
+
+
+@pytest.mark.parametrize('keep', [None, 'patient', 'volume'])
+def test_default_and_streaming_geometry(us_nrrd, tmp_path, keep):
+    path_series = tmp_path / 'dicom'
+    path_series.mkdir()
+    write_us(us_nrrd, str(path_series / 'us.dcm'))
+    if keep is not None:
+        strip_geometry(str(path_series / 'us.dcm'), keep)
+    series = list(index_folder(str(path_series)).values())[0]
+    source = read_entry(us_nrrd)
+    for name, memory_budget in [('default', None), ('streaming', 100)]:
+        output_file = str(tmp_path / f'{name}.nrrd')
+        unit = {'inputs': [str(path_series / k) for k in series['files']], 'series': series, 'output_file': output_file}
+        conversion.convert_series(unit, memory_budget)
+        converted = read_entry(output_file)
+        assert compare_geometry(source, converted, 1e-4) == [], name
+        assert compare_voxels(source, converted)[2] == [], name
+
+
+def baseline_nrrd(path_series, output_file):
+    """
+    NRRD output of the baseline script: GDCM series scan, gzip NIfTI round trip and compressed NRRD written by ITK
+    """
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(path_series))
+    image = reader.Execute()
+    temp_file = output_file.replace('.nrrd', '_temp.nii.gz')
+    sitk.WriteImage(image, temp_file, useCompression=True)
+    image = sitk.ReadImage(temp_file)
+    sitk.WriteImage(image, output_file, useCompression=True)
+    os.remove(temp_file)
+
+
+def test_nrrd_same_bytes_as_baseline(mr_series, tmp_path):
+    path_baseline = str(tmp_path / 'baseline.nrrd')
+    baseline_nrrd(mr_series, path_baseline)
+    series = list(index_folder(mr_series).values())[0]
+    unit = {'inputs': [os.path.join(mr_series, k) for k in series['files']], 'series': series,
+            'output_file': str(tmp_path / 'output.nrrd')}
+    conversion.convert_series(unit)
+    with open(path_baseline, 'rb') as f_baseline, open(unit['output_file'], 'rb') as f_output:
+        assert f_output.read() == f_baseline.read()
+    # The temporary NIfTI file of the round trip is removed
+    assert not [k for k in os.listdir(tmp_path) if k.startswith('.write_nrrd-')]
@@ -0,0 +1,34 @@
+import os
+import pytest
+from manifest import replace_folder
+
+
+def write_series(path_folder, names):
+    os.makedirs(path_folder)
+    for name in names:
+        with open(os.path.join(path_folder, name), 'w') as f:
+            f.write(path_folder)
+
+
+def test_replace_folder_over_earlier_runs(tmp_path):
+    path_study = tmp_path / 'study'
+    path_final = str(path_study / '1-ceT1')
+    # First run, then two runs over the existing output tree (e.g. --resume on a changed NRRD, --force)
+    for run, names in enumerate([['IMG0001.dcm', 'IMG0002.dcm'], ['IMG0001.dcm'], ['IMG0003.dcm']]):
+        path_export = str(path_study / f'ScalarVolume_{run}')
+        write_series(path_export, names)
+        replace_folder(path_export, path_final)
+        assert sorted(os.listdir(path_final)) == names
+        assert not os.path.exists(path_export)
+    with open(os.path.join(path_final, 'IMG0003.dcm')) as f:
+        assert f.read() == str(path_study / 'ScalarVolume_2')
+    assert sorted(os.listdir(path_study)) == ['1-ceT1']
+
+
+def test_replace_folder_keeps_the_old_folder_on_error(tmp_path):
+    path_final = str(tmp_path / '1-ceT1')
+    write_series(path_final, ['IMG0001.dcm'])
+    with pytest.raises(OSError):
+        replace_folder(str(tmp_path / 'missing'), path_final)
+    assert os.listdir(path_final) == ['IMG0001.dcm']
+    assert os.listdir(tmp_path) == ['1-ceT1']
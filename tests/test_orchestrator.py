@@ -0,0 +1,19 @@
+import time
+from orchestrator import Scheduler
+
+
+def test_after_runs_whatever_the_status():
+    done = []
+    def fail():
+        time.sleep(0.1)
+        done.append('img')
+        raise RuntimeError('export failed')
+    with Scheduler() as scheduler:
+        scheduler.add('img', 'slicer', func=fail)
+        scheduler.add('seg/deps', 'seg', func=lambda: done.append('deps'), deps=['img'])
+        scheduler.add('seg/after', 'seg', func=lambda: done.append('after'), after=['img'])
+        results = scheduler.wait()
+    assert results['img']['status'] == 'failed'
+    assert results['seg/deps']['status'] == 'skipped'
+    assert results['seg/after']['status'] == 'ok'
+    assert done == ['img', 'after']
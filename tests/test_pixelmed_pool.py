@@ -0,0 +1,32 @@
+import os
+import io
+import urllib.request
+import pytest
+from pixelmed_pool import download_pixelmed, uses_pixelmed
+
+
+def test_download_pixelmed(tmp_path, monkeypatch):
+    calls = []
+    def urlopen(url):
+        calls.append(url)
+        return io.BytesIO(b'jar')
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+    path_jar = str(tmp_path / 'pixelmed.jar')
+    download_pixelmed(path_jar)
+    download_pixelmed(path_jar)
+    assert len(calls) == 1
+    assert os.listdir(tmp_path) == ['pixelmed.jar']
+
+
+def test_download_pixelmed_keeps_no_partial_jar(tmp_path, monkeypatch):
+    # Failure while writing the jar: not bytes
+    monkeypatch.setattr(urllib.request, 'urlopen', lambda url: io.StringIO('jar'))
+    with pytest.raises(TypeError):
+        download_pixelmed(str(tmp_path / 'pixelmed.jar'))
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('args,expected', [([], True), (['--us_engine', 'native'], False),
+                                           (['--us_engine=native'], False), (['--us_engine', 'pixelmed'], True)])
+def test_uses_pixelmed(args, expected):
+    assert uses_pixelmed(args) == expected
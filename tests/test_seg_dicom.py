@@ -0,0 +1,144 @@
+import os
+import shutil
+import subprocess
+import numpy as np
+import SimpleITK as sitk
+import pydicom
+import pytest
+from dicom_index import index_folder
+from nrrd_to_dicom_seg import load_templates, get_dcmqi_command, write_seg_metadata
+from seg_dicom import write_seg
+from synthetic import write_us, strip_geometry
+
+TEMPLATES = load_templates()
+PATH_DCMQI = os.environ.get('DCMQI_ITKIMAGE2SEGIMAGE', shutil.which('itkimage2segimage'))
+
+
+def read_series(path_series):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(path_series))
+    return reader.Execute()
+
+
+def write_label_map(reference, path_nrrd):
+    """
+    Label map on the grid of a reference image: a blob on the central slices, the others empty
+    @param reference: SITK image of the reference
+    @return: labels (slices, rows, columns)
+    """
+    columns, rows, slices = reference.GetSize()
+    z, y, x = np.ogrid[-1:1:slices * 1j, -1:1:rows * 1j, -1:1:columns * 1j]
+    labels = ((x / 0.6) ** 2 + (y / 0.4) ** 2 + (z / 0.5) ** 2 < 1).astype(np.uint8)
+    image = sitk.GetImageFromArray(labels)
+    image.CopyInformation(reference)
+    sitk.WriteImage(image, path_nrrd, useCompression=True)
+    return labels
+
+
+def seg_frames(ds):
+    """
+    Pixel frames of a SEG by segment number and referenced SOPInstanceUID
+    """
+    pixels = ds.pixel_array.reshape(int(ds.NumberOfFrames), ds.Rows, ds.Columns)
+    frames = {}
+    for frame, pixel in zip(ds.PerFrameFunctionalGroupsSequence, pixels):
+        source = frame.DerivationImageSequence[0].SourceImageSequence[0]
+        frames[(frame.SegmentIdentificationSequence[0].ReferencedSegmentNumber, source.ReferencedSOPInstanceUID)] = pixel
+    return frames
+
+
+def segment_codes(ds):
+    return [(k.SegmentNumber, k.SegmentAlgorithmType,
+             *[(c.CodeValue, c.CodingSchemeDesignator) for sequence in ['SegmentedPropertyCategoryCodeSequence',
+                                                                        'SegmentedPropertyTypeCodeSequence',
+                                                                        'AnatomicRegionSequence']
+               for c in k.get(sequence, [])])
+            for k in ds.SegmentSequence]
+
+
+@pytest.mark.parametrize('structure', sorted(TEMPLATES))
+def test_native_seg(mr_series, tmp_path, structure):
+    path_nrrd, path_seg = str(tmp_path / f'{structure}.nrrd'), str(tmp_path / f'{structure}.dcm')
+    labels = write_label_map(read_series(mr_series), path_nrrd)
+    reference = list(index_folder(mr_series).values())[0]
+    write_seg(path_nrrd, path_seg, mr_series, reference, TEMPLATES[structure])
+    ds = pydicom.dcmread(path_seg)
+
+    ref_header = pydicom.dcmread(os.path.join(mr_series, reference['files'][0]), stop_before_pixels=True)
+    for keyword in ['Manufacturer', 'ManufacturerModelName', 'DeviceSerialNumber', 'SoftwareVersions']:
+        assert ds.get(keyword), f'{keyword} is empty'
+    assert ds.FrameOfReferenceUID == ref_header.FrameOfReferenceUID
+
+    # Segments and their codes, as in the template
+    segments = TEMPLATES[structure]['segmentAttributes'][0]
+    assert len(ds.SegmentSequence) == len(segments)
+    for item, segment in zip(ds.SegmentSequence, segments):
+        assert item.SegmentDescription == segment['SegmentDescription']
+        for sequence in ['SegmentedPropertyCategoryCodeSequence', 'SegmentedPropertyTypeCodeSequence', 'AnatomicRegionSequence']:
+            assert (sequence in item) == (sequence in segment), sequence
+            if sequence not in segment:
+                continue
+            assert item[sequence][0].CodeValue == segment[sequence]['CodeValue']
+            assert item[sequence][0].CodingSchemeDesignator == segment[sequence]['CodingSchemeDesignator']
+
+    # References to the series and to the source frame of each SEG frame, and their pixels
+    assert ds.ReferencedSeriesSequence[0].SeriesInstanceUID == ref_header.SeriesInstanceUID
+    assert [k.ReferencedSOPInstanceUID for k in ds.ReferencedSeriesSequence[0].ReferencedInstanceSequence] == reference['instances']
+    non_empty = [k for k in range(len(labels)) if labels[k].any()]
+    frames = seg_frames(ds)
+    assert sorted(frames) == sorted((1, reference['instances'][k]) for k in non_empty)
+    for k in non_empty:
+        np.testing.assert_array_equal(frames[(1, reference['instances'][k])], labels[k] == 1)
+    for frame in ds.PerFrameFunctionalGroupsSequence:
+        instance = frame.DerivationImageSequence[0].SourceImageSequence[0].ReferencedSOPInstanceUID
+        position = reference['positions'][reference['instances'].index(instance)]
+        np.testing.assert_allclose(frame.PlanePositionSequence[0].ImagePositionPatient, position, atol=1e-4)
+
+
+@pytest.mark.parametrize('keep', [None, 'patient', 'volume'])
+def test_native_seg_us_reference(us_nrrd, tmp_path, keep):
+    path_series = tmp_path / 'us'
+    path_series.mkdir()
+    write_us(us_nrrd, str(path_series / 'us.dcm'))
+    if keep is not None:
+        strip_geometry(str(path_series / 'us.dcm'), keep)
+    path_nrrd, path_seg = str(tmp_path / 'tumor.nrrd'), str(tmp_path / 'tumor.dcm')
+    labels = write_label_map(sitk.ReadImage(us_nrrd), path_nrrd)
+    reference = list(index_folder(str(path_series)).values())[0]
+    write_seg(path_nrrd, path_seg, str(path_series), reference, TEMPLATES['tumor'])
+    ds = pydicom.dcmread(path_seg)
+
+    # Each SEG frame references the frame of the US volume at the same position
+    non_empty = [k for k in range(len(labels)) if labels[k].any()]
+    pixels = ds.pixel_array.reshape(int(ds.NumberOfFrames), ds.Rows, ds.Columns)
+    frame_numbers = [k.DerivationImageSequence[0].SourceImageSequence[0].ReferencedFrameNumber
+                     for k in ds.PerFrameFunctionalGroupsSequence]
+    assert frame_numbers == [k + 1 for k in non_empty]
+    for k, frame_pixels in zip(non_empty, pixels):
+        np.testing.assert_array_equal(frame_pixels, labels[k] == 1)
+
+
+@pytest.mark.skipif(PATH_DCMQI is None or not os.path.isfile(PATH_DCMQI),
+                    reason='dcmqi itkimage2segimage (in the PATH or DCMQI_ITKIMAGE2SEGIMAGE) is required')
+@pytest.mark.parametrize('structure', sorted(TEMPLATES))
+def test_same_as_dcmqi(mr_series, tmp_path, structure):
+    path_nrrd = str(tmp_path / f'{structure}.nrrd')
+    write_label_map(read_series(mr_series), path_nrrd)
+    reference = list(index_folder(mr_series).values())[0]
+    path_native, path_dcmqi = str(tmp_path / 'native.dcm'), str(tmp_path / 'dcmqi.dcm')
+    write_seg(path_nrrd, path_native, mr_series, reference, TEMPLATES[structure])
+    info = {'path_ref_folder': mr_series, 'path_dicom_seg': path_dcmqi}
+    path_metadata = write_seg_metadata(TEMPLATES[structure])
+    try:
+        subprocess.run(get_dcmqi_command(path_nrrd, info, PATH_DCMQI, path_metadata), check=True)
+    finally:
+        os.remove(path_metadata)
+    native, dcmqi = pydicom.dcmread(path_native), pydicom.dcmread(path_dcmqi)
+
+    assert segment_codes(native) == segment_codes(dcmqi)
+    assert native.FrameOfReferenceUID == dcmqi.FrameOfReferenceUID
+    assert native.ReferencedSeriesSequence[0].SeriesInstanceUID == dcmqi.ReferencedSeriesSequence[0].SeriesInstanceUID
+    native_frames, dcmqi_frames = seg_frames(native), seg_frames(dcmqi)
+    assert sorted(native_frames) == sorted(dcmqi_frames)
+    for key, pixels in native_frames.items():
+        np.testing.assert_array_equal(pixels, dcmqi_frames[key])
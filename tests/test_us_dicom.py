@@ -0,0 +1,62 @@
+import os
+import shutil
+import subprocess
+import numpy as np
+import SimpleITK as sitk
+import pydicom
+import pytest
+from conftest import PATH_REPO
+from pixelmed_pool import nrrd_to_dicom_command
+from dicom_stream import frame_geometry
+from us_dicom import ENHANCED_US_VOLUME_STORAGE
+from synthetic import write_us
+
+PATH_JAR = os.environ.get('PIXELMED_JAR', os.path.join(PATH_REPO, 'pixelmed.jar'))
+
+
+def test_only_iod_attributes(us_nrrd, tmp_path):
+    path_dicom = str(tmp_path / 'us.dcm')
+    write_us(us_nrrd, path_dicom)
+    ds = pydicom.dcmread(path_dicom)
+    # The geometry is only in the functional groups, the top-level attributes are not part of the IOD
+    for keyword in ['PixelSpacing', 'SpacingBetweenSlices', 'ImagePositionPatient', 'ImageOrientationPatient']:
+        assert keyword not in ds
+    np.testing.assert_array_equal(ds.pixel_array, sitk.GetArrayFromImage(sitk.ReadImage(us_nrrd)))
+
+
+def test_volume_functional_groups(us_nrrd, tmp_path):
+    path_dicom = str(tmp_path / 'us.dcm')
+    write_us(us_nrrd, path_dicom)
+    ds = pydicom.dcmread(path_dicom)
+    assert ds.SOPClassUID == ENHANCED_US_VOLUME_STORAGE
+    orientation, spacing, positions = frame_geometry(ds)
+    assert 'PlaneOrientationVolumeSequence' in ds.SharedFunctionalGroupsSequence[0]
+    np.testing.assert_allclose(orientation, [0.8, -0.6, 0., 0.6, 0.8, 0.])
+    np.testing.assert_allclose(spacing, [0.4, 0.3])
+    np.testing.assert_allclose(positions[:, 2], 30. + 0.5 * np.arange(5))
+    for frame in ds.PerFrameFunctionalGroupsSequence:
+        assert frame.PlanePositionVolumeSequence[0].ImagePositionVolume == frame.PlanePositionSequence[0].ImagePositionPatient
+
+
+def test_enhanced_general_equipment(us_nrrd, tmp_path):
+    path_dicom = str(tmp_path / 'us.dcm')
+    write_us(us_nrrd, path_dicom)
+    ds = pydicom.dcmread(path_dicom, stop_before_pixels=True)
+    for keyword in ['Manufacturer', 'ManufacturerModelName', 'DeviceSerialNumber', 'SoftwareVersions']:
+        assert ds.get(keyword), f'{keyword} is empty'
+
+
+@pytest.mark.skipif(shutil.which('java') is None or not os.path.isfile(PATH_JAR),
+                    reason='java and pixelmed.jar (or PIXELMED_JAR) are required')
+def test_same_as_pixelmed(us_nrrd, tmp_path):
+    path_native, path_pixelmed = str(tmp_path / 'native.dcm'), str(tmp_path / 'pixelmed.dcm')
+    write_us(us_nrrd, path_native)
+    subprocess.run(nrrd_to_dicom_command(PATH_JAR, [us_nrrd, path_pixelmed, 'CASE^001', '001', 'Intraop', '1', '1']),
+                   check=True)
+    native, pixelmed = pydicom.dcmread(path_native), pydicom.dcmread(path_pixelmed)
+    for keyword in ['SOPClassUID', 'Rows', 'Columns', 'NumberOfFrames', 'SamplesPerPixel', 'PhotometricInterpretation',
+                    'BitsAllocated', 'BitsStored', 'PixelRepresentation']:
+        assert native.get(keyword) == pixelmed.get(keyword), keyword
+    for a, b in zip(frame_geometry(native), frame_geometry(pixelmed)):
+        np.testing.assert_allclose(a, b, atol=1e-4)
+    np.testing.assert_array_equal(native.pixel_array, pixelmed.pixel_array)
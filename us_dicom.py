@@ -0,0 +1,163 @@
+import struct
+import numpy as np
+import pydicom
+from pydicom.datadict import tag_for_keyword
+from pydicom.dataset import Dataset, FileDataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+from dicom_writer import format_ds, code, set_equipment
+from nrrd_io import read_header, get_geometry, iter_frames
+
+ENHANCED_US_VOLUME_STORAGE = '1.2.840.10008.5.1.4.1.1.6.2'
+
+
+def write_us_dicom(path_nrrd,
+                   path_dicom,
+                   patient_name,
+                   patient_id,
+                   study_id,
+                   series_number,
+                   instance_number,
+                   study_instance_uid,
+                   study_description,
+                   series_description,
+                   modality='US',
+                   study_date='19990101'):
+    """
+    Write a 3D US NRRD volume as a multi-frame Enhanced US Volume DICOM file, with all the
+    attributes set in one pass. Frames are streamed from the NRRD payload to the output file,
+    the volume is never loaded in memory.
+    @param path_nrrd: path to the input nrrd file
+    @param path_dicom: path to the output dicom file
+    @param patient_name: Name of the patient
+    @param patient_id: id of the patient
+    @param study_id: id of the study
+    @param series_number: number of the series (e.g. 1 for predura US)
+    @param instance_number: instance number, often same as series number
+    @param study_instance_uid: study instance uid - needs to be the same for all files in the same study
+    @param study_description: study description
+    @param series_description: series description
+    @param modality: modality of the dicom file
+    @param study_date: study date
+    """
+    header, offset = read_header(path_nrrd)
+    assert len(header['sizes']) == 3, f'Only 3D volumes are supported: {path_nrrd}'
+    dtype = header['type']
+    assert dtype.kind in 'ui' and dtype.itemsize <= 2, f'Only 8 and 16 bits integer volumes are supported: {path_nrrd}'
+    columns, rows, number_frames = header['sizes']
+    origin, directions, spacing = get_geometry(header)
+
+    file_meta = FileMetaDataset()
+    file_meta.MediaStorageSOPClassUID = ENHANCED_US_VOLUME_STORAGE
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+
+    ds = FileDataset(path_dicom, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    # Patient, study and series
+    ds.SOPClassUID = ENHANCED_US_VOLUME_STORAGE
+    ds.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+    ds.PatientName = patient_name
+    ds.PatientID = patient_id
+    ds.PatientBirthDate = ''
+    ds.PatientSex = ''
+    ds.StudyInstanceUID = study_instance_uid
+    ds.StudyID = study_id
+    ds.StudyDate = study_date
+    ds.StudyTime = ''
+    ds.StudyDescription = study_description
+    ds.AccessionNumber = ''
+    ds.ReferringPhysicianName = ''
+    ds.SeriesInstanceUID = generate_uid()
+    ds.SeriesNumber = series_number
+    ds.SeriesDescription = series_description
+    ds.Modality = modality
+    ds.InstanceNumber = instance_number
+    ds.ContentDate = study_date
+    ds.ContentTime = ''
+    ds.AcquisitionDateTime = study_date
+    set_equipment(ds, 'us_dicom.py')
+    ds.ImageType = ['DERIVED', 'PRIMARY', 'VOLUME', 'NONE']
+    ds.FrameOfReferenceUID = generate_uid()
+    ds.PositionReferenceIndicator = ''
+
+    # Image pixel
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.Rows = rows
+    ds.Columns = columns
+    ds.NumberOfFrames = number_frames
+    ds.BitsAllocated = 8 * dtype.itemsize
+    ds.BitsStored = 8 * dtype.itemsize
+    ds.HighBit = 8 * dtype.itemsize - 1
+    ds.PixelRepresentation = 1 if dtype.kind == 'i' else 0
+
+    # Multi-frame dimensions: frames are ordered along the third axis of the volume
+    ds.DimensionOrganizationType = '3D'
+    dimension_organization_uid = generate_uid()
+    dimension_organization = Dataset()
+    dimension_organization.DimensionOrganizationUID = dimension_organization_uid
+    ds.DimensionOrganizationSequence = Sequence([dimension_organization])
+    dimensions = []
+    for pointer in ['StackID', 'InStackPositionNumber']:
+        dimension = Dataset()
+        dimension.DimensionOrganizationUID = dimension_organization_uid
+        dimension.DimensionIndexPointer = tag_for_keyword(pointer)
+        dimension.FunctionalGroupPointer = tag_for_keyword('FrameContentSequence')
+        dimensions.append(dimension)
+    ds.DimensionIndexSequence = Sequence(dimensions)
+
+    # Geometry shared by all the frames, in the Volume functional groups of the Enhanced US Volume IOD
+    # (the volume frame of reference is the patient one) and in the Patient ones read by dicom_stream
+    orientation = [format_ds(k) for k in np.concatenate([directions[0], directions[1]])]
+    positions = [[format_ds(v) for v in origin + k * spacing[2] * directions[2]] for k in range(number_frames)]
+    shared = Dataset()
+    pixel_measures = Dataset()
+    pixel_measures.PixelSpacing = [format_ds(spacing[1]), format_ds(spacing[0])]
+    pixel_measures.SliceThickness = format_ds(spacing[2])
+    pixel_measures.SpacingBetweenSlices = format_ds(spacing[2])
+    shared.PixelMeasuresSequence = Sequence([pixel_measures])
+    plane_orientation = Dataset()
+    plane_orientation.ImageOrientationPatient = orientation
+    shared.PlaneOrientationSequence = Sequence([plane_orientation])
+    plane_orientation_volume = Dataset()
+    plane_orientation_volume.ImageOrientationVolume = orientation
+    shared.PlaneOrientationVolumeSequence = Sequence([plane_orientation_volume])
+    frame_anatomy = Dataset()
+    frame_anatomy.AnatomicRegionSequence = Sequence([code('12738006', 'SCT', 'Brain')])
+    frame_anatomy.FrameLaterality = 'U'
+    shared.FrameAnatomySequence = Sequence([frame_anatomy])
+    ds.SharedFunctionalGroupsSequence = Sequence([shared])
+
+    # Position of each frame
+    per_frames = []
+    for k in range(number_frames):
+        per_frame = Dataset()
+        frame_content = Dataset()
+        frame_content.StackID = '1'
+        frame_content.InStackPositionNumber = k + 1
+        frame_content.DimensionIndexValues = [1, k + 1]
+        per_frame.FrameContentSequence = Sequence([frame_content])
+        plane_position = Dataset()
+        plane_position.ImagePositionPatient = positions[k]
+        per_frame.PlanePositionSequence = Sequence([plane_position])
+        plane_position_volume = Dataset()
+        plane_position_volume.ImagePositionVolume = positions[k]
+        per_frame.PlanePositionVolumeSequence = Sequence([plane_position_volume])
+        per_frames.append(per_frame)
+    ds.PerFrameFunctionalGroupsSequence = Sequence(per_frames)
+
+    # The header is written by pydicom, then the pixel data element is appended frame by frame
+    length = rows * columns * number_frames * dtype.itemsize
+    with open(path_dicom, 'wb') as f:
+        pydicom.dcmwrite(f, ds, write_like_original=False)
+        f.write(struct.pack('<HH', 0x7FE0, 0x0010))
+        f.write(b'OB\0\0' if dtype.itemsize == 1 else b'OW\0\0')
+        f.write(struct.pack('<I', length + length % 2))
+        for frame in iter_frames(path_nrrd, header, offset):
+            f.write(np.ascontiguousarray(frame, dtype=dtype.newbyteorder('<')).tobytes())
+        if length % 2:
+            f.write(b'\0')
@@ -0,0 +1,188 @@
+import os
+import sys
+import json
+import zlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from tqdm import tqdm
+from natsort import natsorted
+from remind_dataset import ReMINDDataset, read_entry, iter_slabs
+from instrumentation import add_instrumentation_arguments, open_run_log, measure
+
+SESSIONS = {'Preop-MR':'Preop', 'Intraop-MR':'Intraop', 'Intraop-US':'Intraop'}
+
+
+def parsing_data():
+    parser = argparse.ArgumentParser(
+        description='Verification of the round trip NRRD -> DICOM -> NRRD/NIfTI: voxels and geometry of the '
+                    'converted volumes are compared with the source NRRD files')
+    parser.add_argument('--path_nrrd',
+                        type=str,
+                        default='./nrrd',
+                        help='Path to the source NRRD dataset')
+    parser.add_argument('--path_converted',
+                        type=str,
+                        default='./nifti_imgs',
+                        help='Path to the outputs of dicom_to_nifti-nrrd_img.py')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=0.,
+                        help='Maximum absolute difference of the voxels')
+    parser.add_argument('--tolerance_geometry',
+                        type=float,
+                        default=1e-3,
+                        help='Maximum difference of the spacing and origin (mm) and of the direction cosines')
+    parser.add_argument('--slab',
+                        type=int,
+                        default=16,
+                        help='Number of slices compared at once')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='Number of cases verified in parallel')
+    parser.add_argument('--output',
+                        type=str,
+                        default=None,
+                        help='Path to the JSON report (default: verify_report.json in the converted folder)')
+    add_instrumentation_arguments(parser)
+    opt = parser.parse_args()
+
+    return opt
+
+
+def get_converted_name(path_nrrd):
+    """
+    Case, session and series description of the converted volume of a source NRRD file,
+    following the DICOM naming of nrrd_to_dicom_img.py
+    @param path_nrrd: path to the source NRRD file (case/session/file.nrrd)
+    """
+    patient_id = path_nrrd.split("/")[-3][4:]
+    session = SESSIONS[path_nrrd.split("/")[-2]]
+    description = path_nrrd.replace('-r.n','.n').split('-')[-1].replace('.nrrd','')
+    if 'US' in path_nrrd.split("/")[-2]:
+        description = f'US_{description}'
+    return f'{patient_id}-CASE^{patient_id}', session, description
+
+
+def compare_geometry(source, converted, tolerance):
+    """
+    Differences of the geometry of two volumes
+    @param source: index entry of the source volume
+    @param converted: index entry of the converted volume
+    @return: list of the errors
+    """
+    errors = []
+    if tuple(source['shape'])!=tuple(converted['shape']):
+        return [f"shape {tuple(source['shape'])} != {tuple(converted['shape'])}"]
+    for name in ['spacing', 'origin', 'directions']:
+        difference = float(np.max(np.abs(np.asarray(source[name]) - np.asarray(converted[name]))))
+        if difference > tolerance:
+            errors.append(f'{name} differs by {difference:.3g}')
+    return errors
+
+
+def compare_voxels(source, converted, slab=16, tolerance=0.):
+    """
+    Compare two volumes slab by slab, so that only a few slices of each are in memory
+    @param source: index entry of the source volume
+    @param converted: index entry of the converted volume
+    @param slab: number of slices of a slab
+    @param tolerance: maximum absolute difference of the voxels
+    @return: maximum absolute difference, CRC32 of each source slab, first slices of the slabs that differ
+    """
+    max_difference, checksums, failed = 0., [], []
+    for k, (a, b) in enumerate(zip(iter_slabs(source, slab), iter_slabs(converted, slab))):
+        checksums.append(zlib.crc32(np.ascontiguousarray(a)))
+        difference = float(np.max(np.abs(a.astype(np.float64) - b.astype(np.float64))))
+        max_difference = max(max_difference, difference)
+        if difference > tolerance:
+            failed.append(k * slab)
+    return max_difference, checksums, failed
+
+
+def verify_case(paths_nrrd, path_converted, case, slab=16, tolerance=0., tolerance_geometry=1e-3):
+    """
+    Verify the converted volumes of a case
+    @param paths_nrrd: source NRRD files of the case
+    @param path_converted: path to the outputs of dicom_to_nifti-nrrd_img.py
+    @param case: name of the converted case folder
+    @return: list of results, one per source file
+    """
+    results = []
+    dataset = ReMINDDataset(path_converted, cases=[case]) if os.path.isdir(os.path.join(path_converted, case)) else None
+    for path_nrrd in paths_nrrd:
+        _, session, description = get_converted_name(path_nrrd)
+        result = {'case':case, 'source':path_nrrd, 'converted':None, 'status':'ok', 'errors':[], 'stages':{}}
+        results.append(result)
+        matches = [] if dataset is None else [k for k in dataset.find(session=session) if k['description']==description]
+        if len(matches)!=1:
+            result['status'] = 'missing' if len(matches)==0 else 'ambiguous'
+            result['errors'].append(f'{len(matches)} converted volumes named {description} in {case}/{session}')
+            continue
+        converted = matches[0]
+        result['converted'] = converted['path']
+        try:
+            with measure(result['stages'], 'verify'):
+                source = read_entry(path_nrrd)
+                result['errors'] += compare_geometry(source, converted, tolerance_geometry)
+                if tuple(source['shape'])==tuple(converted['shape']):
+                    max_difference, checksums, failed = compare_voxels(source, converted, slab, tolerance)
+                    result['max_abs_diff'] = max_difference
+                    result['slab_crc32'] = checksums
+                    if failed:
+                        result['errors'].append(f'voxels differ by up to {max_difference:.3g} in the slabs starting at slices {failed}')
+            result['stages']['verify']['bytes_read'] = os.path.getsize(path_nrrd) + os.path.getsize(converted['path'])
+        except Exception as e:
+            result['errors'].append(repr(e))
+        if result['errors']:
+            result['status'] = 'failed'
+    return results
+
+
+def main():
+    opt = parsing_data()
+    log = open_run_log(opt, opt.path_converted, 'verify_conversion')
+    path_output = opt.output if opt.output is not None else os.path.join(opt.path_converted, 'verify_report.json')
+
+    # Source images grouped by case, the segmentations are not round-tripped to images
+    jobs = {}
+    with log.stage('index'):
+        cases = natsorted([k for k in os.listdir(opt.path_nrrd) if os.path.isdir(os.path.join(opt.path_nrrd, k))])
+        for case in cases:
+            for folder in SESSIONS:
+                path_folder = os.path.join(opt.path_nrrd, case, folder)
+                if not os.path.isdir(path_folder):
+                    continue
+                paths_nrrd = [os.path.join(path_folder, k) for k in natsorted(os.listdir(path_folder)) if '.nrrd' in k]
+                case_converted = get_converted_name(os.path.join(path_folder, 'x.nrrd'))[0]
+                jobs.setdefault(case_converted, []).extend(paths_nrrd)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=opt.workers) as executor:
+        futures = [executor.submit(verify_case, paths_nrrd, opt.path_converted, case, opt.slab,
+                                   opt.tolerance, opt.tolerance_geometry) for case, paths_nrrd in jobs.items()]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            for result in future.result():
+                results.append(result)
+                for stage, measures in result.pop('stages').items():
+                    log.record_stage(stage, status=result['status'], case=result['case'], path=result['source'], **measures)
+                if result['status']!='ok':
+                    log.failure(result['source'], '; '.join(result['errors']), case=result['case'])
+
+    results = natsorted(results, key=lambda k: k['source'])
+    summary = {k: sum(result['status']==k for result in results) for k in ['ok', 'failed', 'missing', 'ambiguous']}
+    with open(path_output, 'w') as f:
+        json.dump({'summary':summary, 'tolerance':opt.tolerance, 'tolerance_geometry':opt.tolerance_geometry,
+                   'results':results}, f, indent=1)
+    print(f'----------- {len(results)} volumes verified -------------')
+    for status, count in summary.items():
+        print(f'{status}: {count}')
+    print(f'Report: {path_output}')
+    log.close()
+    if len(results)>summary['ok']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()